@@ -1,7 +1,8 @@
 from django.contrib import admin
 
 # Register your models here.
-from app.models import Organization, Activity, Patient, PatientTimeline, PublicTimeline, PotentialContact
+from app.models import Organization, Activity, Patient, PatientTimeline, PublicTimeline, PotentialContact, Job, \
+    ScoringProfile
 
 admin.site.register(Organization)
 admin.site.register(Activity)
@@ -9,3 +10,6 @@ admin.site.register(Patient)
 admin.site.register(PatientTimeline)
 admin.site.register(PublicTimeline)
 admin.site.register(PotentialContact)
+admin.site.register(Job)
+# saving a profile publishes it as a new version
+admin.site.register(ScoringProfile)
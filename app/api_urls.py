@@ -2,7 +2,9 @@ from django.urls import path
 from app.auth import OrganizationAuthToken
 from app.api_views import create_organization, update_organization_profile, update_organization_password, patients_view, \
     patient_view, patient_timelines_view, public_timelines_view, public_timeline_view, potential_contacts_view, \
-    activities_view, trace_contact, logout, patient_timeline_view, country_message_view
+    activities_view, trace_contact, logout, patient_timeline_view, country_message_view, job_view, \
+    public_timelines_batch_view, import_patient_timelines_view, export_patient_timelines_view, \
+    export_potential_contacts_view
 
 urlpatterns = [
     path('logout/', logout, name="api-logout"),
@@ -17,6 +19,7 @@ urlpatterns = [
     path("activities/", activities_view, name="api-activities"),
 
     path("trace/<int:public_timeline_id>/", trace_contact, name="api-trace"),
+    path("jobs/<int:job_id>/", job_view, name="api-job"),
 
     path("patients/", patients_view, name="api-patients"),
     path("patients/<int:patient_id>/", patient_view, name="api-patient-detail"),
@@ -24,7 +27,13 @@ urlpatterns = [
     path("patients/<int:patient_id>/timelines/<int:timeline_id>/", patient_timeline_view,
          name="api-patient-timeline-detail"),
     path("patients/<int:patient_id>/potentials/", potential_contacts_view, name="api-potentials"),
+    path("patients/timelines/import/", import_patient_timelines_view, name="api-import-patient-timelines"),
+    path("patients/timelines/export.<str:file_format>", export_patient_timelines_view,
+         name="api-export-patient-timelines"),
+    path("patients/potentials/export.<str:file_format>", export_potential_contacts_view,
+         name="api-export-potentials"),
 
     path("public/timelines/", public_timelines_view, name="api-public-timelines"),
+    path("public/timelines/batch/", public_timelines_batch_view, name="api-public-timelines-batch"),
     path("public/timelines/<int:timeline_id>/", public_timeline_view, name="api-public-timeline-detail"),
 ]
@@ -1,8 +1,10 @@
 import datetime
-import statistics
-from statistics import mean
+import json
 
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.db import IntegrityError
+from django.db.models import Q
 
 # Create your views here.
 from rest_framework import status
@@ -10,11 +12,22 @@ from rest_framework.decorators import api_view, permission_classes, authenticati
 from rest_framework.permissions import IsAuthenticatedOrReadOnly
 from rest_framework.response import Response
 
-from app.helpers import error_msg, success_msg, contact_chance, validate_email, generate_covid_id
-from app.models import Organization, Patient, PatientTimeline, Activity, PublicTimeline, PotentialContact, Location
+from app.caching import ACTIVITIES_VERSION, ACTIVITY_LIST_VERSION, LOCATION_DETAILS_VERSION, USERS_VERSION, \
+    cached_country_message, cached_trace, country_message_generation, country_version, public_timelines_version
+from app.conditional import conditional_response, validated_response
+from app.exports import EXPORT_FORMATS, PATIENT_TIMELINES, POTENTIAL_CONTACTS, InvalidExportFilter, export_response
+from app.covid_ids import save_patient
+from app.helpers import error_msg, success_msg, validate_email
+from app.ingestion import IMPORT_FORMATS, import_format, ingest_public_timelines, parse_activity_names, queue_import
+from app.interning import intern_activities, intern_location
+from app.jobs import can_read_job, enqueue, job_message
+from app.models import Organization, Patient, PatientTimeline, Activity, PublicTimeline, PotentialContact, Location, \
+    Job, VisitedLocation
+from app.pagination import PAGINATION_PARAMS, paginated_response
 from app.permissions import OrganizationPermission
 from app.serializers import OrganizationSerializer, PatientSerializer, PatientTimelineSerializer, \
-    PublicTimelineSerializer, PotentialContactSerializer, ActivitySerializer
+    PublicTimelineSerializer, PotentialContactSerializer, ActivitySerializer, PatientTimelineValuesSerializer, \
+    PublicTimelineValuesSerializer
 
 
 @api_view(['GET'])
@@ -110,27 +123,42 @@ def update_organization_password(request):
 @authentication_classes([])
 def country_message_view(request):
     country = request.GET.get('country', 'Nigeria')
-    org = Organization.objects.get(country=country)
+    generation = country_message_generation(country)
+
+    def respond():
+        status_code, body = cached_country_message(country, generation, country_message)
+        return Response(body, status=status_code)
+    token, last_modified = generation
+    return validated_response(request, '"%s"' % token, last_modified, respond)
+
+
+def country_message(country):
+    try:
+        org = Organization.objects.select_related('user').get(country=country)
+    except Organization.DoesNotExist:
+        return status.HTTP_404_NOT_FOUND, error_msg("Organization not found")
     serialized = OrganizationSerializer(org)
-    return Response(success_msg("Message retrieved", serialized.data), status=status.HTTP_200_OK)
+    return status.HTTP_200_OK, success_msg("Message retrieved", serialized.data)
 
 
 @api_view(['GET', 'POST', 'DELETE'])
 @permission_classes((OrganizationPermission,))
 def patients_view(request):
     if request.method == 'GET':
-        patients = Patient.objects.filter(creator=request.user)
-        serialized = PatientSerializer(patients, many=True)
-        return Response(success_msg("Retrieved patients successfully", serialized.data),
-                        status=status.HTTP_200_OK)
+        patients = PatientSerializer.eager_load(Patient.objects.filter(creator=request.user))
+        return paginated_response(request, patients, PatientSerializer, "Retrieved patients successfully")
     elif request.method == 'POST':
         full_name = request.data.get('full_name', None)
-        covid_id = request.data.get('covid_id', generate_covid_id())
+        covid_id = request.data.get('covid_id')  # generated when missing
         nationality = request.data.get('nationality')
         state = request.data.get('state')
         creator = request.user
         patient = Patient(full_name=full_name, covid_id=covid_id, nationality=nationality, state=state, creator=creator)
-        patient.save()
+        try:
+            save_patient(patient)
+        except IntegrityError:
+            return Response(error_msg("A patient with this covid_id already exists."),
+                            status=status.HTTP_400_BAD_REQUEST)
         serialized = PatientSerializer(patient)
         return Response(success_msg("Patient created successfully", serialized.data), status=status.HTTP_201_CREATED)
 
@@ -158,10 +186,9 @@ def patient_timelines_view(request, patient_id):
     except Patient.DoesNotExist:
         return Response(error_msg("Patient not found"), status=status.HTTP_404_NOT_FOUND)
     if request.method == 'GET':
-        patient_timelines = PatientTimeline.objects.filter(patient=patient)
-        serialized = PatientTimelineSerializer(patient_timelines, many=True)
-        return Response(success_msg("Retrieved patient timelines successfully", serialized.data),
-                        status=status.HTTP_200_OK)
+        patient_timelines = PatientTimelineValuesSerializer.eager_load(PatientTimeline.objects.filter(patient=patient))
+        return paginated_response(request, patient_timelines, PatientTimelineValuesSerializer,
+                                  "Retrieved patient timelines successfully")
     elif request.method == 'POST':
         time_range = request.data.get('time_range')
         timeline_date = request.data.get('date')
@@ -169,36 +196,73 @@ def patient_timelines_view(request, patient_id):
         state = request.data.get('state')
         country = request.data.get('country')
         creator = request.user
-        location, _ = Location.objects.get_or_create(name=request.data.get('location'),
-                                                               place_id=request.data.get('place_id'))
+        location = intern_location(request.data.get('location'), request.data.get('place_id'),
+                                   request.data.get('latitude'), request.data.get('longitude'), move=True)
         patient_timeline = PatientTimeline(patient=patient, location=location, time_range=time_range,
                                            date=timeline_date, country=country, state=state, creator=creator)
         patient_timeline.save()
-        activities = request.data.get('activities', '').split(',')  # received as a comma separated string
-        for activity in activities:
-            try:
-                act = Activity.objects.get(name=activity.lower())
-            except Activity.DoesNotExist:
-                act = Activity.objects.create(name=activity.lower(), creator=request.user)
-            patient_timeline.activities.add(act)
-            location.activities.add(act)
-        other_activities = request.data.get('other_activities', '').split(',')  # received as a comma separated string
-        for activity in other_activities:
-            try:
-                act = Activity.objects.get(name=activity.lower())
-            except Activity.DoesNotExist:
-                act = Activity.objects.create(name=activity.lower(), creator=request.user)
-            location.activities.add(act)
-        serialized = PatientTimelineSerializer(patient_timeline)  # TODO: perform a trace using the just created patient timeline
+        # received as comma separated strings
+        activities = parse_activity_names(request.data.get('activities'))
+        other_activities = parse_activity_names(request.data.get('other_activities'))
+        interned = intern_activities(activities + other_activities, creator=request.user)
+        if activities:
+            patient_timeline.activities.add(*[interned[name] for name in activities])
+        if interned:
+            location.activities.add(*interned.values())
+        enqueue('reverse_trace', creator=creator, patient_timeline_id=patient_timeline.pk)
+        serialized = PatientTimelineSerializer(patient_timeline)
         return Response(success_msg("Patient timeline created successfully", serialized.data), status=status.HTTP_201_CREATED)
 
 
+@api_view(['POST'])
+@permission_classes((OrganizationPermission,))
+def import_patient_timelines_view(request):
+    if request.method == 'POST':
+        upload = request.FILES.get('file')
+        if upload is None:
+            return Response(error_msg("Upload the timelines as file."), status=status.HTTP_400_BAD_REQUEST)
+        file_format = request.data.get('format') or import_format(upload.name)
+        if file_format not in IMPORT_FORMATS:
+            return Response(error_msg("Invalid format, expected csv or ndjson."), status=status.HTTP_400_BAD_REQUEST)
+        # imported by a job, a large file takes longer than a request may
+        upload.open('rb')
+        job = queue_import(upload.file, file_format, request.user)
+        return Response(success_msg("Import queued.", {'job_id': job.pk, 'status': job.status}),
+                        status=status.HTTP_202_ACCEPTED)
+
+
+def streamed_export(request, export, queryset, file_format):
+    if file_format not in EXPORT_FORMATS:
+        return Response(error_msg("Invalid format, expected csv or ndjson."), status=status.HTTP_400_BAD_REQUEST)
+    try:
+        queryset = export.filter(queryset, request.GET)
+    except InvalidExportFilter as e:
+        return Response(error_msg(str(e)), status=status.HTTP_400_BAD_REQUEST)
+    return export_response(export, queryset, file_format, chunk_size=settings.EXPORT_CHUNK_SIZE)
+
+
+@api_view(['GET'])
+@permission_classes((OrganizationPermission,))
+def export_patient_timelines_view(request, file_format):
+    if request.method == 'GET':
+        patient_timelines = PatientTimeline.objects.filter(patient__creator=request.user)
+        return streamed_export(request, PATIENT_TIMELINES, patient_timelines, file_format)
+
+
+@api_view(['GET'])
+@permission_classes((OrganizationPermission,))
+def export_potential_contacts_view(request, file_format):
+    if request.method == 'GET':
+        potential_contacts = PotentialContact.objects.filter(patient__creator=request.user)
+        return streamed_export(request, POTENTIAL_CONTACTS, potential_contacts, file_format)
+
+
 @api_view(['GET', 'DELETE'])
 @permission_classes((OrganizationPermission,))
 def patient_timeline_view(request, patient_id, timeline_id):
     if request.method == 'GET':
         try:
-            patient_timeline = PatientTimeline.objects.get(pk=int(timeline_id))
+            patient_timeline = PatientTimelineSerializer.eager_load(PatientTimeline.objects).get(pk=int(timeline_id))
             serialized = PatientTimelineSerializer(patient_timeline)
             return Response(success_msg("Patient timeline retrieved successfully", serialized.data), status=status.HTTP_200_OK)
         except PatientTimeline.DoesNotExist:
@@ -222,9 +286,11 @@ def public_timelines_view(request):
             public_timelines = PublicTimeline.objects.filter(country=request.GET.get('country'))
         else:
             public_timelines = PublicTimeline.objects.all()
-        serialized = PublicTimelineSerializer(public_timelines, many=True)
-        return Response(success_msg("Retrieved public timelines successfully", serialized.data),
-                        status=status.HTTP_200_OK)
+        public_timelines = PublicTimelineValuesSerializer.eager_load(public_timelines)
+        versions = (public_timelines_version(request.GET.get('country') or None), LOCATION_DETAILS_VERSION,
+                    ACTIVITIES_VERSION, USERS_VERSION)
+        return conditional_response(request, versions, lambda: paginated_response(
+            request, public_timelines, PublicTimelineValuesSerializer, "Retrieved public timelines successfully"))
     elif request.method == 'POST':
         time_range = request.data.get('time_range')
         timeline_date = request.data.get('date')
@@ -234,32 +300,54 @@ def public_timelines_view(request):
         phone_number = request.data.get('phone_number', None)
         address = request.data.get('address', None)
         email = request.data.get('email', None)
-        location, _ = Location.objects.get_or_create(name=request.data.get('location'),
-                                                     place_id=request.data.get('place_id'))
+        location = intern_location(request.data.get('location'), request.data.get('place_id'),
+                                   request.data.get('latitude'), request.data.get('longitude'))
         public_timeline = PublicTimeline(location=location, time_range=time_range, date=timeline_date, state=state,
                                           country=country, email=email, phone_number=phone_number, address=address)
         public_timeline.save()
-        activities = request.data.get('activities')  # received as a comma separated string
+        activities = parse_activity_names(request.data.get('activities'))  # received as a comma separated string
         if activities:
-            activities = activities.split(',')
-            for activity in activities:
-                try:
-                    act = Activity.objects.get(name=activity.lower())
-                except Activity.DoesNotExist:
-                    act = Activity.objects.create(name=activity.lower(), creator=request.user)
-                public_timeline.activities.add(act)
-                location.activities.add(act)
+            # the endpoint is unauthenticated, activities it creates have no creator
+            interned = intern_activities(activities)
+            public_timeline.activities.add(*interned.values())
+            location.activities.add(*interned.values())
         serialized = PublicTimelineSerializer(public_timeline)
         return Response(success_msg("Public timeline created successfully", serialized.data), status=status.HTTP_201_CREATED)
 
 
+@api_view(['POST'])
+@permission_classes(())
+@authentication_classes([])
+def public_timelines_batch_view(request):
+    if request.method == 'POST':
+        # a list of timelines, each as public_timelines_view receives one, or {"timelines": [...]}
+        items = request.data
+        if isinstance(items, dict):
+            items = items.get('timelines')
+        if not isinstance(items, list):
+            return Response(error_msg("Expected a list of timelines."), status=status.HTTP_400_BAD_REQUEST)
+        if len(items) > settings.API_MAX_BATCH_SIZE:
+            return Response(error_msg("At most %d timelines per batch." % settings.API_MAX_BATCH_SIZE),
+                            status=status.HTTP_400_BAD_REQUEST)
+        # the endpoint is unauthenticated, activities it creates have no creator
+        results = ingest_public_timelines(items, creator=None, trace=request.GET.get('trace') in ('1', 'true'))
+        created = PublicTimelineValuesSerializer.eager_load(
+            PublicTimeline.objects.filter(id__in=[result['id'] for result in results if 'id' in result]))
+        serialized = {row['id']: row for row in PublicTimelineValuesSerializer(created).data}
+        for result in results:
+            if 'id' in result:
+                result['data'] = serialized[result.pop('id')]
+        return Response(success_msg("Created %d of %d public timelines" % (len(serialized), len(items)), results),
+                        status=status.HTTP_201_CREATED)
+
+
 @api_view(['GET', 'PUT', 'DELETE'])
 @permission_classes(())
 @authentication_classes([])
 def public_timeline_view(request, timeline_id):
     if request.method == 'GET':
         try:
-            public_timeline = PublicTimeline.objects.get(pk=int(timeline_id))
+            public_timeline = PublicTimelineSerializer.eager_load(PublicTimeline.objects).get(pk=int(timeline_id))
             serialized = PublicTimelineSerializer(public_timeline)
             return Response(success_msg("Public timeline retrieved successfully", serialized.data), status=status.HTTP_200_OK)
         except PublicTimeline.DoesNotExist:
@@ -294,10 +382,9 @@ def potential_contacts_view(request, patient_id):
     except Patient.DoesNotExist:
         return Response(error_msg("Patient not found"), status=status.HTTP_404_NOT_FOUND)
     if request.method == 'GET':
-        potential_contacts = PotentialContact.objects.filter(patient=patient)
-        serialized = PotentialContactSerializer(potential_contacts, many=True)
-        return Response(success_msg("Retrieved potential contacts successfully", serialized.data),
-                        status=status.HTTP_200_OK)
+        potential_contacts = PotentialContactSerializer.eager_load(PotentialContact.objects.filter(patient=patient))
+        return paginated_response(request, potential_contacts, PotentialContactSerializer,
+                                  "Retrieved potential contacts successfully")
 
 
 @api_view(['GET'])
@@ -305,38 +392,33 @@ def potential_contacts_view(request, patient_id):
 @authentication_classes([])
 def activities_view(request):
     if request.method == 'GET':
-        if len(request.GET) < 1:
+        if not set(request.GET) - set(PAGINATION_PARAMS):
             activities = Activity.objects.all().order_by('name')
-            serialized = ActivitySerializer(activities, many=True)
-            return Response(success_msg("Retrieved activities successfully", serialized.data),
-                            status=status.HTTP_200_OK)
-        activities = set()
-        timelines = PatientTimeline.objects
+            return conditional_response(request, (ACTIVITY_LIST_VERSION,), lambda: paginated_response(
+                request, activities, ActivitySerializer, "Retrieved activities successfully", ordering=('name', 'id')))
+        # activities at the locations of the matching timelines, and at the location asked for
+        visits = VisitedLocation.objects.filter(timelines__gt=0)
         if request.GET.get('country'):
-            timelines = timelines.filter(country=request.GET.get('country'))
+            visits = visits.filter(country=request.GET.get('country'))
         if request.GET.get('state'):
-            timelines = timelines.filter(state=request.GET.get('state'))
+            visits = visits.filter(state=request.GET.get('state'))
+        locations = Q(id__in=visits.values('location_id'))
         if request.GET.get('location'):
-            try:
-                location_by_name = Location.objects.get(name=request.GET.get('location'))
-                for activity in location_by_name.activities.all():
-                    activities.add(activity)
-            except Location.DoesNotExist:
-                pass
+            locations |= Q(name=request.GET.get('location'))
         if request.GET.get('place_id'):
-            try:
-                location_by_place_id = Location.objects.get(place_id=request.GET.get('place_id'))
-                for activity in location_by_place_id.activities.all():
-                    activities.add(activity)
-            except Location.DoesNotExist:
-                pass
-        for timeline in timelines:
-            timeline_activities = timeline.location.activities.all()
-            for timeline_activity in timeline_activities:
-                activities.add(timeline_activity)
-        serialized = ActivitySerializer(activities, many=True)
-        return Response(success_msg("Retrieved activities successfully", serialized.data),
-                        status=status.HTTP_200_OK)
+            locations |= Q(place_id=request.GET.get('place_id'))
+        activities = Activity.objects.filter(
+            id__in=Location.activities.through.objects.filter(
+                location__in=Location.objects.filter(locations)).values('activity_id')).order_by('name')
+
+        def respond():
+            return paginated_response(request, activities, ActivitySerializer, "Retrieved activities successfully",
+                                      ordering=('name', 'id'))
+        if not request.GET.get('country'):
+            # the patient timelines of every country have no data version
+            return respond()
+        versions = (ACTIVITY_LIST_VERSION, LOCATION_DETAILS_VERSION, country_version(request.GET.get('country')))
+        return conditional_response(request, versions, respond)
 
 
 @api_view(['GET'])
@@ -348,51 +430,28 @@ def trace_contact(request, public_timeline_id):
     except PublicTimeline.DoesNotExist:
         return Response(error_msg("Public timeline not found"), status=status.HTTP_404_NOT_FOUND)
     if request.method == 'GET':
-        probabilities = []
-        matched_activities = set()
-        possible_contacts = 0
-        patient_timelines = PatientTimeline.objects.filter(country=public_timeline.country)  # 16.6%
-        if patient_timelines.exists():
-            for patient_timeline in patient_timelines:
-                matches = set()
-                matched_activities_local = []
-                if patient_timeline.country == public_timeline.country:
-                    matches.add('country')
-                if patient_timeline.state == public_timeline.state:
-                    matches.add('state')
-                if patient_timeline.location == public_timeline.location:
-                    matches.add('location')
-                if patient_timeline.date == public_timeline.date:
-                    matches.add('date')
-                if patient_timeline.time_range == public_timeline.time_range:
-                    matches.add('time_range')
-                for patient_activity in patient_timeline.activities.all():
-                    if patient_activity in public_timeline.activities.all():
-                        matches.add('activity')
-                        matched_activities.add(patient_activity.name)
-                        matched_activities_local.append(patient_activity)
-                probability = contact_chance(matches)
-                probabilities.append(probability)
-                if probability >= 50:
-                    possible_contacts += 1
-                    potential_contact = PotentialContact(public_timeline=public_timeline, probability=probability,
-                                                         patient_timeline=patient_timeline,
-                                                         patient=patient_timeline.patient)
-                    potential_contact.save()
-                    for matched_activity in matched_activities_local:
-                        potential_contact.activities.add(matched_activity)
-        top_probability = 0
-        if len(probabilities) > 0:
-            probabilities.sort(reverse=True)
-            top_probability = probabilities[0]
-        try:
-            chance = mean(probabilities)
-        except statistics.StatisticsError:
-            chance = 0
-        response = {
-            'average_probability': chance,
-            'top_probability': top_probability,
-            'possible_contacts': possible_contacts,
-            'matched_activities': matched_activities
-        }
+        if request.GET.get('async') in ('1', 'true'):
+            job = enqueue('trace_public_timeline', public_timeline_id=public_timeline.pk)
+            return Response(success_msg("Trace queued.", {'job_id': job.pk, 'status': job.status}),
+                            status=status.HTTP_202_ACCEPTED)
+        response = cached_trace(public_timeline)
         return Response(success_msg("Trace complete.", response), status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes(())
+def job_view(request, job_id):
+    try:
+        job = Job.objects.get(pk=int(job_id))
+        if not can_read_job(request.user, job):
+            # jobs of other users are not found, rather than forbidden, to not tell which ids exist
+            raise Job.DoesNotExist
+    except Job.DoesNotExist:
+        return Response(error_msg("Job not found"), status=status.HTTP_404_NOT_FOUND)
+    if request.method == 'GET':
+        if job.status == Job.DONE:
+            return Response(success_msg(job_message(job), json.loads(job.result)), status=status.HTTP_200_OK)
+        if job.status == Job.FAILED:
+            return Response(error_msg("Job failed."), status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return Response(success_msg("Job pending.", {'job_id': job.pk, 'status': job.status}),
+                        status=status.HTTP_202_ACCEPTED)
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class AppConfig(AppConfig):
     name = 'app'
+
+    def ready(self):
+        from app import signals  # noqa: F401
+        from app import ingestion  # noqa: F401, registers the import job handler
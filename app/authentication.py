@@ -0,0 +1,99 @@
+"""Token authentication caching the tokens, users and organizations it looked up.
+
+Kept apart from app.auth, as the authentication classes of the REST_FRAMEWORK
+setting can't import rest_framework views.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.utils.translation import ugettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from app.caching import LRUCache
+from app.models import Organization
+
+_token_cache = None
+_lock = threading.Lock()
+_forgotten = 0  # tokens forgotten so far, a lookup that raced with forgetting one isn't cached
+
+
+def get_token_cache():
+    """Returns the token cache of the process, created on first use from the TOKEN_CACHE setting."""
+    global _token_cache
+    with _lock:
+        if _token_cache is None:
+            _token_cache = LRUCache(settings.TOKEN_CACHE['MAX_SIZE'])
+        return _token_cache
+
+
+def reset_token_cache():
+    global _token_cache
+    with _lock:
+        _token_cache = None
+
+
+def forget_token(key):
+    """Makes the next request authenticated with the token of key look it up again, app.signals calls it."""
+    global _forgotten
+    with _lock:
+        _forgotten += 1
+    get_token_cache().delete(key)
+
+
+def forget_tokens_of(user_id):
+    for key in Token.objects.filter(user_id=user_id).values_list('key', flat=True):
+        forget_token(key)
+
+
+def field_values(instance):
+    if instance is None:
+        return None
+    return tuple(getattr(instance, field.attname) for field in instance._meta.concrete_fields)
+
+
+def from_values(model, values):
+    if values is None:
+        return None
+    return model.from_db(model.objects.db, [field.attname for field in model._meta.concrete_fields], values)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """ `TokenAuthentication` keeping the token, its user and the user's organization in the memory of the process
+    for TOKEN_CACHE['TTL'] seconds, or until the token is deleted or the user or organization saved in the process.
+
+    The user comes with its organization, so `OrganizationPermission` and `request.user.organization` cost no query.
+    """
+
+    def authenticate_credentials(self, key):
+        cache = get_token_cache()
+        cached = cache.get(key)
+        if cached is None or cached[0] < time.monotonic():
+            forgotten = _forgotten
+            token = Token.objects.select_related('user', 'user__organization').filter(key=key).first()
+            if token is None:
+                raise exceptions.AuthenticationFailed(_('Invalid token.'))
+            try:
+                organization = token.user.organization
+            except Organization.DoesNotExist:
+                organization = None
+            cached = (time.monotonic() + settings.TOKEN_CACHE['TTL'], field_values(token), field_values(token.user),
+                      field_values(organization))
+            if forgotten == _forgotten:
+                cache.set(key, cached)
+        # fresh instances every request, as views change the ones they are given
+        expires, token, user, organization = cached
+        token, user, organization = from_values(Token, token), from_values(User, user), \
+            from_values(Organization, organization)
+        token.user = user
+        User.auth_token.related.set_cached_value(user, token)
+        User.organization.related.set_cached_value(user, organization)
+        if organization is not None:
+            organization.user = user
+
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+        return user, token
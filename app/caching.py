@@ -0,0 +1,223 @@
+"""Caching of trace results and of country messages.
+
+A cached trace is keyed by the public timeline (its id, last save and
+activities), the trace settings, and the data versions of everything else the
+result depends on: the patient timelines of its country, the names of
+activities and the scoring profiles. app.signals bumps those versions whenever the data changes, so a
+result computed before a change is never looked up again. The ETags of public
+endpoints are derived from data versions too, see app.conditional.
+
+Country messages, fetched on every app launch, are served from the cache
+without any query. They are keyed by a generation token of their country that
+app.signals replaces when an organization or its user changes. The token and
+the time it was replaced are the ETag and Last-Modified of the message, so a
+client whose copy is current is answered without the message being built.
+"""
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from app.helpers import add_or_create
+from app.models import DataVersion
+from app.tracing import trace_public_timeline
+
+ACTIVITIES_VERSION = 'activities'
+ACTIVITY_LIST_VERSION = 'activity_list'  # unlike ACTIVITIES_VERSION also bumped when an activity is created
+LOCATIONS_VERSION = 'locations'  # of the names and place ids of locations, see app.interning
+LOCATION_DETAILS_VERSION = 'location_details'  # of everything serialized with a location, activities included
+SCORING_PROFILES_VERSION = 'scoring_profiles'
+USERS_VERSION = 'users'  # of the names serialized with the rows a user created
+
+
+def country_version(country):
+    return 'country:%s' % country
+
+
+def public_timelines_version(country=None):
+    """Version of the public timelines of country, or of every public timeline when country is None."""
+    return 'public' if country is None else 'public:%s' % country
+
+
+def data_versions(*keys):
+    """Returns the current version of each key, 0 for keys that never changed."""
+    versions = dict(DataVersion.objects.filter(key__in=keys).values_list('key', 'version'))
+    return [versions.get(key, 0) for key in keys]
+
+
+def bump_data_versions(*keys):
+    for key in set(keys):
+        add_or_create(DataVersion, {'key': key}, version=1)
+
+
+class TraceCache:
+    """Counts hits and misses of a cache backend."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.lookup(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+class LRUCache(TraceCache):
+    """Keeps the max_size most recently used results in the memory of the process."""
+
+    def __init__(self, max_size=10000):
+        super().__init__()
+        self.max_size = max_size
+        self.values = OrderedDict()
+        self.lock = threading.Lock()
+
+    def lookup(self, key):
+        with self.lock:
+            value = self.values.get(key)
+            if value is not None:
+                self.values.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.values[key] = value
+            self.values.move_to_end(key)
+            while len(self.values) > self.max_size:
+                self.values.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.values.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+    def stats(self):
+        return dict(super().stats(), size=len(self.values), max_size=self.max_size)
+
+
+class DjangoCache(TraceCache):
+    """Keeps results in one of the CACHES of the Django cache framework."""
+
+    def __init__(self, alias='default', timeout=24 * 60 * 60):
+        super().__init__()
+        self.cache = caches[alias]
+        self.timeout = timeout
+
+    def lookup(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value):
+        self.cache.set(key, value, self.timeout)
+
+    def clear(self):
+        self.cache.clear()
+
+
+_trace_cache = None
+
+
+def get_trace_cache():
+    """Returns the cache backend of the TRACE_CACHE setting, created on first use."""
+    global _trace_cache
+    if _trace_cache is None:
+        _trace_cache = import_string(settings.TRACE_CACHE['BACKEND'])(**settings.TRACE_CACHE.get('OPTIONS', {}))
+    return _trace_cache
+
+
+def reset_trace_cache():
+    """Drops the cache backend, so the next trace creates it again from the settings."""
+    global _trace_cache
+    _trace_cache = None
+
+
+def trace_cache_key(public_timeline):
+    versions = data_versions(country_version(public_timeline.country), ACTIVITIES_VERSION, SCORING_PROFILES_VERSION)
+    return 'trace:%d:%s:%s:%s:%s:%s:%s' % (
+        public_timeline.pk, public_timeline.updated.timestamp(), bytes(public_timeline.activity_bits).hex(),
+        settings.TRACE_SCORING_PROFILE, settings.TRACE_DATE_WINDOW, settings.TRACE_PROXIMITY_RADIUS,
+        ':'.join(map(str, versions)))
+
+
+def cached_trace(public_timeline):
+    """ Returns the result of `trace_public_timeline`, traced again only when the data it depends on changed.
+
+    The data versions are read before tracing, so a change made during the trace leaves the
+    result under a key that is never looked up again.
+    """
+    cache = get_trace_cache()
+    key = trace_cache_key(public_timeline)
+    response = cache.get(key)
+    if response is None:
+        response = trace_public_timeline(public_timeline)
+        cache.set(key, response)
+    return dict(response, matched_activities=set(response['matched_activities']))
+
+
+def country_message_generation_key(country):
+    # (token, timestamp) pairs, under a new prefix as tokens used to be cached alone
+    return 'country_message_generations:%s' % quote(country)
+
+
+def new_country_message_generation():
+    """A new (token, timestamp) generation, stamped with the time the message changed."""
+    return uuid.uuid4().hex, int(time.time())
+
+
+def country_message_generation(country):
+    """ The (token, timestamp) generation of the current message of country, replaced by
+    `forget_country_messages`. A generation evicted from the cache is replaced by one stamped now.
+    """
+    cache = caches[settings.COUNTRY_MESSAGE_CACHE['ALIAS']]
+    key = country_message_generation_key(country)
+    generation = cache.get(key)
+    if generation is None:
+        generation = new_country_message_generation()
+        cache.add(key, generation, None)
+        generation = cache.get(key, generation)
+    return generation
+
+
+def cached_country_message(country, generation, message):
+    """ Returns the (status code, body) message(country) returns, computed once per generation of country,
+    from `country_message_generation`.
+    """
+    cache = caches[settings.COUNTRY_MESSAGE_CACHE['ALIAS']]
+    key = 'country_message:%s:%s' % (quote(country), generation[0])
+    cached = cache.get(key)
+    if cached is None:
+        status_code, body = message(country)
+        cached = (status_code, json.loads(json.dumps(body)))
+        cache.set(key, cached, settings.COUNTRY_MESSAGE_CACHE['TIMEOUT'])
+    return cached
+
+
+def forget_country_messages(*countries):
+    """ Makes the next `cached_country_message` of each of countries compute it again.
+
+    The messages are forgotten at once and again when the current transaction commits, as one computed
+    from the data read before the commit could be cached in between.
+    """
+    countries = {country for country in countries if country is not None}
+
+    def forget():
+        cache = caches[settings.COUNTRY_MESSAGE_CACHE['ALIAS']]
+        for country in countries:
+            cache.set(country_message_generation_key(country), new_country_message_generation(), None)
+    forget()
+    transaction.on_commit(forget)
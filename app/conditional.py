@@ -0,0 +1,55 @@
+"""Conditional GET of the public endpoints clients poll.
+
+The ETag of a response is derived from the data versions app.signals bumps
+whenever what it serializes changes, and its Last-Modified is the time of the
+latest of those bumps. A client whose copy is current gets 304 Not Modified
+for the price of one indexed query, without anything being serialized.
+"""
+import calendar
+import hashlib
+import json
+
+from django.conf import settings
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from rest_framework import status
+
+from app.models import DataVersion
+
+
+def validators(request, keys):
+    """ Returns the strong ETag and the Last-Modified timestamp of the response to request, a response
+    depending on the data versions of keys. The timestamp is None when none of keys changed yet.
+    """
+    rows = {key: (version, updated) for key, version, updated in
+            DataVersion.objects.filter(key__in=keys).values_list('key', 'version', 'updated')}
+    versions = [rows[key][0] if key in rows else 0 for key in keys]
+    # the query string and the list settings change the response as much as the data does
+    state = [request.path, sorted(request.GET.lists()), versions,
+             settings.API_PAGINATE, settings.API_PAGE_SIZE, settings.API_MAX_PAGE_SIZE]
+    etag = '"%s"' % hashlib.sha1(json.dumps(state).encode()).hexdigest()
+    last_modified = max((updated for _, updated in rows.values()), default=None)
+    if last_modified is not None:
+        last_modified = calendar.timegm(last_modified.utctimetuple())
+    return etag, last_modified
+
+
+def conditional_response(request, keys, respond):
+    """ Responds with respond(), or with 304 Not Modified when the copy the client names with If-None-Match
+    or If-Modified-Since is current. Successful responses carry the ETag and Last-Modified of keys.
+    """
+    etag, last_modified = validators(request, keys)
+    return validated_response(request, etag, last_modified, respond)
+
+
+def validated_response(request, etag, last_modified, respond):
+    """`conditional_response` with validators of the caller, last_modified is None when there is none."""
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = respond()
+        if response.status_code != status.HTTP_200_OK:
+            return response
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
@@ -0,0 +1,135 @@
+"""Allocation of COVID IDs.
+
+Generated IDs keep their COVID-<8 digits> format, but are no longer drawn at
+random and looked up until a free one turns up. They are the values of a
+counter permuted by a keyed Feistel network over the 10**8 IDs, so distinct
+counter values always give distinct IDs, and consecutive ones don't look
+consecutive. Each process reserves the counter values it hands out a block of
+COVID_IDS['BLOCK_SIZE'] at a time. A reservation commits on its own, like
+the values of a database sequence, so the block stays the process's when the
+transaction it was made in rolls back. SQLite can't write on a second
+connection during a transaction, there a reservation made in one takes only
+the values handed out, which go back if it rolls back.
+
+The IDs patients were created with before, or were given by their
+organization, can't be told apart from generated ones. Generated IDs any
+patient has already are skipped, checked with one query per 500 IDs, and
+`save_patient` moves on to the next ID when a patient of the same creator
+takes it in the meantime.
+"""
+import hashlib
+import threading
+
+from django.conf import settings
+from django.db import IntegrityError, connection, connections, transaction
+
+from app.helpers import add_or_create, chunked
+from app.models import Patient, Sequence
+
+COVID_IDS_SEQUENCE = 'covid_ids'
+HALF = 10 ** 4  # IDs are permuted as pairs of 4 digit halves
+ROUNDS = 4
+RESERVATION_ALIAS = 'covid_ids_reservation'  # of the connection reserving blocks outside of a transaction
+
+_lock = threading.RLock()
+_reserved = []  # [next, end) of the counter values reserved by the process
+
+
+class CovidIdsExhausted(Exception):
+    pass
+
+
+def take(name, count, using):
+    """Takes count values of the named sequence in a transaction on the using connection, returns the first one."""
+    with transaction.atomic(using=using):
+        # the update locks the row until the end of the transaction, so the value read back is ours
+        add_or_create(Sequence, {'name': name}, using=using, value=count)
+        return Sequence.objects.using(using).filter(name=name).values_list('value', flat=True).get() - count
+
+
+def reserves_apart():
+    """Whether a reservation commits on its own: outside of a transaction, or on a second connection but with SQLite."""
+    return not connection.in_atomic_block or connection.vendor != 'sqlite'
+
+
+def reserve(name, count):
+    """ Takes count values of the named sequence, returns the first one.
+
+    Inside a transaction the values are taken on a connection of their own, committed at once, but with SQLite.
+    """
+    if not connection.in_atomic_block or not reserves_apart():
+        return take(name, count, connection.alias)
+    connections[RESERVATION_ALIAS] = connection.copy(alias=RESERVATION_ALIAS)
+    try:
+        return take(name, count, RESERVATION_ALIAS)
+    finally:
+        connections[RESERVATION_ALIAS].close()
+        del connections[RESERVATION_ALIAS]
+
+
+def round_value(key, round_index, half):
+    digest = hashlib.blake2b(b'%d:%d' % (round_index, half), key=key, digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % HALF
+
+
+def permute(value):
+    """The keyed Feistel permutation of the values below HALF ** 2."""
+    key = settings.COVID_IDS['KEY'].encode()[:64]
+    left, right = divmod(value, HALF)
+    for round_index in range(ROUNDS):
+        left, right = right, (left + round_value(key, round_index, right)) % HALF
+    return left * HALF + right
+
+
+def counter_values(count):
+    """Hands out count values of the counter from the block of the process, reserving another one when it runs out."""
+    with _lock:
+        values = []
+        if _reserved:
+            start, end = _reserved
+            taken = min(count, end - start)
+            values.extend(range(start, start + taken))
+            _reserved[0] += taken
+        missing = count - len(values)
+        if missing:
+            size = max(missing, settings.COVID_IDS['BLOCK_SIZE']) if reserves_apart() else missing
+            start = reserve(COVID_IDS_SEQUENCE, size)
+            if start + size > HALF ** 2:
+                raise CovidIdsExhausted("Every COVID ID was handed out.")
+            values.extend(range(start, start + missing))
+            _reserved[:] = [start + missing, start + size]
+    return values
+
+
+def allocate_covid_ids(count):
+    """Returns count new COVID IDs no patient has."""
+    covid_ids = []
+    while len(covid_ids) < count:
+        generated = ['COVID-%08d' % permute(value) for value in counter_values(count - len(covid_ids))]
+        taken = set()
+        for chunk in chunked(generated, 500):
+            taken.update(Patient.objects.filter(covid_id__in=chunk).values_list('covid_id', flat=True))
+        covid_ids.extend(covid_id for covid_id in generated if covid_id not in taken)
+    return covid_ids
+
+
+def next_covid_id():
+    return allocate_covid_ids(1)[0]
+
+
+def save_patient(patient, attempts=10):
+    """ Saves the new patient, with the next COVID ID unless it was given one.
+
+    Raises IntegrityError when the COVID ID it was given is taken by another patient of its creator.
+    """
+    generated = patient.covid_id is None
+    for attempt in range(attempts):
+        if generated:
+            patient.covid_id = next_covid_id()
+        try:
+            with transaction.atomic():
+                patient.save(force_insert=True)
+            return patient
+        except IntegrityError:
+            if not generated or attempt == attempts - 1:
+                raise
@@ -0,0 +1,144 @@
+"""Streaming exports of potential contacts and patient timelines.
+
+Rows are read through `QuerySet.iterator`, with a server-side cursor where the
+database has them, and written out as CSV or NDJSON a chunk at a time as they
+come, so an export of any size streams in constant memory. The compression
+middleware gzips the stream on the fly for clients that accept it.
+"""
+import csv
+import datetime
+import io
+import itertools
+import json
+from collections import OrderedDict
+
+from django.http import StreamingHttpResponse
+
+from app.models import PatientTimeline, PotentialContact, PublicTimeline
+from app.serializers import activity_names
+
+EXPORT_FORMATS = OrderedDict([('csv', 'text/csv'), ('ndjson', 'application/x-ndjson')])
+
+# (column, lookup) of the fields exported
+PATIENT_COLUMNS = (('patient_id', 'patient_id'), ('covid_id', 'patient__covid_id'),
+                   ('full_name', 'patient__full_name'))
+VISIT_COLUMNS = (('date', 'date'), ('time_range', 'time_range'), ('state', 'state'), ('country', 'country'),
+                 ('location', 'location__name'), ('place_id', 'location__place_id'),
+                 ('latitude', 'location__latitude'), ('longitude', 'location__longitude'))
+PUBLIC_COLUMNS = (('address', 'address'), ('email', 'email'), ('phone_number', 'phone_number'))
+
+
+class InvalidExportFilter(ValueError):
+    pass
+
+
+def prefixed(prefix, columns):
+    return tuple((prefix + '_' + column, prefix + '__' + lookup) for column, lookup in columns)
+
+
+class Export:
+    """ The rows of a model exported with columns, and with activity_columns: (column, model, id column)
+    listing the names of the activities of the row of model whose id is in the id column.
+    """
+
+    def __init__(self, name, columns, activity_columns, filters):
+        self.name = name
+        self.columns = columns
+        self.activity_columns = activity_columns
+        self.filters = filters  # query parameter -> (lookup, parse)
+
+    @property
+    def headers(self):
+        return [column for column, _ in self.columns] + [column for column, _, _ in self.activity_columns]
+
+    def filter(self, queryset, params):
+        """Filters queryset with the query parameters of the export, raises InvalidExportFilter for invalid ones."""
+        for param, (lookup, parse) in self.filters.items():
+            if params.get(param):
+                try:
+                    queryset = queryset.filter(**{lookup: parse(params[param])})
+                except ValueError:
+                    raise InvalidExportFilter("Invalid %s." % param)
+        return queryset
+
+    def records(self, queryset, chunk_size=2000):
+        """Yields lists of at most chunk_size exported rows of queryset, as ordered dicts of the columns."""
+        indexes = {column: index for index, (column, _) in enumerate(self.columns)}
+        rows = queryset.order_by('id').values_list(*[lookup for _, lookup in self.columns]).iterator(
+            chunk_size=chunk_size)
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                return
+            names = [activity_names(model, {row[indexes[id_column]] for row in chunk})
+                     for _, model, id_column in self.activity_columns]
+            records = []
+            for row in chunk:
+                record = OrderedDict((column, exported(value)) for (column, _), value in zip(self.columns, row))
+                for (column, _, id_column), activities in zip(self.activity_columns, names):
+                    record[column] = activities.get(record[id_column], [])
+                records.append(record)
+            yield records
+
+
+def parse_date(value):
+    return datetime.datetime.strptime(value, "%Y-%m-%d").date()  # e.g. 2010-05-24
+
+
+# potential contacts are filtered on the visit of their public timeline
+POTENTIAL_CONTACTS = Export(
+    'potential_contacts',
+    (('id', 'id'), ('probability', 'probability')) + PATIENT_COLUMNS + (('patient_timeline_id', 'patient_timeline_id'),)
+    + prefixed('patient_timeline', VISIT_COLUMNS) + (('public_timeline_id', 'public_timeline_id'),)
+    + prefixed('public_timeline', VISIT_COLUMNS + PUBLIC_COLUMNS) + (('created', 'created'),),
+    (('activities', PotentialContact, 'id'), ('patient_timeline_activities', PatientTimeline, 'patient_timeline_id'),
+     ('public_timeline_activities', PublicTimeline, 'public_timeline_id')),
+    OrderedDict([('patient', ('patient_id', int)), ('date_from', ('public_timeline__date__gte', parse_date)),
+                 ('date_to', ('public_timeline__date__lte', parse_date)), ('state', ('public_timeline__state', str)),
+                 ('country', ('public_timeline__country', str)), ('min_probability', ('probability__gte', float))]))
+
+# the columns of patient timeline imports, see app.ingestion
+PATIENT_TIMELINES = Export(
+    'patient_timelines',
+    (('id', 'id'),) + PATIENT_COLUMNS + VISIT_COLUMNS + (('created', 'created'),),
+    (('activities', PatientTimeline, 'id'),),
+    OrderedDict([('patient', ('patient_id', int)), ('date_from', ('date__gte', parse_date)),
+                 ('date_to', ('date__lte', parse_date)), ('state', ('state', str)), ('country', ('country', str))]))
+
+
+def exported(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value
+
+
+def csv_chunks(headers, chunks):
+    """Yields the CSV of each chunk of records, after a header line."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(headers)
+    for records in chunks:
+        for record in records:
+            writer.writerow([','.join(value) if isinstance(value, list) else value for value in record.values()])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def ndjson_chunks(chunks):
+    """Yields the NDJSON of each chunk of records, a JSON object per line."""
+    for records in chunks:
+        yield ''.join(json.dumps(record) + '\n' for record in records)
+
+
+def export_response(export, queryset, file_format, chunk_size=2000):
+    """Streams the rows of queryset exported as file_format, one of EXPORT_FORMATS, as a file attachment."""
+    chunks = export.records(queryset, chunk_size)
+    if file_format == 'csv':
+        content = csv_chunks(export.headers, chunks)
+    else:
+        content = ndjson_chunks(chunks)
+    response = StreamingHttpResponse(content, content_type=EXPORT_FORMATS[file_format])
+    response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (export.name, file_format)
+    return response
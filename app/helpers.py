@@ -1,9 +1,12 @@
 import json
+import math
 import os
-import string
+import re
 import random
 
-from app.models import Patient
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
 
 
 def is_number(s):
@@ -59,40 +62,179 @@ def random_illustration():
     return str(random.randint(1, 22)) + '.png'
 
 
-def generate_covid_id(size=8):
-    chars = string.digits
-    exist = True
-    generated_id = ''
-    while exist:
-        generated_id = 'COVID-' + ''.join(random.choice(chars) for _ in range(size))
-        obj_exists = Patient.objects.filter(covid_id=generated_id).exists()
-        if not obj_exists:
-            break
-    return generated_id
+MINUTES_PER_DAY = 24 * 60
+
+TIME_RANGE_PATTERN = re.compile(r'^\s*(\d{1,2})(?::?(\d{2}))?\s*-\s*(\d{1,2})(?::?(\d{2}))?\s*(?:hrs?)?\s*$', re.IGNORECASE)
+
+
+def parse_time_range(time_range):
+    """ Parses a time range into its start and end minute of the day.
+    8-9 - 08:00 to 09:00, as sent by the frontend
+    08:30 - 10:00 Hrs - 08:30 to 10:00
+    23-1 - 23:00 to 01:00 the next day, the end is past 1440
+    Returns (None, None) when the time range can't be parsed, or isn't a string.
+    """
+    if not isinstance(time_range, str):
+        return None, None
+    match = TIME_RANGE_PATTERN.match(time_range)
+    if not match:
+        return None, None
+    start_hour, start_minute, end_hour, end_minute = (int(group or 0) for group in match.groups())
+    if start_hour > 24 or end_hour > 24 or start_minute > 59 or end_minute > 59:
+        return None, None
+    start = (start_hour * 60 + start_minute) % MINUTES_PER_DAY
+    end = (end_hour * 60 + end_minute) % MINUTES_PER_DAY
+    if start == end:
+        return None, None
+    if end < start:
+        end += MINUTES_PER_DAY
+    return start, end
+
+
+# Weight each matched key adds to the chance of contact, applied in this order.
+CONTACT_WEIGHTS = (
+    ('country', 16.6),
+    ('state', 16.7),
+    ('location', 16.7),  # scaled by how close the places are, see `proximity_degree`
+    ('date', 16.6),  # scaled by how close the dates are, see `date_degree`
+    ('time_range', 16.7),  # scaled by how much the time ranges overlap
+    ('activity', 16.6),  # removed 0.1 from this to get a 99.9% probability
+    ('other_activity', 12.5),
+)
 
 
 def contact_chance(matched):
     """ This function calculates the chances of contact based on matched keys
-
+    matched is either a collection of matched keys, or a dict mapping each matched
+    key to how much it matched, from 0 to 1 (e.g. the overlap of two time ranges).
     """
+    if not isinstance(matched, dict):
+        matched = dict.fromkeys(matched, 1)
+    if 'place_id' in matched:
+        matched = dict(matched, location=max(matched['place_id'], matched.get('location', 0)))
     probability = 0
-    if 'country' in matched:
-        probability += 16.6
-    if 'state' in matched:
-        probability += 16.7
-    if 'location' in matched or 'place_id' in matched:
-        probability += 16.7
-    if 'date' in matched:
-        probability += 16.6  # TODO: handle date_before and date_after situations
-    if 'time_range' in matched:
-        probability += 16.7  # TODO: handle time_range_before and time_range_after situations
-    if 'activity' in matched:
-        probability += 16.6  # removed 0.1 from this to get a 99.9% probability
-    if 'other_activity' in matched:
-        probability += 12.5
+    for key, weight in CONTACT_WEIGHTS:
+        if key in matched:
+            probability += weight * matched[key]
     return probability
 
 
+def date_degree(days_apart, window):
+    """ How much two dates days_apart match within a window of days.
+    1 on the same day, decreasing linearly to 1 / (window + 1) window days apart, 0 beyond.
+    """
+    days_apart = abs(days_apart)
+    if days_apart > window:
+        return 0
+    return 1 - days_apart / (window + 1)
+
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+GEOHASH_PRECISION = 9  # characters of the geohash stored on locations, cells of about 5 by 5 meters
+EARTH_RADIUS = 6371000  # meters
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS / 180  # of latitude, and of longitude at the equator
+
+
+def encode_geohash(latitude, longitude, precision=GEOHASH_PRECISION):
+    """ Returns the geohash of a point, its cell in a grid that halves in turn along longitude
+    and latitude, 5 halvings to a base32 character.
+    Points sharing a prefix are in the same, larger, cell.
+    """
+    bounds = [[-90.0, 90.0], [-180.0, 180.0]]
+    point = (latitude, longitude)
+    geohash = ''
+    bits = 0
+    for bit in range(5 * precision):
+        axis = 1 - bit % 2  # longitude first
+        middle = sum(bounds[axis]) / 2
+        bits <<= 1
+        if point[axis] >= middle:
+            bits |= 1
+            bounds[axis][0] = middle
+        else:
+            bounds[axis][1] = middle
+        if bit % 5 == 4:
+            geohash += GEOHASH_ALPHABET[bits]
+            bits = 0
+    return geohash
+
+
+def geohash_cell_size(precision):
+    """Returns the height and width, in degrees, of the geohash cells of precision characters."""
+    bits = 5 * precision
+    return 180 / 2 ** (bits // 2), 360 / 2 ** ((bits + 1) // 2)
+
+
+def geohash_neighbourhood(latitude, longitude, radius):
+    """ Returns geohash prefixes covering every point within radius meters of a point.
+    They are the cell of the point and its 8 neighbours, at the finest precision with cells at least
+    radius meters high and wide, so nothing within radius is more than one cell away.
+    """
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        height, width = geohash_cell_size(precision)
+        narrowest = math.cos(math.radians(min(90, abs(latitude) + height)))  # cells narrow towards the poles
+        if height * METERS_PER_DEGREE >= radius and width * METERS_PER_DEGREE * narrowest >= radius:
+            break
+    else:
+        return {''}
+    cells = set()
+    for rows in (-1, 0, 1):
+        for columns in (-1, 0, 1):
+            cells.add(encode_geohash(max(-90, min(90, latitude + rows * height)),
+                                     (longitude + columns * width + 180) % 360 - 180, precision))
+    return cells
+
+
+def distance(latitude, longitude, other_latitude, other_longitude):
+    """Great-circle distance between two points, in meters."""
+    latitude, other_latitude = math.radians(latitude), math.radians(other_latitude)
+    haversine = (math.sin((other_latitude - latitude) / 2) ** 2 + math.cos(latitude) * math.cos(other_latitude)
+                 * math.sin(math.radians(other_longitude - longitude) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(min(1, math.sqrt(haversine)))
+
+
+def proximity_degree(meters, radius):
+    """ How much two places meters apart match as the same location.
+    1 at the same spot, decreasing linearly to 0 radius meters away.
+    """
+    if meters >= radius:
+        return 0
+    return 1 - meters / radius
+
+
+def activity_bitset(codes):
+    """Returns the little-endian bitset, as bytes, with bit `code` set for each of codes."""
+    bits = 0
+    for code in codes:
+        bits |= 1 << code
+    return bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+
+
+def chunked(values, size):
+    """Yields successive lists of at most size values."""
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def add_or_create(model, lookup, using='default', **amounts):
+    """ Adds amounts to the fields of the row of model matching lookup, creating it with them when there is none.
+
+    The amounts are added with one UPDATE of F() expressions, so concurrent additions all count, and the row is
+    created in a savepoint, so when another process creates it first the amounts are added to that one instead.
+    """
+    rows = model.objects.using(using).filter(**lookup)
+    changes = dict({field: F(field) + amount for field, amount in amounts.items()}, updated=timezone.now())
+    if rows.update(**changes):
+        return
+    try:
+        with transaction.atomic(using=using):
+            model.objects.using(using).create(**lookup, **amounts)
+    except IntegrityError:
+        # created at the same time by another process
+        rows.update(**changes)
+
+
 def error_msg(msg):
     """Returns a dictionary mapping error to msg."""
     return {'status': "failed", 'message': msg}
@@ -0,0 +1,413 @@
+"""Batch ingestion of timelines.
+
+A batch is written in one transaction. Its locations and activities are
+resolved by set through app.interning and its patients looked up by set, the
+missing locations and the timelines are inserted in bulk along with their
+activity rows, and the activity bitsets, visited locations, dashboard
+summaries and data versions app.signals keeps for single saves are set
+directly. `import_timelines` feeds files of any size through in chunks, files
+uploaded to the import endpoint are stored and imported by a job.
+"""
+import csv
+import datetime
+import gzip
+import io
+import itertools
+import json
+import shutil
+from collections import Counter
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+
+from app.caching import LOCATION_DETAILS_VERSION, bump_data_versions, cached_trace, country_version, \
+    public_timelines_version
+from app.helpers import activity_bitset, chunked, parse_time_range
+from app.interning import find_locations, intern_activities, intern_locations, record_coordinates
+from app.jobs import enqueue, job_handler
+from app.models import Location, Patient, PatientTimeline, PublicTimeline, TimelineImport
+from app.signals import update_activity_bits, update_visited_locations, visit_of
+from app.summaries import creator_country, public_timeline_changes, update_country_summaries
+
+VISIT_FIELDS = ('time_range', 'state', 'country')
+PUBLIC_FIELDS = ('address', 'email', 'phone_number')
+IMPORT_FORMATS = ('csv', 'ndjson')
+
+
+class InvalidTimeline(ValueError):
+    pass
+
+
+def parse_activity_names(activities):
+    """Activity names of a comma separated string, or a list, lowercased like the timeline endpoints do."""
+    if not activities:
+        return []
+    if isinstance(activities, str):
+        activities = activities.split(',')
+    return [str(name).lower() for name in activities if name]
+
+
+def value(item, field):
+    """The field of a received timeline, None when it is missing or empty, as CSV cells are."""
+    field_value = item.get(field)
+    return None if field_value == '' else field_value
+
+
+def text(item, field):
+    """Like `value`, raises InvalidTimeline when the field isn't a string, as JSON rows can send anything."""
+    field_value = value(item, field)
+    if field_value is not None and not isinstance(field_value, str):
+        raise InvalidTimeline("%s must be a string." % field)
+    return field_value
+
+
+def parse_activity_list(item, field):
+    """Activity names of the field of a received timeline, raises InvalidTimeline when it isn't a string or list."""
+    activities = value(item, field)
+    if activities is not None and not isinstance(activities, (str, list)):
+        raise InvalidTimeline("%s must be a string or a list." % field)
+    return parse_activity_names(activities)
+
+
+def parse_visit(item):
+    """Reads the fields every timeline has, raises InvalidTimeline when they aren't valid."""
+    if isinstance(item, InvalidTimeline):
+        raise item
+    if not isinstance(item, dict):
+        raise InvalidTimeline("Expected a timeline object.")
+    try:
+        date = datetime.datetime.strptime(str(item.get('date')), "%Y-%m-%d").date()  # e.g. 2010-05-24
+    except ValueError:
+        raise InvalidTimeline("Invalid date, expected YYYY-MM-DD.")
+    location, place_id = text(item, 'location'), text(item, 'place_id')
+    if not location or not place_id:
+        raise InvalidTimeline("Location and place_id are required.")
+    return {
+        'location': (location, place_id),
+        'coordinates': Location.parse_coordinates(item.get('latitude'), item.get('longitude')),
+        'activities': parse_activity_list(item, 'activities'),
+        'other_activities': [],
+        'fields': dict({field: text(item, field) for field in VISIT_FIELDS}, date=date),
+    }
+
+
+def parse_public_timeline(item):
+    """Reads a timeline as the public timelines endpoint receives it, raises InvalidTimeline when it can't."""
+    timeline = parse_visit(item)
+    timeline['fields'].update({field: text(item, field) for field in PUBLIC_FIELDS})
+    return timeline
+
+
+def parse_patient_timeline(item):
+    """ Reads a patient timeline as the patient timelines endpoint receives it, along with its patient.
+
+    The patient is either patient_id or a covid_id, a new patient is created for an unknown covid_id with
+    the full_name and nationality of the row.
+    """
+    timeline = parse_visit(item)
+    timeline['other_activities'] = parse_activity_list(item, 'other_activities')
+    patient_id, covid_id = value(item, 'patient_id'), value(item, 'covid_id')
+    if patient_id is not None:
+        try:
+            timeline['patient'] = ('id', int(patient_id))
+        except (TypeError, ValueError):
+            raise InvalidTimeline("Invalid patient_id.")
+    elif covid_id is not None:
+        if isinstance(covid_id, bool) or not isinstance(covid_id, (str, int)):
+            raise InvalidTimeline("Invalid covid_id.")
+        timeline['patient'] = ('covid_id', str(covid_id))
+        timeline['new_patient'] = {'full_name': text(item, 'full_name'),
+                                   'nationality': text(item, 'nationality') or '',
+                                   'state': timeline['fields']['state'] or ''}
+    else:
+        raise InvalidTimeline("patient_id or covid_id is required.")
+    return timeline
+
+
+def insert_all(model, objs):
+    """ Inserts objs and sets their primary keys.
+    Only PostgreSQL returns the keys of a bulk insert, elsewhere each object is inserted on its own.
+    """
+    if connection.features.can_return_ids_from_bulk_insert:
+        return model.objects.bulk_create(objs, batch_size=500)
+    for obj in objs:
+        obj.save(force_insert=True)
+    return objs
+
+
+def resolve_locations(timelines, move=False):
+    """ Maps the (name, place_id) of every parsed timeline to its location, inserting the missing ones.
+
+    Coordinates sent along are recorded with `Location.set_coordinates`, the last ones of a location win.
+    """
+    coordinates = {timeline['location']: timeline['coordinates'] for timeline in timelines
+                   if timeline['coordinates'] is not None}
+    keys = {timeline['location'] for timeline in timelines}
+    locations = find_locations(keys)
+    missing = []
+    for name, place_id in keys - set(locations):
+        location = Location(name=name, place_id=place_id)
+        location.latitude, location.longitude = coordinates.get((name, place_id), (None, None))
+        location.set_geohash()
+        missing.append(location)
+    if missing:
+        try:
+            with transaction.atomic():
+                Location.objects.bulk_create(missing, batch_size=500)
+        except IntegrityError:
+            # some were inserted at the same time by another process, the rest are created one by one
+            pass
+        locations.update(intern_locations(keys - set(locations)))
+    for key, (latitude, longitude) in coordinates.items():
+        record_coordinates(locations[key], latitude, longitude, move)
+    return locations
+
+
+def add_location_activities(pairs):
+    """Adds the (location_id, activity_id) pairs that aren't there yet and updates the locations' activity bits."""
+    through = Location.activities.through
+    location_ids = {location_id for location_id, _ in pairs}
+    existing = set()
+    for chunk in chunked(location_ids, 500):
+        existing.update(through.objects.filter(location_id__in=chunk).values_list('location_id', 'activity_id'))
+    missing = pairs - existing
+    if missing:
+        through.objects.bulk_create([through(location_id=location_id, activity_id=activity_id)
+                                     for location_id, activity_id in missing], batch_size=500)
+        update_activity_bits(Location, {location_id for location_id, _ in missing})
+        bump_data_versions(LOCATION_DETAILS_VERSION)
+
+
+def resolve_patients(timelines, creator):
+    """ Maps the patient of each parsed patient timeline to the creator's patient.
+
+    Patients of covid ids the creator has none for are inserted, patient ids of other creators are left out.
+    """
+    keys = {timeline['patient'] for timeline in timelines}
+    patients = {}
+    for chunk in chunked([pk for kind, pk in keys if kind == 'id'], 500):
+        for patient in Patient.objects.filter(creator=creator, pk__in=chunk):
+            patients['id', patient.pk] = patient
+
+    def find(covid_ids):
+        for chunk in chunked(covid_ids, 500):
+            for patient in Patient.objects.filter(creator=creator, covid_id__in=chunk).order_by('id'):
+                patients.setdefault(('covid_id', patient.covid_id), patient)
+
+    find([covid_id for kind, covid_id in keys if kind == 'covid_id'])
+    new_patients = {}
+    for timeline in timelines:
+        kind, covid_id = timeline['patient']
+        if kind == 'covid_id' and timeline['patient'] not in patients:
+            new_patients.setdefault(covid_id, timeline['new_patient'])
+    if new_patients:
+        Patient.objects.bulk_create([Patient(covid_id=covid_id, creator=creator, **fields)
+                                     for covid_id, fields in new_patients.items()], batch_size=500)
+        update_country_summaries({creator_country(creator.pk): {'patients': len(new_patients)}})
+        find(new_patients)
+    return patients
+
+
+def build_timeline(model, timeline, locations, activities, **fields):
+    """An unsaved timeline of model for a parsed timeline, with the fields save() and app.signals would set."""
+    instance = model(location=locations[timeline['location']], **timeline['fields'], **fields)
+    instance.time_start, instance.time_end = parse_time_range(instance.time_range)
+    instance.activity_bits = activity_bitset(activities[name].code for name in timeline['activities'])
+    return instance
+
+
+def insert_timelines(model, instances, timelines, activities):
+    """ Inserts the timelines built for the parsed timelines, then their activities.
+
+    Their locations get the activities and other activities of the timelines, as when they are posted one by one.
+    """
+    insert_all(model, instances)
+    through = model.activities.through
+    owner = model._meta.model_name + '_id'
+    timeline_activities = set()
+    location_activities = set()
+    for instance, timeline in zip(instances, timelines):
+        for name in timeline['activities']:
+            timeline_activities.add((instance.pk, activities[name].pk))
+        for name in timeline['activities'] + timeline['other_activities']:
+            location_activities.add((instance.location_id, activities[name].pk))
+    through.objects.bulk_create([through(**{owner: timeline_id, 'activity_id': activity_id})
+                                 for timeline_id, activity_id in timeline_activities], batch_size=500)
+    add_location_activities(location_activities)
+
+
+def parse_all(items, parse):
+    """Parses every item, returns the parsed (index, timeline) pairs and a failed result per invalid item."""
+    results = [None] * len(items)
+    parsed = []
+    for index, item in enumerate(items):
+        try:
+            parsed.append((index, parse(item)))
+        except InvalidTimeline as e:
+            results[index] = {'index': index, 'status': 'failed', 'message': str(e)}
+    return parsed, results
+
+
+def activity_names_of(timelines):
+    return {name for timeline in timelines for name in timeline['activities'] + timeline['other_activities']}
+
+
+def ingest_public_timelines(items, creator=None, trace=False):
+    """ Creates the public timelines of a batch in one transaction.
+
+    Returns a result per item, in order: {'index', 'status': 'created', 'id'} and, with trace, the
+    trace response of the timeline under 'trace', or {'index', 'status': 'failed', 'message'} for an
+    item that isn't a valid timeline. Timelines are traced once committed, one by one, as the trace
+    endpoint traces them, scoring only the candidates of each.
+    """
+    parsed, results = parse_all(items, parse_public_timeline)
+    with transaction.atomic():
+        timelines = [timeline for _, timeline in parsed]
+        locations = resolve_locations(timelines)
+        activities = intern_activities(activity_names_of(timelines), creator)
+        public_timelines = [build_timeline(PublicTimeline, timeline, locations, activities) for timeline in timelines]
+        insert_timelines(PublicTimeline, public_timelines, timelines, activities)
+        # as app.signals does for a single save, which the activity rows bypass
+        bump_data_versions(public_timelines_version(), *{public_timelines_version(public_timeline.country)
+                                                         for public_timeline in public_timelines})
+        if connection.features.can_return_ids_from_bulk_insert:
+            # timelines inserted one by one were counted by app.signals
+            update_country_summaries(public_timeline_changes(
+                public_timeline.country for public_timeline in public_timelines))
+
+        for (index, _), public_timeline in zip(parsed, public_timelines):
+            results[index] = {'index': index, 'status': 'created', 'id': public_timeline.pk}
+    if trace:
+        for (index, _), public_timeline in zip(parsed, public_timelines):
+            response = cached_trace(public_timeline)
+            results[index]['trace'] = dict(response, matched_activities=sorted(response['matched_activities']))
+    return results
+
+
+def ingest_patient_timelines(items, creator):
+    """ Creates the patient timelines of a batch in one transaction, for patients of creator.
+
+    Returns a result per item like `ingest_public_timelines`, and the job reverse tracing the created
+    timelines, queued once for the whole batch, or None when none was created.
+    """
+    parsed, results = parse_all(items, parse_patient_timeline)
+    with transaction.atomic():
+        patients = resolve_patients([timeline for _, timeline in parsed], creator)
+        for index, timeline in parsed:
+            if timeline['patient'] not in patients:
+                results[index] = {'index': index, 'status': 'failed', 'message': "Patient not found."}
+        parsed = [(index, timeline) for index, timeline in parsed if timeline['patient'] in patients]
+        timelines = [timeline for _, timeline in parsed]
+        locations = resolve_locations(timelines, move=True)
+        activities = intern_activities(activity_names_of(timelines), creator)
+        patient_timelines = [build_timeline(PatientTimeline, timeline, locations, activities, creator=creator,
+                                            patient=patients[timeline['patient']]) for timeline in timelines]
+        insert_timelines(PatientTimeline, patient_timelines, timelines, activities)
+        # cached traces of these countries are stale, as app.signals marks them for a single save
+        bump_data_versions(*{country_version(patient_timeline.country) for patient_timeline in patient_timelines})
+        if connection.features.can_return_ids_from_bulk_insert:
+            # timelines inserted one by one were counted by app.signals
+            update_visited_locations(Counter(map(visit_of, patient_timelines)))
+
+        for (index, _), patient_timeline in zip(parsed, patient_timelines):
+            results[index] = {'index': index, 'status': 'created', 'id': patient_timeline.pk}
+        job = None
+        if patient_timelines:
+            job = enqueue('reverse_trace_batch', creator=creator,
+                          patient_timeline_ids=[patient_timeline.pk for patient_timeline in patient_timelines])
+    return results, job
+
+
+def import_format(name):
+    """The format of a file to import by its name: ndjson for .ndjson and .jsonl files, csv otherwise."""
+    return 'ndjson' if name.lower().endswith(('.ndjson', '.jsonl')) else 'csv'
+
+
+def text_stream(binary):
+    """Reads a binary file as text, as CSV files are read, without failing on invalid UTF-8."""
+    return io.TextIOWrapper(binary, encoding='utf-8-sig', errors='replace', newline='')
+
+
+def read_rows(stream, format):
+    """ Yields the (line, row) of each row of a CSV with a header line, or of NDJSON, read from a text stream.
+
+    An NDJSON line that isn't valid JSON is yielded as an InvalidTimeline, to be reported with the row.
+    """
+    if format == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except ValueError:
+            yield line_number, InvalidTimeline("Invalid JSON.")
+
+
+def import_timelines(rows, creator, chunk_size=1000, on_error=None, on_chunk=None, summary=None):
+    """ Imports the patient timelines of (line, row) pairs, such as `read_rows` yields, chunk by chunk.
+
+    Only a chunk of rows is held at a time, and each is written in its own transaction, so a file of any
+    size imports in bounded memory. Invalid rows are passed to on_error(line, message) and skipped, and
+    on_chunk(summary, line), with the last line of the chunk, is called in the chunk's transaction.
+    Returns the summary, continued from summary when given: the numbers of rows imported and failed, and
+    the ids of the reverse trace jobs, one per chunk.
+    """
+    summary = summary or {'imported': 0, 'failed': 0, 'jobs': []}
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            return summary
+        with transaction.atomic():
+            results, job = ingest_patient_timelines([row for _, row in chunk], creator)
+            for (line, _), result in zip(chunk, results):
+                if result['status'] == 'created':
+                    summary['imported'] += 1
+                else:
+                    summary['failed'] += 1
+                    if on_error is not None:
+                        on_error(line, result['message'])
+            if job is not None:
+                summary['jobs'].append(job.pk)
+            if on_chunk is not None:
+                on_chunk(summary, chunk[-1][0])
+
+
+def queue_import(upload, file_format, creator):
+    """ Stores an uploaded file of patient timelines of creator and queues the job importing it.
+
+    Returns the job, whose result is the summary of `import_timelines` with the first
+    IMPORT_MAX_REPORTED_ERRORS invalid rows under 'errors'.
+    """
+    data = io.BytesIO()
+    with gzip.GzipFile(fileobj=data, mode='wb') as compressed:
+        shutil.copyfileobj(upload, compressed)
+    with transaction.atomic():
+        timeline_import = TimelineImport.objects.create(creator=creator, format=file_format, data=data.getvalue())
+        return enqueue('import_patient_timelines', creator=creator, import_id=timeline_import.pk)
+
+
+@job_handler('import_patient_timelines', message='Import complete.')
+def import_patient_timelines_job(import_id):
+    timeline_import = TimelineImport.objects.select_related('creator').get(pk=import_id)
+    summary = json.loads(timeline_import.summary) or {'imported': 0, 'failed': 0, 'jobs': [], 'errors': []}
+
+    def report(line, message):
+        if len(summary['errors']) < settings.IMPORT_MAX_REPORTED_ERRORS:
+            summary['errors'].append({'line': line, 'message': message})
+
+    def checkpoint(summary, line):
+        timeline_import.line, timeline_import.summary = line, json.dumps(summary)
+        timeline_import.save(update_fields=['line', 'summary', 'updated'])
+
+    # a retried job resumes after the last chunk imported
+    with text_stream(gzip.GzipFile(fileobj=io.BytesIO(bytes(timeline_import.data)))) as stream:
+        rows = ((line, row) for line, row in read_rows(stream, timeline_import.format) if line > timeline_import.line)
+        import_timelines(rows, timeline_import.creator, chunk_size=settings.IMPORT_CHUNK_SIZE, on_error=report,
+                         on_chunk=checkpoint, summary=summary)
+    timeline_import.delete()
+    return summary
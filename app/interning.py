@@ -0,0 +1,216 @@
+"""Interning of activities and locations.
+
+Every timeline names its activities and its location, which the write paths
+used to look up, and create when missing, one query each. Each process keeps
+the rows it resolved in bounded LRU caches instead, keyed by activity name and
+by location (name, place_id), so known names cost no query.
+
+Creation is race safe: the unique constraints on those keys make the insert of
+a row created at the same time by another process fail, and that row is looked
+up instead. Rows are only cached once the transaction that read them commits,
+so a rolled back insert is never cached. Renaming or deleting an activity or a
+location bumps its data version (app.signals), and every process clears its
+cache when it next checks the versions, at most INTERNING['CHECK_INTERVAL']
+seconds later.
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from app.caching import ACTIVITIES_VERSION, LOCATIONS_VERSION, LRUCache, data_versions
+from app.helpers import chunked
+from app.models import Activity, Location
+
+logger = logging.getLogger(__name__)
+
+
+class Interner:
+    """ Resolves the rows of model by the unique key_fields, caching their fields in the process.
+
+    Instances are built from the cached fields, the other fields are deferred.
+    """
+
+    def __init__(self, model, key_fields, fields, version_key, max_size):
+        self.model = model
+        self.key_fields = key_fields
+        # Model.from_db takes the values in the order of the model's fields
+        self.fields = [field.attname for field in model._meta.concrete_fields
+                       if field.attname == 'id' or field.attname in fields]
+        self.version_key = version_key
+        self.version = None
+        self.cache = LRUCache(max_size)
+
+    def key(self, instance):
+        return tuple(getattr(instance, field) for field in self.key_fields)
+
+    def instance(self, values):
+        return self.model.from_db(self.model.objects.db, self.fields, values)
+
+    def remember(self, instance):
+        """Caches the fields of instance once the current transaction commits, unless the cache was cleared since."""
+        key, values = self.key(instance), tuple(getattr(instance, field) for field in self.fields)
+        version = self.version
+
+        def cache():
+            if self.version == version:
+                self.cache.set(key, values)
+        transaction.on_commit(cache)
+
+    def find(self, keys):
+        """Maps each of keys to the row stored with it, one query per 500 keys."""
+        instances = {}
+        for chunk in chunked(keys, 500):
+            keys_of_chunk = set(chunk)
+            lookup = {field + '__in': {key[index] for key in chunk} for index, field in enumerate(self.key_fields)}
+            for values in self.model.objects.filter(**lookup).order_by('id').values_list(*self.fields):
+                instance = self.instance(values)
+                key = self.key(instance)
+                if key in keys_of_chunk and key not in instances:
+                    instances[key] = instance
+                    self.remember(instance)
+        return instances
+
+    def get_many(self, keys):
+        """Maps each of keys to its row, when there is one, looking up only the keys that aren't cached."""
+        instances = {}
+        missing = []
+        for key in set(keys):
+            values = self.cache.get(key)
+            if values is None:
+                missing.append(key)
+            else:
+                instances[key] = self.instance(values)
+        instances.update(self.find(missing))
+        count_lookups(len(instances) + len(missing))
+        return instances
+
+    def create(self, key, **fields):
+        """Creates the row of key, or returns the one created at the same time by another process."""
+        try:
+            with transaction.atomic():
+                instance = self.model.objects.create(**dict(zip(self.key_fields, key)), **fields)
+        except IntegrityError:
+            instance = self.find([key]).get(key)
+            if instance is None:
+                raise
+            return instance
+        self.remember(instance)
+        return instance
+
+    def resolve(self, keys, **fields):
+        """Maps each of keys to its row, creating the missing rows with fields, in the order of their keys."""
+        instances = self.get_many(keys)
+        for key in sorted(set(keys) - set(instances), key=str):
+            instances[key] = self.create(key, **fields)
+        return instances
+
+    def stats(self):
+        stats = self.cache.stats()
+        lookups = stats['hits'] + stats['misses']
+        return dict(stats, hit_rate=stats['hits'] / lookups if lookups else None)
+
+
+_interners = None
+_lock = threading.Lock()
+_checked = None
+_lookups = 0
+
+
+def get_interners():
+    """Returns the activity and location interners, created on first use from the INTERNING setting."""
+    global _interners
+    with _lock:
+        if _interners is None:
+            _interners = (
+                Interner(Activity, ('name',), ('name', 'code'), ACTIVITIES_VERSION,
+                         settings.INTERNING['ACTIVITIES_MAX_SIZE']),
+                Interner(Location, ('name', 'place_id'),
+                         ('name', 'place_id', 'latitude', 'longitude', 'geohash', 'creator_id', 'created'),
+                         LOCATIONS_VERSION, settings.INTERNING['LOCATIONS_MAX_SIZE']),
+            )
+        return _interners
+
+
+def check_versions():
+    """Clears the caches of the interners whose data version changed, checked at most every CHECK_INTERVAL."""
+    global _checked
+    now = time.monotonic()
+    if _checked is not None and now - _checked < settings.INTERNING['CHECK_INTERVAL']:
+        return
+    _checked = now
+    interners = get_interners()
+    for interner, version in zip(interners, data_versions(*[interner.version_key for interner in interners])):
+        if interner.version is not None and interner.version != version:
+            interner.cache.clear()
+        interner.version = version
+
+
+def check_versions_soon():
+    """Makes the next lookup check the data versions, app.signals calls it after bumping them."""
+    global _checked
+    _checked = None
+
+
+def count_lookups(count):
+    global _lookups
+    report_every = settings.INTERNING['REPORT_EVERY']
+    _lookups += count
+    if report_every and _lookups >= report_every:
+        _lookups = 0
+        logger.info('Interning hit rates: %s', interning_stats())
+
+
+def interning_stats():
+    """Hits, misses, size and hit rate of the activity and location caches of this process."""
+    activities, locations = get_interners()
+    return {'activities': activities.stats(), 'locations': locations.stats()}
+
+
+def reset_interning():
+    """Drops the interners, so the next lookup creates them again from the settings."""
+    global _interners, _checked
+    with _lock:
+        _interners = None
+        _checked = None
+
+
+def intern_activities(names, creator=None):
+    """Maps each activity name to its activity, creating the missing ones with creator."""
+    check_versions()
+    activities, _ = get_interners()
+    return {key[0]: activity for key, activity in activities.resolve([(name,) for name in names],
+                                                                     creator=creator).items()}
+
+
+def find_locations(keys):
+    """Maps each (name, place_id) of keys to its location, leaving out the missing ones."""
+    check_versions()
+    _, locations = get_interners()
+    return locations.get_many(keys)
+
+
+def intern_locations(keys):
+    """Maps each (name, place_id) of keys to its location, creating the missing ones."""
+    check_versions()
+    _, locations = get_interners()
+    return locations.resolve(keys)
+
+
+def intern_location(name, place_id, latitude=None, longitude=None, move=False):
+    """ The location of name and place_id, created when missing, and the replacement of
+    `Location.objects.get_or_create`. The coordinates are recorded with `Location.set_coordinates`.
+    """
+    location = intern_locations([(name, place_id)])[name, place_id]
+    record_coordinates(location, latitude, longitude, move)
+    return location
+
+
+def record_coordinates(location, latitude, longitude, move=False):
+    """`Location.set_coordinates`, caching the new coordinates when they changed."""
+    coordinates = (location.latitude, location.longitude)
+    location.set_coordinates(latitude, longitude, move)
+    if (location.latitude, location.longitude) != coordinates:
+        get_interners()[1].remember(location)
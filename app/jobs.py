@@ -0,0 +1,139 @@
+"""Background jobs stored in the database.
+
+A job is claimed with a conditional UPDATE of its status, so any number of
+`manage.py run_jobs` processes can share the table without an external broker.
+Failed jobs are retried with exponential backoff, up to their max_attempts,
+except for jobs that can't succeed: those of an unknown kind, and those whose
+rows were deleted before they ran. A job left running by a worker that died
+is queued again after JOB_TIMEOUT, or failed once it used up its attempts.
+Done and failed jobs are deleted by the workers JOB_RETENTION after they
+finished. Handlers are registered by the modules defining them, app.jobs for
+traces and app.ingestion for imports, both loaded with the app.
+
+A job is only shown to the user who queued it. Jobs queued anonymously are
+shown to anyone when their kind is public, as traces of public timelines are.
+"""
+import datetime
+import json
+import logging
+import traceback
+
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import F
+from django.utils import timezone
+
+from app.caching import cached_trace
+from app.models import Job, PublicTimeline, TimelineImport
+from app.tracing import reverse_trace, reverse_trace_many
+
+logger = logging.getLogger(__name__)
+
+# kind -> (handler, message of the response once the job is done)
+HANDLERS = {}
+# kinds of the jobs anyone may read when they were queued anonymously
+PUBLIC_KINDS = set()
+
+
+class UnknownJob(Exception):
+    pass
+
+
+# failures retrying doesn't help
+PERMANENT_ERRORS = (UnknownJob, ObjectDoesNotExist)
+
+
+def job_handler(kind, message='Job complete.', public=False):
+    """Registers the decorated function as the handler of jobs of this kind."""
+    def register(function):
+        HANDLERS[kind] = (function, message)
+        if public:
+            PUBLIC_KINDS.add(kind)
+        return function
+    return register
+
+
+def enqueue(kind, creator=None, **payload):
+    """Queues a job for creator, None for anonymous requests, committed along with the current transaction."""
+    return Job.objects.create(kind=kind, payload=json.dumps(payload), max_attempts=settings.JOB_MAX_ATTEMPTS,
+                              creator=creator)
+
+
+def claim_job(worker):
+    """Marks the next due job as running for worker and returns it, or returns None when there is none."""
+    now = timezone.now()
+    abandoned = Job.objects.filter(status=Job.RUNNING,
+                                   updated__lt=now - datetime.timedelta(seconds=settings.JOB_TIMEOUT))
+    abandoned.filter(attempts__gte=F('max_attempts')).update(
+        status=Job.FAILED, error='Timed out on the last attempt.', updated=now)
+    abandoned.filter(attempts__lt=F('max_attempts')).update(status=Job.PENDING, updated=now)
+    due = Job.objects.filter(status=Job.PENDING, run_after__lte=now).order_by('run_after', 'id')
+    for job_id in due.values_list('id', flat=True)[:10]:
+        claimed = Job.objects.filter(pk=job_id, status=Job.PENDING).update(
+            status=Job.RUNNING, worker=worker, attempts=F('attempts') + 1, updated=now)
+        if claimed:
+            return Job.objects.get(pk=job_id)
+    return None
+
+
+def run_job(job):
+    """Runs a claimed job and records its result, or schedules a retry when it fails."""
+    try:
+        if job.kind not in HANDLERS:
+            raise UnknownJob("No handler for jobs of kind %r." % job.kind)
+        handler, _ = HANDLERS[job.kind]
+        result = handler(**json.loads(job.payload))
+    except Exception as e:
+        logger.exception('Job %s (%s) failed on attempt %s', job.pk, job.kind, job.attempts)
+        job.error = traceback.format_exc()
+        if job.attempts >= job.max_attempts or isinstance(e, PERMANENT_ERRORS):
+            job.status = Job.FAILED
+        else:
+            job.status = Job.PENDING
+            job.run_after = timezone.now() + datetime.timedelta(
+                seconds=settings.JOB_RETRY_DELAY * 2 ** (job.attempts - 1))
+    else:
+        job.status = Job.DONE
+        job.result = json.dumps(result)
+        job.error = None
+    job.save()
+    return job
+
+
+def purge_jobs():
+    """ Deletes the jobs that finished more than JOB_RETENTION ago, returns how many.
+
+    The files of imports untouched as long, whose job failed, go with them.
+    """
+    finished_before = timezone.now() - datetime.timedelta(seconds=settings.JOB_RETENTION)
+    TimelineImport.objects.filter(updated__lt=finished_before).delete()
+    deleted, _ = Job.objects.filter(status__in=(Job.DONE, Job.FAILED), updated__lt=finished_before).delete()
+    return deleted
+
+
+def can_read_job(user, job):
+    """Whether user may see the status and result of job."""
+    if job.creator_id is None:
+        return job.kind in PUBLIC_KINDS
+    return job.creator_id == user.pk
+
+
+def job_message(job):
+    return HANDLERS.get(job.kind, (None, 'Job complete.'))[1]
+
+
+@job_handler('trace_public_timeline', message='Trace complete.', public=True)
+def trace_public_timeline_job(public_timeline_id):
+    response = cached_trace(PublicTimeline.objects.get(pk=public_timeline_id))
+    response['matched_activities'] = sorted(response['matched_activities'])
+    return response
+
+
+@job_handler('reverse_trace', message='Reverse trace complete.')
+def reverse_trace_job(patient_timeline_id):
+    return {'possible_contacts': reverse_trace(patient_timeline_id)}
+
+
+@job_handler('reverse_trace_batch', message='Reverse trace complete.')
+def reverse_trace_batch_job(patient_timeline_ids):
+    return {'possible_contacts': reverse_trace_many(patient_timeline_ids)}
@@ -0,0 +1,113 @@
+import datetime
+import itertools
+import random
+import time
+import tracemalloc
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test.utils import override_settings
+from rest_framework.renderers import JSONRenderer
+
+from app.exports import POTENTIAL_CONTACTS, csv_chunks, ndjson_chunks
+from app.models import Activity, Location, Patient, PatientTimeline, PotentialContact, PublicTimeline
+from app.serializers import PotentialContactSerializer
+
+STATES = ['Lagos', 'Abuja', 'Kano', 'Rivers', 'Oyo', 'Kaduna', 'Enugu', 'Delta']
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Measures the peak memory of potential contact exports, against serializing the whole list, on ' \
+           'synthetic contacts created in a transaction that is rolled back.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10000,100000,1000000',
+                            help='Comma separated numbers of potential contacts to export.')
+        parser.add_argument('--serializer-max', type=int, default=10000,
+                            help='Largest number of contacts to also serialize as one list.')
+        parser.add_argument('--chunk-size', type=int, default=2000)
+        parser.add_argument('--seed', type=int, default=19)
+
+    def handle(self, *args, **options):
+        sizes = sorted(int(size) for size in options['sizes'].split(','))
+        try:
+            # with DEBUG on every query is kept in memory, production exports run without
+            with override_settings(DEBUG=False), transaction.atomic():
+                self.create_contacts(sizes[-1], random.Random(options['seed']))
+                contacts = PotentialContact.objects.order_by('id')
+                for size in sizes:
+                    queryset = PotentialContact.objects.filter(id__lte=contacts.values_list('id', flat=True)[size - 1])
+                    for file_format in ('csv', 'ndjson'):
+                        self.benchmark(size, file_format, lambda: self.export(queryset, file_format,
+                                                                                 options['chunk_size']))
+                    if size <= options['serializer_max']:
+                        self.benchmark(size, 'serializer', lambda: len(JSONRenderer().render(
+                            PotentialContactSerializer(PotentialContactSerializer.eager_load(queryset),
+                                                       many=True).data)))
+                raise Rollback
+        except Rollback:
+            pass
+
+    def create_contacts(self, size, rng):
+        """Creates at least size contacts, between each of about sqrt(size) patient and public timelines."""
+        user = User.objects.create_user(username='benchmark_exports')
+        activities = [Activity.objects.create(name='benchmark activity %d' % i) for i in range(20)]
+        Location.objects.bulk_create(Location(name='benchmark location %d' % i, place_id='benchmark %d' % i,
+                                              latitude=rng.uniform(4, 13), longitude=rng.uniform(3, 14))
+                                     for i in range(200))
+        locations = list(Location.objects.filter(place_id__startswith='benchmark '))
+        Patient.objects.bulk_create(Patient(full_name='Patient %d' % i, covid_id='COVID-%d' % i,
+                                            nationality='Nigerian', state=rng.choice(STATES), creator=user)
+                                    for i in range(100))
+        patients = list(Patient.objects.filter(creator=user))
+        side = int(size ** 0.5) + 1
+        first_day = datetime.date(2020, 3, 1)
+
+        def visit():
+            return {'location': rng.choice(locations), 'country': 'Nigeria', 'state': rng.choice(STATES),
+                    'date': first_day + datetime.timedelta(days=rng.randint(0, 30)), 'time_range': '8-9'}
+
+        PatientTimeline.objects.bulk_create(PatientTimeline(patient=rng.choice(patients), creator=user, **visit())
+                                            for _ in range(side))
+        PublicTimeline.objects.bulk_create(PublicTimeline(phone_number='080', **visit()) for _ in range(side))
+        patient_timelines = list(PatientTimeline.objects.filter(creator=user).values_list('id', 'patient_id'))
+        public_timeline_ids = list(PublicTimeline.objects.filter(location__in=locations).values_list('id', flat=True))
+        pairs = ((patient_timeline, public_timeline_id) for patient_timeline in patient_timelines
+                 for public_timeline_id in public_timeline_ids)
+        while True:
+            # bulk_create holds every object it is given, so a million are inserted a chunk at a time
+            chunk = list(itertools.islice(pairs, 5000))
+            if not chunk:
+                break
+            PotentialContact.objects.bulk_create(
+                PotentialContact(patient_timeline_id=patient_timeline_id, patient_id=patient_id,
+                                 public_timeline_id=public_timeline_id, probability=rng.random())
+                for (patient_timeline_id, patient_id), public_timeline_id in chunk)
+        for model, ids in ((PatientTimeline, [pk for pk, _ in patient_timelines]),
+                           (PublicTimeline, public_timeline_ids)):
+            through = model.activities.through
+            owner = model._meta.model_name + '_id'
+            through.objects.bulk_create(through(**{owner: pk, 'activity': activity})
+                                        for pk in ids for activity in rng.sample(activities, 2))
+
+    def export(self, queryset, file_format, chunk_size):
+        chunks = POTENTIAL_CONTACTS.records(queryset, chunk_size)
+        content = csv_chunks(POTENTIAL_CONTACTS.headers, chunks) if file_format == 'csv' else ndjson_chunks(chunks)
+        return sum(len(chunk) for chunk in content)
+
+    def benchmark(self, size, name, run):
+        # timed apart from the run measuring memory, which tracing slows down several times
+        started = time.perf_counter()
+        output_size = run()
+        seconds = time.perf_counter() - started
+        tracemalloc.start()
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.stdout.write('%8d contacts  %-10s peak %8.1f MiB  %.1fs  %.0f rows/s  %.1f MB out' % (
+            size, name, peak / 2 ** 20, seconds, size / max(seconds, 1e-9), output_size / 1e6))
@@ -0,0 +1,87 @@
+import datetime
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+
+from app.models import Activity, Location, Patient, PatientTimeline, PublicTimeline
+from app.serializers import PatientTimelineSerializer, PatientTimelineValuesSerializer, PublicTimelineSerializer, \
+    PublicTimelineValuesSerializer
+
+STATES = ['Lagos', 'Abuja', 'Kano', 'Rivers', 'Oyo', 'Kaduna', 'Enugu', 'Delta']
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Compares the serializers of timeline lists with their values serializers, on synthetic timelines ' \
+           'created in a transaction that is rolled back.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000, help='Number of timelines of each kind.')
+        parser.add_argument('--seed', type=int, default=19)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.create_timelines(options['rows'], random.Random(options['seed']))
+                self.benchmark('public timelines', PublicTimeline.objects.order_by('id'),
+                               PublicTimelineSerializer, PublicTimelineValuesSerializer)
+                self.benchmark('patient timelines', PatientTimeline.objects.order_by('id'),
+                               PatientTimelineSerializer, PatientTimelineValuesSerializer)
+                raise Rollback
+        except Rollback:
+            pass
+
+    def create_timelines(self, rows, rng):
+        user = User.objects.create_user(username='benchmark_serializers')
+        activities = [Activity.objects.create(name='benchmark activity %d' % i) for i in range(40)]
+        Location.objects.bulk_create(
+            Location(name='benchmark location %d' % i, place_id='benchmark %d' % i, creator=user,
+                     latitude=rng.uniform(4, 13), longitude=rng.uniform(3, 14)) for i in range(rows // 20 + 1))
+        locations = list(Location.objects.filter(place_id__startswith='benchmark '))
+        Location.activities.through.objects.bulk_create(
+            Location.activities.through(location=location, activity=activity)
+            for location in locations for activity in rng.sample(activities, 3))
+        Patient.objects.bulk_create(
+            Patient(full_name='Patient %d' % i, covid_id='COVID-%d' % i, nationality='Nigerian',
+                    state=rng.choice(STATES), creator=user) for i in range(rows // 10 + 1))
+        patients = list(Patient.objects.filter(creator=user))
+        first_day = datetime.date(2020, 3, 1)
+
+        def visit():
+            hour = rng.randint(0, 22)
+            return {'location': rng.choice(locations), 'country': 'Nigeria', 'state': rng.choice(STATES),
+                    'date': first_day + datetime.timedelta(days=rng.randint(0, 30)),
+                    'time_range': '%d-%d' % (hour, hour + 1)}
+
+        PatientTimeline.objects.bulk_create(
+            PatientTimeline(patient=rng.choice(patients), creator=user, **visit()) for _ in range(rows))
+        PublicTimeline.objects.bulk_create(PublicTimeline(phone_number='080', **visit()) for _ in range(rows))
+        for model in (PatientTimeline, PublicTimeline):
+            timeline_ids = model.objects.filter(location__in=locations).values_list('id', flat=True)
+            through = model.activities.through
+            owner = model._meta.model_name
+            through.objects.bulk_create(through(**{owner + '_id': timeline_id, 'activity': activity})
+                                        for timeline_id in timeline_ids
+                                        for activity in rng.sample(activities, rng.randint(0, 3)))
+
+    def benchmark(self, name, queryset, serializer_class, values_serializer_class):
+        started = time.perf_counter()
+        expected = JSONRenderer().render(serializer_class(serializer_class.eager_load(queryset), many=True).data)
+        serializer_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        rendered = JSONRenderer().render(values_serializer_class(values_serializer_class.eager_load(queryset)).data)
+        values_seconds = time.perf_counter() - started
+
+        if rendered != expected:
+            self.stderr.write('%s: the values serializer output differs from the serializer' % name)
+        rows = queryset.count()
+        self.stdout.write('%s, %d rows  serializer %.0f rows/s  values %.0f rows/s  speedup x%.1f' % (
+            name, rows, rows / max(serializer_seconds, 1e-9), rows / max(values_seconds, 1e-9),
+            serializer_seconds / max(values_seconds, 1e-9)))
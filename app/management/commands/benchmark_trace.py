@@ -0,0 +1,92 @@
+import datetime
+import random
+import time
+from types import SimpleNamespace
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from app.helpers import activity_bitset, contact_chance, date_degree, parse_time_range
+from app.scoring import default_profile
+from app.tracing import TimelineColumns, score_timelines
+
+STATES = ['Lagos', 'Abuja', 'Kano', 'Rivers', 'Oyo', 'Kaduna', 'Enugu', 'Delta']
+TIME_RANGES = {'%d-%d' % (hour, hour + 1): parse_time_range('%d-%d' % (hour, hour + 1)) for hour in range(24)}
+
+
+def legacy_scores(rows, timeline_activities, public_timeline, public_activities, date_window):
+    """The per-row loop `trace_contact` used before batch scoring, minus its queries."""
+    probabilities = []
+    for timeline_id, country, state, location_id, date, time_range, _, _ in rows:
+        matches = {}
+        if country == public_timeline.country:
+            matches['country'] = 1
+        if state == public_timeline.state:
+            matches['state'] = 1
+        if location_id == public_timeline.location_id:
+            matches['location'] = 1
+        matches['date'] = date_degree((date - public_timeline.date).days, date_window)
+        if time_range == public_timeline.time_range:
+            matches['time_range'] = 1
+        for activity_id in timeline_activities.get(timeline_id, ()):
+            if activity_id in public_activities:
+                matches['activity'] = 1
+        probabilities.append(contact_chance(matches))
+    return probabilities
+
+
+class Command(BaseCommand):
+    help = 'Compares the per-row trace loop with batch scoring on synthetic patient timelines.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10000,100000,1000000',
+                            help='Comma separated numbers of patient timelines to score.')
+        parser.add_argument('--windows', default='0,1,3,7,14',
+                            help='Comma separated date windows, in days, to score with.')
+        parser.add_argument('--seed', type=int, default=19)
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        windows = [int(window) for window in options['windows'].split(',')]
+        rng = random.Random(options['seed'])
+        start_date = datetime.date(2020, 3, 1)
+        public_activities = {1, 4, 9}
+        public_timeline = SimpleNamespace(country='Nigeria', state='Lagos', location_id=7,
+                                          date=start_date + datetime.timedelta(days=10), time_range='13-14',
+                                          time_start=13 * 60, time_end=14 * 60)
+        for size in sizes:
+            rows = []
+            for timeline_id in range(1, size + 1):
+                time_range = rng.choice(list(TIME_RANGES))
+                rows.append((timeline_id, 'Nigeria', rng.choice(STATES), rng.randint(1, 500),
+                             start_date + datetime.timedelta(days=rng.randint(0, 30)), time_range)
+                            + TIME_RANGES[time_range])
+            timeline_activities = {row[0]: rng.sample(range(1, 40), rng.randint(0, 3)) for row in rows}
+            # the activity ids double as their codes
+            activity_bitsets = [activity_bitset(timeline_activities[row[0]]) for row in rows]
+
+            started = time.perf_counter()
+            columns = TimelineColumns(rows, activity_bitsets, public_activities)
+            columns.days, columns.visits  # built once per set of columns, not per window
+            load_seconds = time.perf_counter() - started
+            self.stdout.write('%9d timelines  columns %.3fs' % (size, load_seconds))
+
+            for window in windows:
+                started = time.perf_counter()
+                expected = legacy_scores(rows, timeline_activities, public_timeline, public_activities, window)
+                loop_seconds = time.perf_counter() - started
+                profile = default_profile(date_window=window)
+                started = time.perf_counter()
+                probabilities, _ = score_timelines(columns, public_timeline, public_activities, profile)
+                score_seconds = time.perf_counter() - started
+
+                if probabilities.tolist() != expected:
+                    self.stderr.write('%d timelines, %d day window: batch scores differ from the loop' % (
+                        size, window))
+                # the share of timelines a trace fetches: same state or location, or dated within the window
+                candidates = ((columns.states == columns.state_codes.code(public_timeline.state))
+                              | (columns.locations == public_timeline.location_id)
+                              | (np.abs(columns.dates - public_timeline.date.toordinal()) <= window))
+                self.stdout.write('  %2d day window  loop %.3fs  score %.4fs  speedup x%.0f  candidates %.1f%%' % (
+                    window, loop_seconds, score_seconds, loop_seconds / max(score_seconds, 1e-9),
+                    100 * candidates.mean()))
@@ -0,0 +1,36 @@
+import sys
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from app.ingestion import IMPORT_FORMATS, import_format, import_timelines, read_rows, text_stream
+
+
+class Command(BaseCommand):
+    help = 'Imports patient timelines from a CSV file with a header line, or from NDJSON, in chunked transactions.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to import, - for standard input.')
+        parser.add_argument('--user', required=True, help='Username of the organization the patients belong to.')
+        parser.add_argument('--format', choices=IMPORT_FORMATS,
+                            help='Format of the file, by default ndjson for .ndjson and .jsonl files, csv otherwise.')
+        parser.add_argument('--chunk-size', type=int, default=settings.IMPORT_CHUNK_SIZE,
+                            help='Rows written per transaction, and reverse traced per job.')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError('User %s not found.' % options['user'])
+        path = options['path']
+        file_format = options['format'] or import_format(path)
+        binary = sys.stdin.buffer if path == '-' else open(path, 'rb')
+        with text_stream(binary) as stream:
+            summary = import_timelines(
+                read_rows(stream, file_format), user, chunk_size=max(1, options['chunk_size']),
+                on_error=lambda line, message: self.stderr.write('line %d: %s' % (line, message)),
+                on_chunk=lambda summary, line: self.stdout.write('%d rows imported, %d failed' % (
+                    summary['imported'], summary['failed'])))
+        self.stdout.write('Imported %d patient timelines, %d rows failed, queued %d reverse trace jobs.' % (
+            summary['imported'], summary['failed'], len(summary['jobs'])))
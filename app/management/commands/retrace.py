@@ -0,0 +1,94 @@
+import multiprocessing
+import os
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+
+from app.models import PotentialContact, PublicTimeline, RetraceCheckpoint
+from app.scoring import active_profile
+from app.tracing import load_candidates, trace_public_timeline
+
+
+def public_timelines_to_retrace(stale):
+    """All public timelines, or only those with contacts scored by another profile than the active one."""
+    if not stale:
+        return PublicTimeline.objects.all()
+    profile_id = active_profile().id
+    stale_contacts = PotentialContact.objects.all()
+    if profile_id is not None:
+        stale_contacts = stale_contacts.exclude(profile_id=profile_id)
+    return PublicTimeline.objects.filter(id__in=stale_contacts.values('public_timeline_id'))
+
+
+def retrace_partition(partition):
+    """Retraces the public timelines of one (country, date) partition, resuming from its checkpoint."""
+    run, country, date, chunk_size, stale = partition
+    checkpoint, _ = RetraceCheckpoint.objects.get_or_create(run=run, country=country, date=date)
+    if checkpoint.done:
+        return 0
+    public_timelines = public_timelines_to_retrace(stale).filter(
+        country=country, date=date, id__gt=checkpoint.last_public_timeline_id).order_by('id')
+    # the candidates of the partition's timelines, by their date, states and locations, not the whole country
+    profile = active_profile()
+    loaded = load_candidates(public_timelines, profile)
+    traced = 0
+    for public_timeline in public_timelines.iterator(chunk_size=chunk_size):
+        trace_public_timeline(public_timeline, profile=profile, loaded=loaded)
+        traced += 1
+        checkpoint.last_public_timeline_id = public_timeline.pk
+        if traced % chunk_size == 0:
+            checkpoint.traced += chunk_size
+            checkpoint.save(update_fields=['last_public_timeline_id', 'traced', 'updated'])
+    checkpoint.traced += traced % chunk_size
+    checkpoint.done = True
+    checkpoint.save()
+    return traced
+
+
+class Command(BaseCommand):
+    help = 'Retraces every public timeline against every patient timeline, partitioned by country and date.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--run', default='retrace',
+                            help='Name of the run. Running it again resumes from its checkpoints.')
+        parser.add_argument('--restart', action='store_true', help='Drop the checkpoints of the run first.')
+        parser.add_argument('--processes', type=int, default=os.cpu_count())
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Public timelines fetched per query, and traced between checkpoints.')
+        parser.add_argument('--stale', action='store_true',
+                            help='Only retrace public timelines with contacts scored by an older scoring profile.')
+
+    def handle(self, *args, **options):
+        run = options['run']
+        if options['restart']:
+            RetraceCheckpoint.objects.filter(run=run).delete()
+        done = set(RetraceCheckpoint.objects.filter(run=run, done=True).values_list('country', 'date'))
+        public_timelines = public_timelines_to_retrace(options['stale'])
+        partitions = [(run, country, date, options['chunk_size'], options['stale']) for country, date in
+                      public_timelines.order_by('country', 'date').values_list('country', 'date').distinct()
+                      if (country, date) not in done]
+        self.stdout.write('%d partitions to retrace, %d already done.' % (len(partitions), len(done)))
+
+        processes = max(1, options['processes'])
+        if connection.vendor == 'sqlite' and processes > 1:
+            self.stdout.write('SQLite allows a single writer, retracing with one process.')
+            processes = 1
+        pool = None
+        if processes > 1:
+            # every process opens its own database connection
+            connections.close_all()
+            pool = multiprocessing.Pool(processes)
+        started = time.perf_counter()
+        traced = 0
+        try:
+            retraced = (pool.imap_unordered(retrace_partition, partitions) if pool
+                        else map(retrace_partition, partitions))
+            for finished, count in enumerate(retraced, 1):
+                traced += count
+                elapsed = time.perf_counter() - started
+                self.stdout.write('%d/%d partitions, %d public timelines, %.1f timelines/s' % (
+                    finished, len(partitions), traced, traced / max(elapsed, 1e-9)))
+        finally:
+            if pool:
+                pool.terminate()
@@ -0,0 +1,63 @@
+import multiprocessing
+import os
+import socket
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from app.jobs import claim_job, purge_jobs, run_job
+
+PURGE_INTERVAL = 60 * 60  # seconds between two purges of finished jobs by a worker
+
+
+def work(worker, poll, burst):
+    """ Runs jobs one after the other, waiting poll seconds whenever the queue is empty.
+
+    Finished jobs past their retention are purged when the worker starts, and then every PURGE_INTERVAL.
+    """
+    purged = None
+    while True:
+        if purged is None or time.monotonic() - purged >= PURGE_INTERVAL:
+            purge_jobs()
+            purged = time.monotonic()
+        job = claim_job(worker)
+        if job is not None:
+            run_job(job)
+        elif burst:
+            return
+        else:
+            time.sleep(poll)
+
+
+class Command(BaseCommand):
+    help = 'Runs queued jobs, such as asynchronous and reverse traces, in worker processes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=settings.JOB_CONCURRENCY,
+                            help='Number of worker processes.')
+        parser.add_argument('--poll', type=float, default=1.0,
+                            help='Seconds to wait before checking an empty queue again.')
+        parser.add_argument('--burst', action='store_true',
+                            help='Exit once the queue is empty instead of waiting for new jobs.')
+
+    def handle(self, *args, **options):
+        name = '%s:%s' % (socket.gethostname(), os.getpid())
+        concurrency = max(1, options['concurrency'])
+        if concurrency == 1:
+            work(name, options['poll'], options['burst'])
+            return
+        # every process opens its own database connection
+        connections.close_all()
+        workers = [multiprocessing.Process(target=work, args=('%s/%d' % (name, i), options['poll'], options['burst']))
+                   for i in range(concurrency)]
+        for worker in workers:
+            worker.start()
+        self.stdout.write('Started %d workers.' % concurrency)
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            for worker in workers:
+                worker.terminate()
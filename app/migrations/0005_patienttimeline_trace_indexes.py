@@ -0,0 +1,25 @@
+# Generated by Django 2.0 on 2026-10-18 16:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0004_potentialcontact_activities'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='patienttimeline',
+            index=models.Index(fields=['country', 'state'], name='patient_timeline_state_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patienttimeline',
+            index=models.Index(fields=['country', 'location'], name='patient_timeline_location_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patienttimeline',
+            index=models.Index(fields=['country', 'date'], name='patient_timeline_date_idx'),
+        ),
+    ]
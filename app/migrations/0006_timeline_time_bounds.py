@@ -0,0 +1,53 @@
+# Generated by Django 2.0 on 2026-10-18 16:12
+
+from django.db import migrations, models
+
+from app.helpers import parse_time_range
+
+
+def parse_time_ranges(apps, schema_editor):
+    for model_name in ('PatientTimeline', 'PublicTimeline'):
+        timelines = apps.get_model('app', model_name).objects
+        for time_range in timelines.values_list('time_range', flat=True).distinct():
+            time_start, time_end = parse_time_range(time_range)
+            if time_start is not None:
+                timelines.filter(time_range=time_range).update(time_start=time_start, time_end=time_end)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0005_patienttimeline_trace_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patienttimeline',
+            name='time_end',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='patienttimeline',
+            name='time_start',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='publictimeline',
+            name='time_end',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='publictimeline',
+            name='time_start',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddIndex(
+            model_name='patienttimeline',
+            index=models.Index(fields=['location', 'date', 'time_start'], name='patient_timeline_visit_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='publictimeline',
+            index=models.Index(fields=['location', 'date', 'time_start'], name='public_timeline_visit_idx'),
+        ),
+        migrations.RunPython(parse_time_ranges, migrations.RunPython.noop),
+    ]
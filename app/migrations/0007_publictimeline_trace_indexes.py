@@ -0,0 +1,25 @@
+# Generated by Django 2.0 on 2026-10-18 16:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0006_timeline_time_bounds'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='publictimeline',
+            index=models.Index(fields=['country', 'state'], name='public_timeline_state_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='publictimeline',
+            index=models.Index(fields=['country', 'location'], name='public_timeline_location_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='publictimeline',
+            index=models.Index(fields=['country', 'date'], name='public_timeline_date_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.0 on 2026-10-18 16:14
+
+from django.db import migrations
+from django.db.models import Count, Max
+
+
+def remove_duplicate_contacts(apps, schema_editor):
+    PotentialContact = apps.get_model('app', 'PotentialContact')
+    duplicates = PotentialContact.objects.values('patient_timeline', 'public_timeline').annotate(
+        latest=Max('id'), count=Count('id')).filter(count__gt=1)
+    for duplicate in duplicates:
+        PotentialContact.objects.filter(patient_timeline=duplicate['patient_timeline'],
+                                        public_timeline=duplicate['public_timeline']).exclude(
+            id=duplicate['latest']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0007_publictimeline_trace_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_contacts, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='potentialcontact',
+            unique_together={('patient_timeline', 'public_timeline')},
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 2.0 on 2026-10-18 16:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0009_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RetraceCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('run', models.CharField(max_length=100)),
+                ('country', models.CharField(max_length=300, null=True)),
+                ('date', models.DateField()),
+                ('last_public_timeline_id', models.IntegerField(default=0)),
+                ('traced', models.IntegerField(default=0)),
+                ('done', models.BooleanField(default=False)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='retracecheckpoint',
+            unique_together={('run', 'country', 'date')},
+        ),
+    ]
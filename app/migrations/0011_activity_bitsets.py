@@ -0,0 +1,58 @@
+# Generated by Django 2.0 on 2026-10-18 17:02
+
+from collections import defaultdict
+
+from django.db import migrations, models
+
+from app.helpers import activity_bitset
+
+
+def fill_activity_bitsets(apps, schema_editor):
+    Activity = apps.get_model('app', 'Activity')
+    for code, activity_id in enumerate(Activity.objects.order_by('id').values_list('id', flat=True)):
+        Activity.objects.filter(pk=activity_id).update(code=code)
+    for model_name in ('PatientTimeline', 'PublicTimeline', 'Location'):
+        model = apps.get_model('app', model_name)
+        activities = model._meta.get_field('activities')
+        source = activities.m2m_field_name() + '_id'
+        codes = defaultdict(list)
+        for row_id, code in activities.remote_field.through.objects.values_list(
+                source, activities.m2m_reverse_field_name() + '__code'):
+            codes[row_id].append(code)
+        rows = defaultdict(list)
+        for row_id, row_codes in codes.items():
+            rows[activity_bitset(row_codes)].append(row_id)
+        for bits, row_ids in rows.items():
+            for start in range(0, len(row_ids), 500):
+                model.objects.filter(pk__in=row_ids[start:start + 500]).update(activity_bits=bits)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0010_retracecheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='activity',
+            name='code',
+            field=models.IntegerField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='location',
+            name='activity_bits',
+            field=models.BinaryField(default=b''),
+        ),
+        migrations.AddField(
+            model_name='patienttimeline',
+            name='activity_bits',
+            field=models.BinaryField(default=b''),
+        ),
+        migrations.AddField(
+            model_name='publictimeline',
+            name='activity_bits',
+            field=models.BinaryField(default=b''),
+        ),
+        migrations.RunPython(fill_activity_bitsets, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.0 on 2026-10-18 17:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0011_activity_bitsets'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='activity',
+            name='code',
+            field=models.IntegerField(editable=False, unique=True),
+        ),
+    ]
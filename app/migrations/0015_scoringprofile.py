@@ -0,0 +1,53 @@
+# Generated by Django 2.0 on 2026-10-18 16:39
+
+import json
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+from app.helpers import CONTACT_WEIGHTS
+
+
+def create_default_profile(apps, schema_editor):
+    """Stores the weights contacts were scored with so far as the first version of the default profile."""
+    profile = apps.get_model('app', 'ScoringProfile').objects.create(
+        name=settings.TRACE_SCORING_PROFILE, version=1, weights=json.dumps(CONTACT_WEIGHTS),
+        date_window=settings.TRACE_DATE_WINDOW, proximity_radius=settings.TRACE_PROXIMITY_RADIUS)
+    apps.get_model('app', 'PotentialContact').objects.update(profile=profile)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0014_dataversion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScoringProfile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('version', models.IntegerField(editable=False)),
+                ('weights', models.TextField()),
+                ('threshold', models.FloatField(default=50)),
+                ('date_window', models.IntegerField(default=0)),
+                ('date_decay', models.CharField(choices=[('linear', 'Linear'), ('flat', 'Flat')], default='linear', max_length=20)),
+                ('proximity_radius', models.FloatField(default=0)),
+                ('proximity_decay', models.CharField(choices=[('linear', 'Linear'), ('flat', 'Flat')], default='linear', max_length=20)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='scoringprofile',
+            unique_together={('name', 'version')},
+        ),
+        migrations.AddField(
+            model_name='potentialcontact',
+            name='profile',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='app.ScoringProfile'),
+        ),
+        migrations.RunPython(create_default_profile, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 2.0 on 2026-10-18 16:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0015_scoringprofile'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['created', 'id'], name='activity_page_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(fields=['creator', 'created', 'id'], name='patient_page_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patienttimeline',
+            index=models.Index(fields=['patient', 'created', 'id'], name='patient_timeline_page_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='potentialcontact',
+            index=models.Index(fields=['patient', 'created', 'id'], name='potential_contact_page_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='publictimeline',
+            index=models.Index(fields=['created', 'id'], name='public_timeline_page_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='publictimeline',
+            index=models.Index(fields=['country', 'created', 'id'], name='public_country_page_idx'),
+        ),
+    ]
@@ -0,0 +1,143 @@
+# Generated by Django 2.0 on 2026-10-18 21:40
+
+from collections import defaultdict
+
+from django.db import migrations, models
+
+from app.helpers import activity_bitset
+
+BITSET_MODELS = ('PatientTimeline', 'PublicTimeline', 'Location')
+
+
+def chunks(values, size=500):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def fill_activity_bits(model, row_ids):
+    activities = model._meta.get_field('activities')
+    source = activities.m2m_field_name() + '_id'
+    codes = defaultdict(list)
+    for chunk in chunks(row_ids):
+        for row_id, code in activities.remote_field.through.objects.filter(**{source + '__in': chunk}).values_list(
+                source, activities.m2m_reverse_field_name() + '__code'):
+            codes[row_id].append(code)
+    rows = defaultdict(list)
+    for row_id in row_ids:
+        rows[activity_bitset(codes[row_id])].append(row_id)
+    for bits, ids in rows.items():
+        for chunk in chunks(ids):
+            model.objects.filter(pk__in=chunk).update(activity_bits=bits)
+
+
+def move_activity_rows(through, owner, activity, moved):
+    """Points the through rows of the keys of moved to their values, dropping the rows that would repeat one."""
+    owner, activity = owner + '_id', activity + '_id'
+    targets = set(moved.values())
+    existing = set()
+    for chunk in chunks(targets):
+        existing.update(through.objects.filter(**{activity + '__in': chunk}).values_list(owner, activity))
+    changed = set()
+    for chunk in chunks(moved):
+        for row_id, owner_id, activity_id in through.objects.filter(**{activity + '__in': chunk}).values_list(
+                'id', owner, activity):
+            pair = (owner_id, moved[activity_id])
+            if pair in existing:
+                through.objects.filter(pk=row_id).delete()
+            else:
+                through.objects.filter(pk=row_id).update(**{activity: pair[1]})
+                existing.add(pair)
+            changed.add(owner_id)
+    return changed
+
+
+def duplicates(rows):
+    """Maps the id of every row repeating the key of an earlier one to the id of the first, rows are (id, key)."""
+    first = {}
+    moved = {}
+    for row_id, key in rows:
+        if key in first:
+            moved[row_id] = first[key]
+        else:
+            first[key] = row_id
+    return moved
+
+
+def merge_duplicate_activities(apps, schema_editor):
+    Activity = apps.get_model('app', 'Activity')
+    moved = duplicates((activity_id, name) for activity_id, name in
+                       Activity.objects.order_by('id').values_list('id', 'name'))
+    if not moved:
+        return
+    changed = {}
+    for model_name in BITSET_MODELS + ('PotentialContact',):
+        model = apps.get_model('app', model_name)
+        activities = model._meta.get_field('activities')
+        changed[model] = move_activity_rows(activities.remote_field.through, activities.m2m_field_name(),
+                                            activities.m2m_reverse_field_name(), moved)
+    for chunk in chunks(moved):
+        Activity.objects.filter(pk__in=chunk).delete()
+    for model_name in BITSET_MODELS:
+        model = apps.get_model('app', model_name)
+        fill_activity_bits(model, changed[model])
+
+
+def merge_duplicate_locations(apps, schema_editor):
+    Location = apps.get_model('app', 'Location')
+    moved = duplicates((location_id, (name, place_id)) for location_id, name, place_id in
+                       Location.objects.order_by('id').values_list('id', 'name', 'place_id'))
+    if not moved:
+        return
+    for model_name in ('PatientTimeline', 'PublicTimeline'):
+        model = apps.get_model('app', model_name)
+        for location_id, kept_id in moved.items():
+            model.objects.filter(location_id=location_id).update(location_id=kept_id)
+    # the activities of a location are moved like its visits, under the location instead of the activity
+    through = Location._meta.get_field('activities').remote_field.through
+    kept_activities = defaultdict(set)
+    for chunk in chunks(set(moved.values())):
+        for location_id, activity_id in through.objects.filter(location_id__in=chunk).values_list(
+                'location_id', 'activity_id'):
+            kept_activities[location_id].add(activity_id)
+    for chunk in chunks(moved):
+        for row_id, location_id, activity_id in through.objects.filter(location_id__in=chunk).values_list(
+                'id', 'location_id', 'activity_id'):
+            kept_id = moved[location_id]
+            if activity_id in kept_activities[kept_id]:
+                through.objects.filter(pk=row_id).delete()
+            else:
+                through.objects.filter(pk=row_id).update(location_id=kept_id)
+                kept_activities[kept_id].add(activity_id)
+    # a kept location without coordinates takes those of a duplicate
+    for location in Location.objects.filter(pk__in=set(moved.values()), latitude__isnull=True):
+        duplicate = Location.objects.filter(pk__in=[location_id for location_id, kept_id in moved.items()
+                                                    if kept_id == location.pk],
+                                            latitude__isnull=False).order_by('id').first()
+        if duplicate is not None:
+            Location.objects.filter(pk=location.pk).update(latitude=duplicate.latitude, longitude=duplicate.longitude,
+                                                           geohash=duplicate.geohash)
+    for chunk in chunks(moved):
+        Location.objects.filter(pk__in=chunk).delete()
+    fill_activity_bits(Location, set(moved.values()))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0016_list_page_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_activities, migrations.RunPython.noop),
+        migrations.RunPython(merge_duplicate_locations, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='activity',
+            name='name',
+            field=models.CharField(max_length=1023, unique=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='location',
+            unique_together={('name', 'place_id')},
+        ),
+    ]
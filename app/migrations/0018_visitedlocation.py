@@ -0,0 +1,46 @@
+# Generated by Django 2.0 on 2026-10-18 23:10
+
+from collections import defaultdict
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_visits(apps, schema_editor):
+    PatientTimeline = apps.get_model('app', 'PatientTimeline')
+    VisitedLocation = apps.get_model('app', 'VisitedLocation')
+    visits = defaultdict(int)
+    for visit in PatientTimeline.objects.values('country', 'state', 'location_id').annotate(
+            timelines=Count('id')).order_by():
+        visits[visit['country'] or '', visit['state'] or '', visit['location_id']] += visit['timelines']
+    VisitedLocation.objects.bulk_create([
+        VisitedLocation(country=country, state=state, location_id=location_id, timelines=timelines)
+        for (country, state, location_id), timelines in visits.items()], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0017_interning_unique_keys'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VisitedLocation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('country', models.CharField(default='', max_length=300)),
+                ('state', models.CharField(default='', max_length=300)),
+                ('timelines', models.IntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('location', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='app.Location')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='visitedlocation',
+            unique_together={('country', 'state', 'location')},
+        ),
+        migrations.RunPython(count_visits, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 2.0 on 2026-10-18 18:19
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def rename_repeated_covid_ids(apps, schema_editor):
+    """Suffixes the repeated covid ids of a creator with the patient id, but for their first patient."""
+    Patient = apps.get_model('app', 'Patient')
+    repeated = Patient.objects.filter(covid_id__isnull=False).values('creator_id', 'covid_id').annotate(
+        patients=Count('id')).filter(patients__gt=1).order_by()
+    for key in repeated:
+        patients = Patient.objects.filter(creator_id=key['creator_id'], covid_id=key['covid_id']).order_by('id')
+        for patient in patients[1:]:
+            Patient.objects.filter(pk=patient.pk).update(covid_id='%s-%d' % (patient.covid_id, patient.pk))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('app', '0018_visitedlocation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Sequence',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('value', models.BigIntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(rename_repeated_covid_ids, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='patient',
+            unique_together={('creator', 'covid_id')},
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 2.0 on 2026-10-18 18:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0019_covid_id_allocation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CountrySummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('country', models.CharField(max_length=300, unique=True)),
+                ('patients', models.IntegerField(default=0)),
+                ('potential_contacts', models.IntegerField(default=0)),
+                ('probability_sum', models.FloatField(default=0.0)),
+                ('public_timelines', models.IntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.0 on 2026-10-18 18:53
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0021_job_creator'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='activity',
+            name='activity_page_idx',
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 2.0 on 2026-10-18 18:55
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def follow_settings(apps, schema_editor):
+    """ Empties the date window and proximity radius 0015 copied from the TRACE_* settings into the first version
+    of the default profile, in the versions saved since that still have them, so they follow the settings.
+    """
+    ScoringProfile = apps.get_model('app', 'ScoringProfile')
+    profiles = ScoringProfile.objects.filter(name=settings.TRACE_SCORING_PROFILE)
+    first = profiles.filter(version=1).first()
+    if first is None:
+        return
+    profiles.filter(date_window=first.date_window).update(date_window=None)
+    profiles.filter(proximity_radius=first.proximity_radius).update(proximity_radius=None)
+
+
+def copy_settings(apps, schema_editor):
+    ScoringProfile = apps.get_model('app', 'ScoringProfile')
+    ScoringProfile.objects.filter(date_window__isnull=True).update(date_window=settings.TRACE_DATE_WINDOW)
+    ScoringProfile.objects.filter(proximity_radius__isnull=True).update(
+        proximity_radius=settings.TRACE_PROXIMITY_RADIUS)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0022_remove_activity_page_idx'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='scoringprofile',
+            name='date_window',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='scoringprofile',
+            name='proximity_radius',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.RunPython(follow_settings, copy_settings),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 2.0 on 2026-10-18 19:14
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0023_scoring_profile_settings'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='patienttimeline',
+            name='patient_timeline_visit_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='publictimeline',
+            name='public_timeline_visit_idx',
+        ),
+    ]
@@ -1,5 +1,12 @@
+import json
+
 from django.contrib.auth.models import User
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, models, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from app.helpers import encode_geohash, parse_time_range
 
 # Create your models here.
 
@@ -21,7 +28,8 @@ class Organization(models.Model):
 
 
 class Activity(models.Model):
-    name = models.CharField(max_length=1023)  # lowercase, frontend must ensure it is in lowercase
+    name = models.CharField(max_length=1023, unique=True)  # lowercase, frontend must ensure it is in lowercase
+    code = models.IntegerField(unique=True, editable=False)  # dense, the bit of the activity in activity bitsets
     creator = models.ForeignKey(User, blank=True, null=True, on_delete=models.DO_NOTHING)
 
     created = models.DateTimeField(auto_now_add=True)
@@ -33,22 +41,83 @@ class Activity(models.Model):
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        if self.code is not None:
+            return super().save(*args, **kwargs)
+        try:
+            with transaction.atomic():
+                self.code = Activity.next_code()
+                super().save(*args, **kwargs)
+        except IntegrityError:
+            # an activity created at the same time took the code
+            self.code = Activity.next_code()
+            super().save(*args, **kwargs)
+
+    @staticmethod
+    def next_code():
+        code = Activity.objects.aggregate(code=Max('code'))['code']
+        return 0 if code is None else code + 1
+
 
 class Location(models.Model):
     name = models.CharField(max_length=1023)
     place_id = models.CharField(max_length=1023)
     activities = models.ManyToManyField(Activity, related_name='Activities_at_Location')
+    activity_bits = models.BinaryField(default=b'')  # `activity_bitset` of the activity codes, kept by app.signals
+    latitude = models.FloatField(null=True)
+    longitude = models.FloatField(null=True)
+    geohash = models.CharField(max_length=12, null=True, db_index=True)  # of latitude and longitude, set on save
     creator = models.ForeignKey(User, blank=True, null=True, on_delete=models.DO_NOTHING)
 
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        # app.interning resolves locations by name and place id
+        unique_together = ('name', 'place_id')
+
     class Admin:
         pass
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        self.set_geohash()
+        super().save(*args, **kwargs)
+
+    def set_geohash(self):
+        """Sets the geohash of the coordinates, save() does, bulk inserts have to."""
+        self.geohash = None
+        if self.latitude is not None and self.longitude is not None:
+            self.geohash = encode_geohash(self.latitude, self.longitude)
+
+    def set_coordinates(self, latitude, longitude, move=False):
+        """ Records the coordinates sent along with a visit to the location, ignoring missing or invalid ones.
+
+        Only a location without coordinates takes them, unless move, for visits of authenticated users.
+        A location isn't moved within its geohash cell, as the GPS jitter of every visit would.
+        """
+        coordinates = Location.parse_coordinates(latitude, longitude)
+        if coordinates is None:
+            return
+        if self.latitude is not None and self.longitude is not None and (
+                not move or encode_geohash(*coordinates) == self.geohash):
+            return
+        self.latitude, self.longitude = coordinates
+        self.save(update_fields=['latitude', 'longitude', 'geohash', 'updated'])
+
+    @staticmethod
+    def parse_coordinates(latitude, longitude):
+        """Returns (latitude, longitude) as floats, or None when either is missing or invalid."""
+        try:
+            latitude, longitude = float(latitude), float(longitude)
+        except (TypeError, ValueError):
+            return None
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            return None
+        return latitude, longitude
+
 
 class Patient(models.Model):
     full_name = models.CharField(max_length=1023, null=True)
@@ -60,6 +129,11 @@ class Patient(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        # imports find the patients of a creator by covid_id, see app.ingestion
+        unique_together = ('creator', 'covid_id')
+        indexes = [models.Index(fields=['creator', 'created', 'id'], name='patient_page_idx')]
+
     class Admin:
         pass
 
@@ -68,7 +142,10 @@ class PatientTimeline(models.Model):
     patient = models.ForeignKey(Patient, on_delete=models.DO_NOTHING)
     location = models.ForeignKey(Location, on_delete=models.DO_NOTHING)
     time_range = models.CharField(max_length=1023, null=True)
+    time_start = models.IntegerField(null=True)  # minute of the day, parsed from time_range on save
+    time_end = models.IntegerField(null=True)  # past 1440 when the time range ends the next day
     activities = models.ManyToManyField(Activity, related_name='Activities_of_Patient')
+    activity_bits = models.BinaryField(default=b'')  # `activity_bitset` of the activity codes, kept by app.signals
     date = models.DateField(default=None)
     state = models.CharField(max_length=300, null=True)
     country = models.CharField(max_length=300, null=True)
@@ -77,14 +154,30 @@ class PatientTimeline(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        # a trace only fetches the timelines of a country sharing the state, location or date
+        indexes = [
+            models.Index(fields=['country', 'state'], name='patient_timeline_state_idx'),
+            models.Index(fields=['country', 'location'], name='patient_timeline_location_idx'),
+            models.Index(fields=['country', 'date'], name='patient_timeline_date_idx'),
+            models.Index(fields=['patient', 'created', 'id'], name='patient_timeline_page_idx'),
+        ]
+
     class Admin:
         pass
 
+    def save(self, *args, **kwargs):
+        self.time_start, self.time_end = parse_time_range(self.time_range)
+        super().save(*args, **kwargs)
+
 
 class PublicTimeline(models.Model):
     location = models.ForeignKey(Location, on_delete=models.DO_NOTHING)
     time_range = models.CharField(max_length=1023, null=True)
+    time_start = models.IntegerField(null=True)  # minute of the day, parsed from time_range on save
+    time_end = models.IntegerField(null=True)  # past 1440 when the time range ends the next day
     activities = models.ManyToManyField(Activity)
+    activity_bits = models.BinaryField(default=b'')  # `activity_bitset` of the activity codes, kept by app.signals
     date = models.DateField(default=None)
     state = models.CharField(max_length=300, null=True)
     country = models.CharField(max_length=300, null=True)
@@ -95,9 +188,70 @@ class PublicTimeline(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        # a reverse trace only fetches the timelines of a country sharing the state, location or date
+        indexes = [
+            models.Index(fields=['country', 'state'], name='public_timeline_state_idx'),
+            models.Index(fields=['country', 'location'], name='public_timeline_location_idx'),
+            models.Index(fields=['country', 'date'], name='public_timeline_date_idx'),
+            models.Index(fields=['created', 'id'], name='public_timeline_page_idx'),
+            models.Index(fields=['country', 'created', 'id'], name='public_country_page_idx'),
+        ]
+
+    class Admin:
+        pass
+
+    def save(self, *args, **kwargs):
+        self.time_start, self.time_end = parse_time_range(self.time_range)
+        super().save(*args, **kwargs)
+
+
+class ScoringProfile(models.Model):
+    LINEAR = 'linear'  # from 1 for the same date or place down to the edge of the window or radius
+    FLAT = 'flat'  # 1 anywhere within the window or radius
+    DECAYS = ((LINEAR, 'Linear'), (FLAT, 'Flat'))
+
+    name = models.CharField(max_length=100)
+    version = models.IntegerField(editable=False)  # every save stores a new version, see save()
+    weights = models.TextField()  # json list of [key, weight] pairs, the weights are added up in this order
+    threshold = models.FloatField(default=50)  # probability from which a timeline is a potential contact
+    # days apart visits still match on date, TRACE_DATE_WINDOW when None
+    date_window = models.IntegerField(null=True, blank=True)
+    date_decay = models.CharField(max_length=20, choices=DECAYS, default=LINEAR)
+    # meters apart locations still match, 0 for the same only, TRACE_PROXIMITY_RADIUS when None
+    proximity_radius = models.FloatField(null=True, blank=True)
+    proximity_decay = models.CharField(max_length=20, choices=DECAYS, default=LINEAR)
+
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('name', 'version')
+
     class Admin:
         pass
 
+    def __str__(self):
+        return '%s v%s' % (self.name, self.version)
+
+    def clean(self):
+        try:
+            weights = json.loads(self.weights)
+            valid = isinstance(weights, list) and all(
+                isinstance(pair, list) and len(pair) == 2 and isinstance(pair[0], str)
+                and isinstance(pair[1], (int, float)) and not isinstance(pair[1], bool) for pair in weights)
+        except ValueError:
+            valid = False
+        if not valid:
+            raise ValidationError({'weights': 'Expected a JSON list of [key, weight] pairs.'})
+
+    def save(self, *args, **kwargs):
+        """Stores the profile as its next version, earlier versions stay as they were for the contacts they scored."""
+        version = ScoringProfile.objects.filter(name=self.name).aggregate(version=Max('version'))['version']
+        self.pk = None
+        self.version = (version or 0) + 1
+        super().save(*args, **kwargs)
+
 
 class PotentialContact(models.Model):
     probability = models.FloatField(default=0.0)
@@ -105,6 +259,132 @@ class PotentialContact(models.Model):
     public_timeline = models.ForeignKey(PublicTimeline, on_delete=models.CASCADE, related_name='Timeline_of_Public')
     patient = models.ForeignKey(Patient, on_delete=models.DO_NOTHING)
     activities = models.ManyToManyField(Activity)
+    profile = models.ForeignKey(ScoringProfile, null=True, on_delete=models.SET_NULL)  # version that scored it
+
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('patient_timeline', 'public_timeline')
+        indexes = [models.Index(fields=['patient', 'created', 'id'], name='potential_contact_page_idx')]
+
+    class Admin:
+        pass
+
+
+class RetraceCheckpoint(models.Model):
+    run = models.CharField(max_length=100)
+    country = models.CharField(max_length=300, null=True)
+    date = models.DateField()
+    last_public_timeline_id = models.IntegerField(default=0)  # public timelines are retraced in id order
+    traced = models.IntegerField(default=0)
+    done = models.BooleanField(default=False)
+
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('run', 'country', 'date')
+
+    class Admin:
+        pass
+
+
+class VisitedLocation(models.Model):
+    # patient timelines at a location, by country and state, kept by app.signals for the activities endpoint
+    country = models.CharField(max_length=300, default='')  # '' for timelines without one
+    state = models.CharField(max_length=300, default='')
+    location = models.ForeignKey(Location, on_delete=models.CASCADE)
+    timelines = models.IntegerField(default=0)
+
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('country', 'state', 'location')
+
+    class Admin:
+        pass
+
+
+class CountrySummary(models.Model):
+    # dashboard counts of a country, kept by app.summaries
+    country = models.CharField(max_length=300, unique=True)
+    patients = models.IntegerField(default=0)  # of the organizations of the country
+    potential_contacts = models.IntegerField(default=0)  # of those patients
+    probability_sum = models.FloatField(default=0.0)  # of those potential contacts
+    public_timelines = models.IntegerField(default=0)
+
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Admin:
+        pass
+
+    @property
+    def average_probability(self):
+        return self.probability_sum / self.potential_contacts if self.potential_contacts else 0
+
+
+class Sequence(models.Model):
+    name = models.CharField(max_length=100, unique=True)  # e.g. covid_ids
+    value = models.BigIntegerField(default=0)  # values below it are taken, see app.covid_ids.reserve
+
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Admin:
+        pass
+
+
+class DataVersion(models.Model):
+    key = models.CharField(max_length=400, unique=True)  # what changed, e.g. country:Nigeria
+    version = models.BigIntegerField(default=0)  # increased on every change, by app.caching.bump_data_versions
+
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Admin:
+        pass
+
+
+class Job(models.Model):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = ((PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed'))
+
+    kind = models.CharField(max_length=100)
+    payload = models.TextField(default='{}')  # json encoded keyword arguments of the job handler
+    status = models.CharField(max_length=20, choices=STATUSES, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    max_attempts = models.IntegerField(default=5)
+    run_after = models.DateTimeField(default=timezone.now)
+    result = models.TextField(null=True)  # json encoded return value of the job handler
+    error = models.TextField(null=True)
+    worker = models.CharField(max_length=300, null=True)
+    creator = models.ForeignKey(User, blank=True, null=True, on_delete=models.CASCADE)  # None for anonymous traces
+
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_after'], name='job_queue_idx'),
+        ]
+
+    class Admin:
+        pass
+
+
+class TimelineImport(models.Model):
+    # a file uploaded to the import endpoint, imported by a job and deleted once it is
+    creator = models.ForeignKey(User, on_delete=models.CASCADE)
+    format = models.CharField(max_length=20)
+    data = models.BinaryField()  # gzipped, in the database as workers may run on other machines than the upload
+    line = models.IntegerField(default=0)  # last line imported, a retried job resumes after it
+    summary = models.TextField(default='{}')  # json encoded summary of the lines imported so far
 
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
@@ -0,0 +1,108 @@
+"""Cursor pagination of list endpoints.
+
+Pages are ordered by (created, id), or by the ordering of their endpoint
+ending with id, e.g. (name, id) for activities. The cursor of the next page
+is the values of those fields in the last row of the page, so every page is
+fetched with the same indexed range query however deep it is, instead of an
+OFFSET that scans every row before it.
+"""
+import base64
+import binascii
+import datetime
+import json
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework import status
+from rest_framework.response import Response
+
+from app.helpers import error_msg, success_msg
+
+# Query parameters read by `paginated_response`, list endpoints filtering on the query string leave them out.
+PAGINATION_PARAMS = ('cursor', 'page_size', 'paginate')
+PAGE_ORDERING = ('created', 'id')
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(values):
+    values = [value.isoformat() if isinstance(value, datetime.datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor, model, ordering):
+    """The values of the ordering fields of model in cursor, raises InvalidCursor when it doesn't hold them."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (binascii.Error, TypeError, ValueError, UnicodeError):
+        raise InvalidCursor(cursor)
+    if not isinstance(values, list) or len(values) != len(ordering) or None in values:
+        raise InvalidCursor(cursor)
+    try:
+        return [model._meta.get_field(name).to_python(value) for name, value in zip(ordering, values)]
+    except ValidationError:
+        raise InvalidCursor(cursor)
+
+
+def following(ordering, values):
+    """A Q matching the rows after values in ordering, e.g. created > c or created = c and id > i."""
+    rows = Q()
+    for index, name in enumerate(ordering):
+        rows |= Q(**dict(zip(ordering[:index], values[:index]), **{name + '__gt': values[index]}))
+    return rows
+
+
+def wants_pages(request):
+    """ Whether to paginate the response: as the request says with ?paginate=0|1, or when it sends a cursor or a
+    page size, API_PAGINATE otherwise.
+    """
+    paginate = request.GET.get('paginate')
+    if paginate is not None:
+        return paginate.lower() not in ('0', 'false', 'no')
+    return 'cursor' in request.GET or 'page_size' in request.GET or settings.API_PAGINATE
+
+
+def page_size(request):
+    try:
+        size = int(request.GET.get('page_size', settings.API_PAGE_SIZE))
+    except ValueError:
+        size = settings.API_PAGE_SIZE
+    return min(max(size, 1), settings.API_MAX_PAGE_SIZE)
+
+
+def paginate(queryset, cursor=None, size=None, ordering=PAGE_ORDERING):
+    """ Returns the rows of queryset following the cursor, at most size of them, and the cursor of the next page.
+
+    Rows are ordered by the ascending fields of ordering, the last of which must be unique. queryset may be of
+    models or of .values() including those fields.
+    """
+    size = size or settings.API_PAGE_SIZE
+    queryset = queryset.order_by(*ordering)
+    if cursor:
+        queryset = queryset.filter(following(ordering, decode_cursor(cursor, queryset.model, ordering)))
+    rows = list(queryset[:size + 1])
+    if len(rows) <= size:
+        return rows, None
+    rows = rows[:size]
+    if isinstance(rows[-1], dict):
+        return rows, encode_cursor([rows[-1][name] for name in ordering])
+    return rows, encode_cursor([getattr(rows[-1], name) for name in ordering])
+
+
+def paginated_response(request, queryset, serializer_class, message, ordering=PAGE_ORDERING):
+    """ Responds with one page of queryset in ordering, serialized, or with all of it when the request isn't paginated.
+
+    A page comes as {'results': [...], 'next': cursor}, next is None on the last page. Unpaginated
+    responses are the `success_msg` of the serialized list, as list endpoints responded before pagination.
+    """
+    if not wants_pages(request):
+        return Response(success_msg(message, serializer_class(queryset, many=True).data), status=status.HTTP_200_OK)
+    try:
+        rows, next_cursor = paginate(queryset, request.GET.get('cursor'), page_size(request), ordering)
+    except InvalidCursor:
+        return Response(error_msg("Invalid cursor."), status=status.HTTP_400_BAD_REQUEST)
+    data = {'results': serializer_class(rows, many=True).data, 'next': next_cursor}
+    return Response(success_msg(message, data), status=status.HTTP_200_OK)
@@ -1,7 +1,5 @@
 from rest_framework import permissions
 
-from app.models import Organization
-
 
 class OrganizationPermission(permissions.BasePermission):
     """
@@ -11,5 +9,5 @@ class OrganizationPermission(permissions.BasePermission):
     def has_permission(self, request, view):
         if request.user.is_anonymous:
             return False
-        org = Organization.objects.filter(user=request.user).exists()
-        return org
+        # token requests come with the organization of their user, see app.authentication.CachedTokenAuthentication
+        return hasattr(request.user, 'organization')
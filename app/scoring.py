@@ -0,0 +1,94 @@
+"""Scoring profiles.
+
+A `ScoringProfile` row says which keys of two timelines are compared, what
+each match weighs and how date and location matches decay with distance. It is
+compiled once per process into a `CompiledProfile`, holding the probability of
+every combination of full matches, so most rows score with one table lookup.
+A profile leaving its date window or proximity radius empty uses the
+TRACE_DATE_WINDOW or TRACE_PROXIMITY_RADIUS setting.
+"""
+import json
+
+import numpy as np
+from django.conf import settings
+
+from app.helpers import CONTACT_WEIGHTS
+from app.models import ScoringProfile
+
+# Keys the trace engine can match.
+SCORED_KEYS = ('country', 'state', 'location', 'date', 'time_range', 'activity')
+
+
+class CompiledProfile:
+    """ A scoring profile ready to score rows.
+
+    Keys are scored in the order of the profile's weights, keys that aren't in `SCORED_KEYS`
+    are left out. Bit i of a match signature is set when a row matches the i-th key, and
+    table[signature] is the probability of a row matching those keys fully.
+    """
+
+    def __init__(self, profile):
+        self.id = profile.pk
+        self.name = profile.name
+        self.version = profile.version
+        self.weights = tuple((key, float(weight)) for key, weight in json.loads(profile.weights)
+                             if key in SCORED_KEYS)
+        self.threshold = profile.threshold
+        self.date_window = settings.TRACE_DATE_WINDOW if profile.date_window is None else profile.date_window
+        self.date_decay = profile.date_decay
+        self.proximity_radius = (settings.TRACE_PROXIMITY_RADIUS if profile.proximity_radius is None
+                                 else profile.proximity_radius)
+        self.proximity_decay = profile.proximity_decay
+        self.table = np.zeros(2 ** len(self.weights))
+        for signature in range(len(self.table)):
+            probability = 0
+            for bit, (_, weight) in enumerate(self.weights):
+                if signature >> bit & 1:
+                    probability += weight
+            self.table[signature] = probability
+
+    def score(self, degrees, size):
+        """ Returns the probabilities of size rows, given how much each row matched each key, from 0 to 1.
+
+        Rows matching some key partly are summed key by key in the order of the weights, which
+        gives the same result as `contact_chance` does for the weights of the profile.
+        """
+        signatures = np.zeros(size, dtype=np.int64)
+        partial = np.zeros(size, dtype=bool)
+        for bit, (key, _) in enumerate(self.weights):
+            matched = np.asarray(degrees[key]) > 0
+            signatures |= matched.astype(np.int64) << bit
+            partial |= matched & (np.asarray(degrees[key]) < 1)
+        probabilities = self.table[signatures]
+        rows = np.flatnonzero(partial)
+        if len(rows):
+            probabilities[rows] = 0
+            for key, weight in self.weights:
+                probabilities[rows] += weight * np.asarray(degrees[key], dtype=float)[rows]
+        return probabilities
+
+
+def default_profile(**fields):
+    """The built-in profile of `CONTACT_WEIGHTS` and the TRACE_* settings, unsaved, with fields changed."""
+    profile = ScoringProfile(name=settings.TRACE_SCORING_PROFILE, version=0, weights=json.dumps(CONTACT_WEIGHTS))
+    for name, value in fields.items():
+        setattr(profile, name, value)
+    return CompiledProfile(profile)
+
+
+_compiled_profiles = {}
+
+
+def active_profile():
+    """ Returns the latest version of the TRACE_SCORING_PROFILE profile, compiled once per process and settings.
+
+    Falls back to `default_profile` while no version of it is stored.
+    """
+    profile_id = ScoringProfile.objects.filter(name=settings.TRACE_SCORING_PROFILE).order_by(
+        '-version').values_list('id', flat=True).first()
+    if profile_id is None:
+        return default_profile()
+    key = (profile_id, settings.TRACE_DATE_WINDOW, settings.TRACE_PROXIMITY_RADIUS)
+    if key not in _compiled_profiles:
+        _compiled_profiles[key] = CompiledProfile(ScoringProfile.objects.get(pk=profile_id))
+    return _compiled_profiles[key]
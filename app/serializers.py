@@ -1,9 +1,42 @@
+from collections import OrderedDict, defaultdict
+
 from django.contrib.auth.models import User
+from django.db.models import Prefetch
 from rest_framework import serializers
 from rest_framework.authtoken.models import Token
 
+from app.helpers import chunked
 from app.models import Activity, Organization, Patient, PatientTimeline, PublicTimeline, PotentialContact, Location
 
+# activities are listed in id order, by the serializers and the values serializers alike
+ACTIVITIES_BY_ID = Activity.objects.order_by('id')
+
+
+def prefixed(prefix, lookup):
+    if isinstance(lookup, Prefetch):
+        return Prefetch('%s__%s' % (prefix, lookup.prefetch_through), queryset=lookup.queryset)
+    return '%s__%s' % (prefix, lookup)
+
+
+def related(prefix, serializer_class):
+    """The select_related and prefetch_related plans of serializer_class, for a serializer nesting it in prefix."""
+    return (tuple(prefixed(prefix, field) for field in serializer_class.select_related_fields),
+            tuple(prefixed(prefix, lookup) for lookup in serializer_class.prefetch_related_fields))
+
+
+class EagerLoadingMixin:
+    """ Declares the related rows a serializer reads, so serializing a list takes the same queries for any length.
+
+    select_related_fields are joined in, prefetch_related_fields fetched with one query each. Nested
+    serializers add the plans of the serializers they nest, see `related`.
+    """
+    select_related_fields = ()
+    prefetch_related_fields = ()
+
+    @classmethod
+    def eager_load(cls, queryset):
+        return queryset.select_related(*cls.select_related_fields).prefetch_related(*cls.prefetch_related_fields)
+
 
 class XUserSerializer(serializers.ModelSerializer):
 
@@ -30,20 +63,22 @@ class UserSerializer(serializers.Serializer):
         model = User
 
 
-class ActivitySerializer(serializers.ModelSerializer):
+class ActivitySerializer(EagerLoadingMixin, serializers.ModelSerializer):
 
     class Meta:
         model = Activity
         fields = ('name',)
 
 
-class LocationSerializer(serializers.ModelSerializer):
+class LocationSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     activities = ActivitySerializer(required=False, many=True)
     creator = UserSerializer(required=False)
+    select_related_fields = ('creator',)
+    prefetch_related_fields = (Prefetch('activities', queryset=ACTIVITIES_BY_ID),)
 
     class Meta:
         model = Location
-        fields = ('name', 'place_id', 'activities', 'creator', 'created')
+        fields = ('name', 'place_id', 'latitude', 'longitude', 'activities', 'creator', 'created')
 
 
 class OrganizationSerializer(serializers.ModelSerializer):
@@ -54,39 +89,188 @@ class OrganizationSerializer(serializers.ModelSerializer):
         fields = ('id', 'user', 'name', 'country', 'message', 'created')
 
 
-class PatientSerializer(serializers.ModelSerializer):
+class PatientSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     creator = UserSerializer(required=False)
+    select_related_fields = ('creator',)
 
     class Meta:
         model = Patient
         fields = ('id', 'full_name', 'covid_id', 'nationality', 'state', 'creator', 'created')
 
 
-class PatientTimelineSerializer(serializers.ModelSerializer):
+class PatientTimelineSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     patient = PatientSerializer(required=False)
     location = LocationSerializer(required=False)
     activities = ActivitySerializer(required=False, many=True)
     creator = UserSerializer(required=False)
+    select_related_fields = ('patient', 'location', 'creator') + related('patient', PatientSerializer)[0] \
+        + related('location', LocationSerializer)[0]
+    prefetch_related_fields = (Prefetch('activities', queryset=ACTIVITIES_BY_ID),) \
+        + related('location', LocationSerializer)[1]
 
     class Meta:
         model = PatientTimeline
         fields = ('id', 'patient', 'location', 'time_range', 'date', 'state', 'country', 'activities', 'creator', 'created')
 
 
-class PublicTimelineSerializer(serializers.ModelSerializer):
+class PublicTimelineSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     location = LocationSerializer(required=False)
     activities = ActivitySerializer(required=False, many=True)
+    select_related_fields = ('location',) + related('location', LocationSerializer)[0]
+    prefetch_related_fields = (Prefetch('activities', queryset=ACTIVITIES_BY_ID),) \
+        + related('location', LocationSerializer)[1]
 
     class Meta:
         model = PublicTimeline
         fields = ('id', 'location', 'time_range', 'date', 'state', 'country', 'address', 'email', 'phone_number', 'activities', 'created')
 
 
-class PotentialContactSerializer(serializers.ModelSerializer):
+class PotentialContactSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     patient_timeline = PatientTimelineSerializer(required=False)
     public_timeline = PublicTimelineSerializer(required=False)
     activities = ActivitySerializer(required=False, many=True)
+    select_related_fields = ('patient_timeline', 'public_timeline') \
+        + related('patient_timeline', PatientTimelineSerializer)[0] \
+        + related('public_timeline', PublicTimelineSerializer)[0]
+    prefetch_related_fields = (Prefetch('activities', queryset=ACTIVITIES_BY_ID),) \
+        + related('patient_timeline', PatientTimelineSerializer)[1] \
+        + related('public_timeline', PublicTimelineSerializer)[1]
 
     class Meta:
         model = PotentialContact
         fields = ('id', 'probability', 'activities', 'patient_timeline', 'public_timeline', 'created')
+
+
+# The fast read path of hot list endpoints: the output of the serializers above, byte for byte, built straight
+# from .values() rows instead of a model instance and a serializer per row.
+
+DATETIME_FIELD = serializers.DateTimeField()
+DATE_FIELD = serializers.DateField()
+
+USER_VALUES = ('id', 'username', 'first_name', 'last_name')
+PATIENT_VALUES = ('id', 'full_name', 'covid_id', 'nationality', 'state', 'created') \
+    + tuple('creator__' + field for field in USER_VALUES)
+LOCATION_VALUES = ('id', 'name', 'place_id', 'latitude', 'longitude', 'created') \
+    + tuple('creator__' + field for field in USER_VALUES)
+
+
+def activity_names(model, owner_ids):
+    """Maps the id of each row of model to the names of its `activities`, in id order, with one query per 500 rows."""
+    through = model.activities.through
+    owner = model._meta.model_name + '_id'
+    names = defaultdict(list)
+    for chunk in chunked(set(owner_ids), 500):
+        for owner_id, name in through.objects.filter(**{owner + '__in': chunk}).order_by(
+                owner, 'activity_id').values_list(owner, 'activity__name'):
+            names[owner_id].append(name)
+    return names
+
+
+def activity_values(model, owner_ids):
+    """Maps the id of each row of model to the serialized activities of its `activities`."""
+    return {owner_id: [OrderedDict([('name', name)]) for name in names]
+            for owner_id, names in activity_names(model, owner_ids).items()}
+
+
+def user_values(row, prefix):
+    """`UserSerializer` of the user whose fields are in row under prefix."""
+    if row[prefix + 'id'] is None:
+        return None
+    return OrderedDict((field, row[prefix + field]) for field in ('username', 'first_name', 'last_name'))
+
+
+def location_values(row, prefix, activities):
+    """`LocationSerializer` of the location whose fields are in row under prefix."""
+    latitude, longitude = row[prefix + 'latitude'], row[prefix + 'longitude']
+    return OrderedDict([
+        ('name', row[prefix + 'name']),
+        ('place_id', row[prefix + 'place_id']),
+        ('latitude', None if latitude is None else float(latitude)),
+        ('longitude', None if longitude is None else float(longitude)),
+        ('activities', activities.get(row[prefix + 'id'], [])),
+        ('creator', user_values(row, prefix + 'creator__')),
+        ('created', DATETIME_FIELD.to_representation(row[prefix + 'created'])),
+    ])
+
+
+def patient_values(row, prefix):
+    """`PatientSerializer` of the patient whose fields are in row under prefix."""
+    return OrderedDict([
+        ('id', row[prefix + 'id']),
+        ('full_name', row[prefix + 'full_name']),
+        ('covid_id', row[prefix + 'covid_id']),
+        ('nationality', row[prefix + 'nationality']),
+        ('state', row[prefix + 'state']),
+        ('creator', user_values(row, prefix + 'creator__')),
+        ('created', DATETIME_FIELD.to_representation(row[prefix + 'created'])),
+    ])
+
+
+class ValuesSerializer:
+    """ Serializes many timelines from the .values() rows of `eager_load(queryset)`.
+
+    The activities of the timelines and of their locations take one query each, whatever the number of rows.
+    Subclasses list the values they read and build the output of one row with
+    to_representation(row, activities, location_activities).
+    """
+    model = None
+    values = ()
+
+    def __init__(self, instance, many=True):
+        self.instance = instance
+
+    @classmethod
+    def eager_load(cls, queryset):
+        return queryset.values(*cls.values)
+
+    @property
+    def data(self):
+        rows = list(self.instance)
+        activities = activity_values(self.model, [row['id'] for row in rows])
+        location_activities = activity_values(Location, [row['location__id'] for row in rows])
+        return [self.to_representation(row, activities, location_activities) for row in rows]
+
+
+class PublicTimelineValuesSerializer(ValuesSerializer):
+    """The output of `PublicTimelineSerializer`."""
+    model = PublicTimeline
+    values = ('id', 'time_range', 'date', 'state', 'country', 'address', 'email', 'phone_number', 'created') \
+        + tuple('location__' + field for field in LOCATION_VALUES)
+
+    def to_representation(self, row, activities, location_activities):
+        return OrderedDict([
+            ('id', row['id']),
+            ('location', location_values(row, 'location__', location_activities)),
+            ('time_range', row['time_range']),
+            ('date', DATE_FIELD.to_representation(row['date'])),
+            ('state', row['state']),
+            ('country', row['country']),
+            ('address', row['address']),
+            ('email', row['email']),
+            ('phone_number', row['phone_number']),
+            ('activities', activities.get(row['id'], [])),
+            ('created', DATETIME_FIELD.to_representation(row['created'])),
+        ])
+
+
+class PatientTimelineValuesSerializer(ValuesSerializer):
+    """The output of `PatientTimelineSerializer`."""
+    model = PatientTimeline
+    values = ('id', 'time_range', 'date', 'state', 'country', 'created') \
+        + tuple('patient__' + field for field in PATIENT_VALUES) \
+        + tuple('location__' + field for field in LOCATION_VALUES) \
+        + tuple('creator__' + field for field in USER_VALUES)
+
+    def to_representation(self, row, activities, location_activities):
+        return OrderedDict([
+            ('id', row['id']),
+            ('patient', patient_values(row, 'patient__')),
+            ('location', location_values(row, 'location__', location_activities)),
+            ('time_range', row['time_range']),
+            ('date', DATE_FIELD.to_representation(row['date'])),
+            ('state', row['state']),
+            ('country', row['country']),
+            ('activities', activities.get(row['id'], [])),
+            ('creator', user_values(row, 'creator__')),
+            ('created', DATETIME_FIELD.to_representation(row['created'])),
+        ])
@@ -0,0 +1,270 @@
+""" Keeps derived data in step with the models it is derived from: the activity bitsets of
+timelines and locations, the visited locations index, the data versions of cached trace
+results, interned rows and ETags, the dashboard summaries, and the cached country messages
+and tokens.
+"""
+from collections import Counter, defaultdict
+
+from django.contrib.auth.models import User
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from app.authentication import forget_token, forget_tokens_of
+from app.caching import ACTIVITIES_VERSION, ACTIVITY_LIST_VERSION, LOCATION_DETAILS_VERSION, LOCATIONS_VERSION, \
+    SCORING_PROFILES_VERSION, USERS_VERSION, bump_data_versions, country_version, forget_country_messages, \
+    public_timelines_version
+from app.helpers import activity_bitset, add_or_create, chunked
+from app.interning import check_versions_soon
+from app.models import Activity, Location, Organization, Patient, PatientTimeline, PotentialContact, PublicTimeline, \
+    ScoringProfile, VisitedLocation
+from app.summaries import creator_country, forget_country_summaries, public_timeline_changes, removed_contacts, \
+    update_country_summaries
+
+BITSET_MODELS = (PatientTimeline, PublicTimeline, Location)
+
+
+def update_activity_bits(model, ids):
+    """ Recomputes the activity bitsets of the model rows with these ids, one UPDATE per distinct bitset.
+
+    Returns the bitset of each id.
+    """
+    activities = model._meta.get_field('activities')
+    source = activities.m2m_field_name() + '_id'
+    codes = defaultdict(list)
+    for row_id, code in activities.remote_field.through.objects.filter(**{source + '__in': ids}).values_list(
+            source, activities.m2m_reverse_field_name() + '__code'):
+        codes[row_id].append(code)
+    bitsets = {row_id: activity_bitset(codes[row_id]) for row_id in ids}
+    rows = defaultdict(list)
+    for row_id, bits in bitsets.items():
+        rows[bits].append(row_id)
+    for bits, row_ids in rows.items():
+        for chunk in chunked(row_ids, 500):
+            model.objects.filter(pk__in=chunk).update(activity_bits=bits)
+    return bitsets
+
+
+def activities_changed(sender, instance, action, reverse, model, pk_set, **kwargs):
+    owner = model if reverse else type(instance)
+    if reverse and action == 'pre_clear':
+        # the cleared rows can't be found once the through rows are gone
+        instance._cleared_rows = list(owner.objects.filter(activities=instance).values_list('id', flat=True))
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        if not reverse:
+            ids = [instance.pk]
+            instance.activity_bits = update_activity_bits(owner, ids)[instance.pk]
+        else:
+            ids = instance._cleared_rows if action == 'post_clear' else list(pk_set)
+            update_activity_bits(owner, ids)
+        if owner is PatientTimeline:
+            bump_data_versions(*[country_version(country) for country in
+                                 PatientTimeline.objects.filter(pk__in=ids).values_list('country', flat=True)])
+        elif owner is PublicTimeline:
+            bump_data_versions(public_timelines_version(), *[public_timelines_version(country) for country in
+                               PublicTimeline.objects.filter(pk__in=ids).values_list('country', flat=True)])
+        else:
+            bump_data_versions(LOCATION_DETAILS_VERSION)
+
+
+for bitset_model in BITSET_MODELS:
+    m2m_changed.connect(activities_changed, sender=bitset_model.activities.through)
+
+
+@receiver(pre_delete, sender=Activity)
+def activity_deleting(sender, instance, **kwargs):
+    instance._bitset_rows = {model: list(model.objects.filter(activities=instance).values_list('id', flat=True))
+                             for model in BITSET_MODELS}
+
+
+@receiver(post_delete, sender=Activity)
+def activity_deleted(sender, instance, **kwargs):
+    # the code of the last activity is given to the next one created, so its bit must not linger
+    for model, ids in instance._bitset_rows.items():
+        update_activity_bits(model, ids)
+    bump_data_versions(ACTIVITIES_VERSION, ACTIVITY_LIST_VERSION)
+    check_versions_soon()
+
+
+@receiver(post_save, sender=Activity)
+def activity_saved(sender, instance, created, **kwargs):
+    # traces return the names of matched activities, a new activity isn't matched by anything yet
+    if not created:
+        bump_data_versions(ACTIVITIES_VERSION)
+        check_versions_soon()
+    bump_data_versions(ACTIVITY_LIST_VERSION)
+
+
+def visit_of(timeline):
+    """The (country, state, location_id) a patient timeline is counted under in the visited locations."""
+    return timeline.country or '', timeline.state or '', timeline.location_id
+
+
+def update_visited_locations(changes):
+    """Adds the change in number of timelines to each (country, state, location_id) of changes."""
+    for (country, state, location_id), change in sorted(changes.items()):
+        if change:
+            add_or_create(VisitedLocation, {'country': country, 'state': state, 'location_id': location_id},
+                          timelines=change)
+
+
+@receiver(post_save, sender=Patient)
+def patient_saved(sender, instance, created, **kwargs):
+    if created:
+        update_country_summaries({creator_country(instance.creator_id): {'patients': 1}})
+
+
+@receiver(post_delete, sender=Patient)
+def patient_deleted(sender, instance, **kwargs):
+    update_country_summaries({creator_country(instance.creator_id): {'patients': -1}})
+
+
+@receiver(pre_save, sender=PatientTimeline)
+def patient_timeline_saving(sender, instance, **kwargs):
+    instance._saved_country = None
+    instance._saved_visit = None
+    if not instance._state.adding:
+        saved = PatientTimeline.objects.filter(pk=instance.pk).values_list(
+            'country', 'state', 'location_id').first()
+        if saved is not None:
+            instance._saved_country = saved[0]
+            instance._saved_visit = (saved[0] or '', saved[1] or '', saved[2])
+
+
+@receiver(post_save, sender=PatientTimeline)
+def patient_timeline_saved(sender, instance, created, **kwargs):
+    countries = [instance.country]
+    changes = Counter([visit_of(instance)])
+    if not created:
+        countries.append(instance._saved_country)
+        if instance._saved_visit is not None:
+            changes[instance._saved_visit] -= 1
+    bump_data_versions(*map(country_version, countries))
+    update_visited_locations(changes)
+
+
+@receiver(pre_delete, sender=PatientTimeline)
+def patient_timeline_deleting(sender, instance, **kwargs):
+    # its potential contacts are deleted along
+    update_country_summaries(removed_contacts(PotentialContact.objects.filter(patient_timeline=instance)))
+
+
+@receiver(post_delete, sender=PatientTimeline)
+def patient_timeline_deleted(sender, instance, **kwargs):
+    bump_data_versions(country_version(instance.country))
+    update_visited_locations({visit_of(instance): -1})
+
+
+@receiver(pre_save, sender=PublicTimeline)
+def public_timeline_saving(sender, instance, **kwargs):
+    instance._saved_country = None
+    if not instance._state.adding:
+        instance._saved_country = PublicTimeline.objects.filter(pk=instance.pk).values_list(
+            'country', flat=True).first()
+
+
+@receiver(post_save, sender=PublicTimeline)
+def public_timeline_saved(sender, instance, created, **kwargs):
+    countries = [None, instance.country]
+    if not created:
+        countries.append(instance._saved_country)
+    bump_data_versions(*map(public_timelines_version, countries))
+    if created:
+        update_country_summaries(public_timeline_changes([instance.country]))
+    elif instance._saved_country != instance.country:
+        summaries = public_timeline_changes([instance.country])
+        summaries[instance._saved_country]['public_timelines'] -= 1
+        update_country_summaries(summaries)
+
+
+@receiver(pre_delete, sender=PublicTimeline)
+def public_timeline_deleting(sender, instance, **kwargs):
+    # its potential contacts are deleted along
+    update_country_summaries(removed_contacts(PotentialContact.objects.filter(public_timeline=instance)))
+
+
+@receiver(post_delete, sender=PublicTimeline)
+def public_timeline_deleted(sender, instance, **kwargs):
+    bump_data_versions(public_timelines_version(), public_timelines_version(instance.country))
+    update_country_summaries(public_timeline_changes([instance.country], -1))
+
+
+@receiver(pre_save, sender=Location)
+def location_saving(sender, instance, **kwargs):
+    instance._saved_geohash = instance._saved_key = None
+    if not instance._state.adding:
+        instance._saved_geohash, *instance._saved_key = Location.objects.filter(pk=instance.pk).values_list(
+            'geohash', 'name', 'place_id').first() or (None,)
+
+
+@receiver(post_save, sender=Location)
+def location_saved(sender, instance, created, **kwargs):
+    if created:
+        return
+    bump_data_versions(LOCATION_DETAILS_VERSION)
+    # interned ids are looked up by name and place id
+    if instance._saved_key != [instance.name, instance.place_id]:
+        bump_data_versions(LOCATIONS_VERSION)
+        check_versions_soon()
+    # moving a location changes which visits are near each other, a new one has no visits yet
+    if instance.geohash == instance._saved_geohash:
+        return
+    countries = set(PatientTimeline.objects.filter(location=instance).values_list('country', flat=True))
+    countries.update(PublicTimeline.objects.filter(location=instance).values_list('country', flat=True))
+    bump_data_versions(*map(country_version, countries))
+
+
+@receiver(post_delete, sender=Location)
+def location_deleted(sender, instance, **kwargs):
+    bump_data_versions(LOCATIONS_VERSION, LOCATION_DETAILS_VERSION)
+    check_versions_soon()
+
+
+@receiver(pre_save, sender=Organization)
+def organization_saving(sender, instance, **kwargs):
+    instance._saved_country = None
+    if not instance._state.adding:
+        instance._saved_country = Organization.objects.filter(pk=instance.pk).values_list(
+            'country', flat=True).first()
+
+
+@receiver(post_save, sender=Organization)
+def organization_saved(sender, instance, created, **kwargs):
+    countries = [instance.country]
+    if not created:
+        countries.append(instance._saved_country)
+    forget_country_messages(*countries)
+    forget_tokens_of(instance.user_id)
+    if created or instance._saved_country != instance.country:
+        # the patients of the organization count in its country
+        forget_country_summaries(*countries)
+
+
+@receiver(post_delete, sender=Organization)
+def organization_deleted(sender, instance, **kwargs):
+    forget_country_messages(instance.country)
+    forget_tokens_of(instance.user_id)
+    forget_country_summaries(instance.country)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, **kwargs):
+    # logging in only records the time of the login
+    if kwargs.get('update_fields') != frozenset(['last_login']):
+        bump_data_versions(USERS_VERSION)
+        # country messages serialize the user of the organization
+        forget_country_messages(*Organization.objects.filter(user_id=instance.pk).values_list('country', flat=True))
+        forget_tokens_of(instance.pk)
+
+
+@receiver(post_delete, sender=Token)
+def token_deleted(sender, instance, **kwargs):
+    # rotated when logging in, deleted when logging out
+    forget_token(instance.key)
+
+
+@receiver(post_save, sender=ScoringProfile)
+@receiver(post_delete, sender=ScoringProfile)
+def scoring_profile_changed(sender, instance, **kwargs):
+    bump_data_versions(SCORING_PROFILES_VERSION)
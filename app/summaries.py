@@ -0,0 +1,98 @@
+"""Per country summaries of the dashboard.
+
+A CountrySummary counts the patients of the organizations of a country, their
+potential contacts along with the sum of the contact probabilities, and the
+public timelines of the country. The write and trace paths add their changes
+to the summary rows there are, app.signals for single saves and deletes,
+app.ingestion and app.tracing for the rows they write in bulk.
+
+A country without a summary row is summarized from scratch by the first
+dashboard showing it, with one aggregate query over the organizations'
+patients and contacts. Deleting the row of a country, as moving an
+organization to another country does, makes it be summarized again.
+"""
+from collections import defaultdict
+
+from django.db.models import Count, F, Sum
+
+from app.helpers import chunked
+from app.models import CountrySummary, Organization, PublicTimeline
+
+
+def summarize_country(country):
+    """The fields of the summary of country, counted from scratch."""
+    totals = Organization.objects.filter(country=country).aggregate(
+        patients=Count('user__patient', distinct=True), potential_contacts=Count('user__patient__potentialcontact'),
+        probability_sum=Sum('user__patient__potentialcontact__probability'))
+    return {'patients': totals['patients'], 'potential_contacts': totals['potential_contacts'],
+            'probability_sum': totals['probability_sum'] or 0.0,
+            'public_timelines': PublicTimeline.objects.filter(country=country).count()}
+
+
+def country_summary(country):
+    """Returns the summary of country, summarized when it has none yet."""
+    summary = CountrySummary.objects.filter(country=country).first()
+    if summary is None:
+        # get_or_create returns the summary of another dashboard when it summarized the country at the same time
+        summary, _ = CountrySummary.objects.get_or_create(country=country, defaults=summarize_country(country))
+    return summary
+
+
+def update_country_summaries(changes):
+    """Adds changes, {country: {field: change}}, to the summaries of their countries."""
+    for country, fields in sorted(changes.items(), key=lambda item: str(item[0])):
+        fields = {field: F(field) + change for field, change in fields.items() if change}
+        if country is not None and fields:
+            CountrySummary.objects.filter(country=country).update(**fields)
+
+
+def forget_country_summaries(*countries):
+    """Drops the summaries of countries, they are summarized again when next shown."""
+    CountrySummary.objects.filter(country__in=[country for country in countries if country is not None]).delete()
+
+
+def creator_country(user_id):
+    """The country of the organization of the user, None for users without one."""
+    return Organization.objects.filter(user_id=user_id).values_list('country', flat=True).first()
+
+
+def patient_countries(patient_ids):
+    """Maps each of patient_ids to the country of the organization of its creator."""
+    countries = {}
+    for chunk in chunked(set(patient_ids), 500):
+        countries.update(Organization.objects.filter(user__patient__in=chunk).values_list('user__patient', 'country'))
+    return countries
+
+
+def contact_changes(changes):
+    """ Summary changes of changes to potential contacts, (patient_id, contacts added, probability added) triples.
+
+    Contacts are counted in the country of the organization of their patient's creator.
+    """
+    changes = [change for change in changes if change[1] or change[2]]
+    countries = patient_countries(patient_id for patient_id, _, _ in changes)
+    summaries = defaultdict(lambda: defaultdict(int))
+    for patient_id, contacts, probability in changes:
+        country = countries.get(patient_id)
+        summaries[country]['potential_contacts'] += contacts
+        summaries[country]['probability_sum'] += probability
+    return summaries
+
+
+def removed_contacts(contacts):
+    """Summary changes of deleting the potential contacts of the queryset contacts, read with one query."""
+    summaries = defaultdict(lambda: defaultdict(int))
+    for row in contacts.order_by().values('patient__creator__organization__country').annotate(
+            count=Count('id'), probability=Sum('probability')):
+        country = row['patient__creator__organization__country']
+        summaries[country]['potential_contacts'] -= row['count']
+        summaries[country]['probability_sum'] -= row['probability'] or 0.0
+    return summaries
+
+
+def public_timeline_changes(countries, change=1):
+    """Summary changes of adding change public timelines in each of countries, one per timeline."""
+    summaries = defaultdict(lambda: defaultdict(int))
+    for country in countries:
+        summaries[country]['public_timelines'] += change
+    return summaries
@@ -1,3 +1,1422 @@
-from django.test import TestCase
+import csv
+import datetime
+import gzip
+import io
+import json
+import os
+import random
+import re
+import statistics
+import tempfile
+import time
+from collections import defaultdict
+from unittest import mock, skipIf, skipUnless
 
-# Create your tests here.
+import numpy as np
+from django.conf import settings
+from django.core.cache import caches
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import http_date
+from rest_framework.renderers import JSONRenderer
+
+from app.authentication import reset_token_cache
+from app.caching import ACTIVITIES_VERSION, LRUCache, bump_data_versions, cached_trace, get_trace_cache, \
+    reset_trace_cache
+from app.covid_ids import _reserved, allocate_covid_ids, permute
+from app.ingestion import ingest_patient_timelines, ingest_public_timelines, parse_patient_timeline, read_rows
+from app.interning import get_interners, intern_activities, intern_location, interning_stats, reset_interning
+from app.jobs import HANDLERS, claim_job, enqueue, job_handler, run_job
+from app.helpers import activity_bitset, contact_chance, distance, encode_geohash, geohash_neighbourhood, \
+    parse_time_range, proximity_degree
+from app.models import Activity, CountrySummary, Job, Location, Organization, Patient, PatientTimeline, \
+    PublicTimeline, PotentialContact, RetraceCheckpoint, ScoringProfile, Sequence, TimelineImport, VisitedLocation
+from app.scoring import SCORED_KEYS, active_profile, default_profile
+from app.signals import update_activity_bits
+from app.serializers import PatientTimelineSerializer, PatientTimelineValuesSerializer, PublicTimelineSerializer, \
+    PublicTimelineValuesSerializer
+from app.tracing import IntervalIndex, load_candidates, trace_patient_timeline, trace_public_timeline
+
+
+def create_timelines(seed=19, patient_timelines=300, public_timelines=12):
+    """Fills the database with random timelines crowded into a few states, locations, dates and hours."""
+    rng = random.Random(seed)
+    user = User.objects.create_user(username='cdc@example.com', email='cdc@example.com', password='secret')
+    activities = [Activity.objects.create(name='activity %d' % i) for i in range(6)]
+    locations = [Location.objects.create(name='location %d' % i, place_id='place %d' % i) for i in range(4)]
+    patients = [Patient.objects.create(nationality='Nigerian', state='Lagos', creator=user) for _ in range(5)]
+    first_day = datetime.date(2020, 3, 1)
+
+    def timeline_fields():
+        return {
+            'location': rng.choice(locations),
+            'time_range': rng.choice(['8-9', '9-10', None]),
+            'date': first_day + datetime.timedelta(days=rng.randint(0, 3)),
+            'state': rng.choice(['Lagos', 'Ogun', None]),
+        }
+
+    for _ in range(patient_timelines):
+        timeline = PatientTimeline.objects.create(patient=rng.choice(patients), creator=user,
+                                                  country=rng.choice(['Nigeria', 'Nigeria', 'Ghana']),
+                                                  **timeline_fields())
+        timeline.activities.add(*rng.sample(activities, rng.randint(0, 3)))
+    for _ in range(public_timelines):
+        timeline = PublicTimeline.objects.create(country='Nigeria', **timeline_fields())
+        timeline.activities.add(*rng.sample(activities, rng.randint(0, 3)))
+
+
+def traced_contacts(public_timeline):
+    contacts = PotentialContact.objects.filter(public_timeline=public_timeline).order_by('patient_timeline_id')
+    return [(contact.patient_timeline_id, contact.patient_id, contact.probability,
+             sorted(contact.activities.values_list('id', flat=True))) for contact in contacts]
+
+
+def trace_row_by_row(public_timeline):
+    """ The trace of public_timeline scored one patient timeline at a time with `contact_chance`,
+    as traces were before they were vectorized. Returns the response and the contacts it would write.
+    """
+    activities = set(public_timeline.activities.all())
+    probabilities, matched_activities, contacts = [], set(), []
+    for timeline in PatientTimeline.objects.filter(country=public_timeline.country).order_by('id'):
+        matched = {key for key in ('country', 'state', 'location', 'date', 'time_range')
+                   if getattr(timeline, key) == getattr(public_timeline, key)}
+        shared = [activity for activity in timeline.activities.all() if activity in activities]
+        if shared:
+            matched.add('activity')
+            matched_activities.update(activity.name for activity in shared)
+        probability = contact_chance(matched)
+        probabilities.append(probability)
+        if probability >= 50:
+            contacts.append((timeline.id, timeline.patient_id, probability,
+                             sorted(activity.id for activity in shared)))
+    response = {'average_probability': statistics.mean(probabilities) if probabilities else 0,
+                'top_probability': max(probabilities, default=0), 'possible_contacts': len(contacts),
+                'matched_activities': matched_activities}
+    return response, contacts
+
+
+class CandidatePruningTest(TestCase):
+
+    def setUp(self):
+        create_timelines()
+
+    def test_pruned_trace_matches_full_scan(self):
+        for date_window in (0, 2):
+            for public_timeline in PublicTimeline.objects.all():
+                profile = default_profile(date_window=date_window)
+                full_scan = trace_public_timeline(public_timeline, prune=False, profile=profile)
+                full_scan_contacts = traced_contacts(public_timeline)
+                PotentialContact.objects.filter(public_timeline=public_timeline).delete()
+
+                pruned = trace_public_timeline(public_timeline, profile=profile)
+                self.assertEqual(pruned, full_scan)
+                self.assertEqual(traced_contacts(public_timeline), full_scan_contacts)
+            self.assertTrue(PotentialContact.objects.exists())
+
+    def test_vectorized_trace_matches_row_by_row_scores(self):
+        # exact matches only, the time ranges of create_timelines overlap fully or not at all
+        profile = default_profile(date_window=0, proximity_radius=0)
+        for public_timeline in PublicTimeline.objects.all():
+            response, contacts = trace_row_by_row(public_timeline)
+            self.assertEqual(trace_public_timeline(public_timeline, profile=profile), response)
+            self.assertEqual(traced_contacts(public_timeline), contacts)
+        empty = PublicTimeline.objects.create(country='Togo', date=datetime.date(2020, 3, 1), time_range='8-9',
+                                              location=Location.objects.first())
+        self.assertEqual(trace_public_timeline(empty, profile=profile), trace_row_by_row(empty)[0])
+
+    def test_candidates_loaded_per_date_trace_like_pruned_traces(self):
+        # elsewhere and long before, never candidates of the public timelines
+        user, patient = User.objects.get(), Patient.objects.first()
+        kano = Location.objects.create(name='kano market', place_id='kano market')
+        for day in range(5):
+            PatientTimeline.objects.create(patient=patient, creator=user, location=kano, country='Nigeria',
+                                           state='Kano', date=datetime.date(2019, 1, 1 + day), time_range='8-9')
+        elsewhere = set(PatientTimeline.objects.filter(location=kano).values_list('id', flat=True))
+        for date_window in (0, 2):
+            profile = default_profile(date_window=date_window)
+            for date in PublicTimeline.objects.values_list('date', flat=True).distinct():
+                public_timelines = PublicTimeline.objects.filter(country='Nigeria', date=date).order_by('id')
+                loaded = load_candidates(public_timelines, profile)
+                self.assertFalse(set(loaded[0].ids.tolist()) & elsewhere)
+                for public_timeline in public_timelines:
+                    pruned = trace_public_timeline(public_timeline, profile=profile)
+                    pruned_contacts = traced_contacts(public_timeline)
+                    PotentialContact.objects.filter(public_timeline=public_timeline).delete()
+                    self.assertEqual(trace_public_timeline(public_timeline, profile=profile, loaded=loaded), pruned)
+                    self.assertEqual(traced_contacts(public_timeline), pruned_contacts)
+        self.assertTrue(PotentialContact.objects.exists())
+
+    def test_reverse_trace_matches_forward_trace(self):
+        def contacts():
+            return sorted((contact.patient_timeline_id, contact.public_timeline_id, contact.probability,
+                           tuple(sorted(contact.activities.values_list('id', flat=True))))
+                          for contact in PotentialContact.objects.all())
+
+        for date_window in (0, 2):
+            profile = default_profile(date_window=date_window)
+            for public_timeline in PublicTimeline.objects.all():
+                trace_public_timeline(public_timeline, profile=profile)
+            traced = contacts()
+            PotentialContact.objects.all().delete()
+            found = sum(trace_patient_timeline(patient_timeline, profile=profile)
+                        for patient_timeline in PatientTimeline.objects.all())
+            self.assertTrue(traced)
+            self.assertEqual((contacts(), found), (traced, len(traced)))
+            PotentialContact.objects.all().delete()
+
+
+class ProximityTest(TestCase):
+
+    def test_geohash(self):
+        self.assertEqual(encode_geohash(57.64911, 10.40744, 11), 'u4pruydqqvj')
+
+    def test_neighbourhood_covers_radius(self):
+        rng = random.Random(19)
+        for latitude, longitude in ((6.5244, 3.3792), (-33.9, 179.9995), (64.1, -21.9), (0, 0)):
+            for radius in (5, 50, 500, 5000):
+                cells = geohash_neighbourhood(latitude, longitude, radius)
+                for _ in range(200):
+                    other_latitude = latitude + rng.uniform(-1, 1) * radius / 111000
+                    other_longitude = (longitude + rng.uniform(-1, 1) * radius / 40000 + 180) % 360 - 180
+                    if distance(latitude, longitude, other_latitude, other_longitude) <= radius:
+                        geohash = encode_geohash(other_latitude, other_longitude)
+                        self.assertTrue(any(geohash.startswith(cell) for cell in cells))
+
+    def test_nearby_visit_is_a_contact(self):
+        user = User.objects.create_user(username='cdc@example.com', email='cdc@example.com', password='secret')
+        patient = Patient.objects.create(nationality='Nigerian', state='Lagos', creator=user)
+        market = Location.objects.create(name='market', place_id='market', latitude=6.4541, longitude=3.3947)
+        market_gate = Location.objects.create(name='market gate', place_id='market gate', latitude=6.4543,
+                                              longitude=3.3949)
+        far = Location.objects.create(name='far', place_id='far', latitude=6.5, longitude=3.4)
+        visit = {'date': datetime.date(2020, 3, 1), 'time_range': '8-9', 'country': 'Nigeria'}
+        patient_timeline = PatientTimeline.objects.create(patient=patient, location=market, creator=user, **visit)
+        PatientTimeline.objects.create(patient=patient, location=far, creator=user, **visit)
+        public_timeline = PublicTimeline.objects.create(location=market_gate, state='Lagos', **visit)
+
+        profile = default_profile(proximity_radius=100)
+        self.assertEqual(trace_public_timeline(public_timeline)['possible_contacts'], 0)
+        self.assertEqual(trace_public_timeline(public_timeline, profile=profile)['possible_contacts'], 1)
+        contact = PotentialContact.objects.get(public_timeline=public_timeline)
+        meters = distance(market.latitude, market.longitude, market_gate.latitude, market_gate.longitude)
+        self.assertEqual(contact.patient_timeline, patient_timeline)
+        self.assertEqual(contact.probability, contact_chance({
+            'country': 1, 'date': 1, 'time_range': 1, 'location': proximity_degree(meters, 100)}))
+
+        contact.delete()
+        self.assertEqual(trace_patient_timeline(patient_timeline, profile=profile), 1)
+        self.assertEqual(PotentialContact.objects.get(patient_timeline=patient_timeline).probability,
+                         contact.probability)
+
+
+    def test_only_authenticated_visits_move_locations(self):
+        user = User.objects.create_user(username='cdc@example.com', email='cdc@example.com', password='secret')
+        Organization.objects.create(user=user, name='NCDC', country='Nigeria')
+        patient = Patient.objects.create(nationality='Nigerian', state='Lagos', creator=user)
+        visit = {'location': 'market', 'place_id': 'market', 'date': '2020-03-01', 'time_range': '8-9',
+                 'country': 'Nigeria'}
+
+        def post(url, latitude, longitude):
+            self.client.post(url, dict(visit, latitude=latitude, longitude=longitude))
+            location = Location.objects.get(place_id='market')
+            return location.latitude, location.longitude, location.updated
+
+        public_timelines = reverse('api-public-timelines')
+        located = post(public_timelines, 6.4541, 3.3947)
+        self.assertEqual(located[:2], (6.4541, 3.3947))
+        self.assertEqual(post(public_timelines, 6.5, 3.4), located)
+        self.client.post(reverse('api-public-timelines-batch'), json.dumps([dict(visit, latitude=6.5, longitude=3.4)]),
+                         content_type='application/json')
+        self.assertEqual(post(public_timelines, None, None), located)
+
+        self.client.force_login(user)
+        patient_timelines = reverse('api-patient-timelines', args=[patient.pk])
+        # within the geohash cell of the location
+        self.assertEqual(post(patient_timelines, 6.45411, 3.39471), located)
+        self.assertEqual(post(patient_timelines, 6.5, 3.4)[:2], (6.5, 3.4))
+
+
+class TimeRangeTest(TestCase):
+
+    def test_parse_time_range(self):
+        self.assertEqual(parse_time_range('8-9'), (480, 540))
+        self.assertEqual(parse_time_range('08:30 - 10:00 Hrs'), (510, 600))
+        self.assertEqual(parse_time_range('23-1'), (1380, 1500))
+        self.assertEqual(parse_time_range('22:00-24:00'), (1320, 1440))
+        for time_range in ('', None, 'morning', '9-9', '25-2', '8:75-9', 8, ['8-9']):
+            self.assertEqual(parse_time_range(time_range), (None, None))
+
+    def test_overlap_degrees(self):
+        # visits of rows 0 to 4: 8-9, 8:30-10, 12-13, 23-1 and 0:30-2
+        index = IntervalIndex(np.arange(5), np.array([480, 510, 720, 1380, 30]), np.array([540, 600, 780, 1500, 120]))
+        self.assertEqual(index.overlap_degrees(*parse_time_range('8-9'), size=5).tolist(), [1, 0.5, 0, 0, 0])
+        self.assertEqual(index.overlap_degrees(*parse_time_range('8:30-12:30'), size=5).tolist(), [0.5, 1, 0.5, 0, 0])
+        # ranges crossing midnight match visits on either side of it
+        self.assertEqual(index.overlap_degrees(*parse_time_range('0-1'), size=5).tolist(), [0, 0, 0, 1, 0.5])
+        self.assertEqual(index.overlap_degrees(*parse_time_range('23:30-1:30'), size=5).tolist(),
+                         [0, 0, 0, 90 / 120, 60 / 90])
+
+    def test_unparseable_time_range_is_saved(self):
+        user = User.objects.create_user(username='cdc@example.com')
+        patient = Patient.objects.create(nationality='Nigerian', state='Lagos', creator=user)
+        location = Location.objects.create(name='market', place_id='market')
+        timeline = PatientTimeline.objects.create(patient=patient, location=location, creator=user, country='Nigeria',
+                                                  date=datetime.date(2020, 3, 1), time_range=8)
+        self.assertEqual((timeline.time_start, timeline.time_end), (None, None))
+
+
+class ScoringProfileTest(TestCase):
+
+    def test_table_lookup_matches_contact_chance(self):
+        rng = random.Random(19)
+        rows = [{key: rng.choice([0, 0, 1, 1, rng.random()]) for key in SCORED_KEYS} for _ in range(500)]
+        degrees = {key: [row[key] for row in rows] for key in SCORED_KEYS}
+        self.assertEqual(default_profile().score(degrees, len(rows)).tolist(),
+                         [contact_chance({key: degree for key, degree in row.items() if degree}) for row in rows])
+
+    def test_saving_a_profile_adds_a_version(self):
+        create_timelines(patient_timelines=60, public_timelines=4)
+        first = ScoringProfile.objects.get(name='default')
+        for public_timeline in PublicTimeline.objects.all():
+            trace_public_timeline(public_timeline)
+        self.assertFalse(PotentialContact.objects.exclude(profile=first).exists())
+
+        first.threshold = 30
+        first.save()
+        second = ScoringProfile.objects.get(name='default', version=2)
+        self.assertEqual(ScoringProfile.objects.get(name='default', version=1).threshold, 50)
+        self.assertEqual(active_profile().id, second.pk)
+        public_timeline = PublicTimeline.objects.first()
+        trace_public_timeline(public_timeline)
+        self.assertFalse(PotentialContact.objects.filter(public_timeline=public_timeline).exclude(
+            profile=second).exists())
+
+    # the admin pages link their static files, collected only for deployments
+    @override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_profiles_are_published_from_the_admin(self):
+        admin = User.objects.create_superuser(username='admin', email='admin@example.com', password='secret')
+        self.client.force_login(admin)
+        url = reverse('admin:app_scoringprofile_add')
+        fields = {'name': 'default', 'threshold': 40, 'date_window': 1, 'date_decay': ScoringProfile.FLAT,
+                  'proximity_radius': '', 'proximity_decay': ScoringProfile.LINEAR}
+        for weights in ('', '{"date": 1}', '[["date", "1"]]', '[["date"]]'):
+            response = self.client.post(url, dict(fields, weights=weights))
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('weights', response.context['adminform'].form.errors)
+        response = self.client.post(url, dict(fields, weights='[["country", 20], ["date", 30]]'))
+        self.assertEqual(response.status_code, 302)
+        profile = active_profile()
+        self.assertEqual((profile.version, profile.weights, profile.threshold, profile.date_window),
+                         (2, (('country', 20), ('date', 30)), 40, 1))
+
+    def test_profiles_follow_the_trace_settings_they_leave_empty(self):
+        first = ScoringProfile.objects.get(name='default')
+        self.assertEqual((first.date_window, first.proximity_radius), (None, None))
+        self.assertEqual((active_profile().date_window, active_profile().proximity_radius), (0, 0))
+        with self.settings(TRACE_DATE_WINDOW=2, TRACE_PROXIMITY_RADIUS=100):
+            self.assertEqual((active_profile().id, active_profile().date_window, active_profile().proximity_radius),
+                             (first.pk, 2, 100))
+            first.date_window = 1
+            first.save()
+            self.assertEqual((active_profile().date_window, active_profile().proximity_radius), (1, 100))
+
+
+class PaginationTest(TestCase):
+
+    def setUp(self):
+        create_timelines(patient_timelines=10, public_timelines=23)
+        # rows created at the same time are ordered by id
+        PublicTimeline.objects.filter(id__in=PublicTimeline.objects.order_by('id').values('id')[5:12]).update(
+            created=timezone.now())
+
+    def test_pages_cover_every_row_once(self):
+        url = reverse('api-public-timelines')
+        ids, cursor = [], None
+        while True:
+            params = {'page_size': 5}
+            if cursor:
+                params['cursor'] = cursor
+            data = self.client.get(url, params).json()['data']
+            self.assertLessEqual(len(data['results']), 5)
+            ids += [row['id'] for row in data['results']]
+            cursor = data['next']
+            if cursor is None:
+                break
+        self.assertEqual(ids, list(PublicTimeline.objects.order_by('created', 'id').values_list('id', flat=True)))
+
+    def test_deep_pages_cost_the_same_as_the_first(self):
+        url = reverse('api-activities')
+        first = self.client.get(url, {'page_size': 1}).json()['data']
+        # the data versions of the ETag, then the page
+        with self.assertNumQueries(2):
+            self.client.get(url, {'page_size': 1})
+        with self.assertNumQueries(2):
+            last = self.client.get(url, {'page_size': 1, 'cursor': first['next']}).json()['data']
+        self.assertNotEqual(last['results'], first['results'])
+
+    def test_activities_keep_their_order_by_name(self):
+        for name in ('zumba', 'archery', 'knitting'):
+            activity = Activity.objects.create(name=name)
+            Location.objects.first().activities.add(activity)
+        url = reverse('api-activities')
+        for params in ({}, {'country': 'Nigeria'}):
+            names, cursor = [], None
+            while True:
+                data = self.client.get(url, dict(params, page_size=2, **({'cursor': cursor} if cursor else {})))
+                data = data.json()['data']
+                names += [activity['name'] for activity in data['results']]
+                cursor = data['next']
+                if cursor is None:
+                    break
+            unpaginated = self.client.get(url, dict(params, paginate=0)).json()['data']
+            self.assertEqual(names, [activity['name'] for activity in unpaginated])
+            self.assertEqual(names, sorted(names))
+            self.assertIn('zumba', names)
+
+    def test_unpaginated_responses(self):
+        url = reverse('api-public-timelines')
+        # clients that don't ask for pages get the whole list, as before pagination
+        self.assertEqual(len(self.client.get(url).json()['data']), 23)
+        self.assertEqual(len(self.client.get(url, {'paginate': 0, 'page_size': 5}).json()['data']), 23)
+        self.assertEqual(len(self.client.get(url, {'paginate': 1}).json()['data']['results']), 23)
+        with self.settings(API_PAGINATE=True):
+            self.assertEqual(len(self.client.get(url).json()['data']['results']), 23)
+            self.assertEqual(len(self.client.get(url, {'paginate': 0}).json()['data']), 23)
+        self.assertEqual(self.client.get(url, {'cursor': 'nonsense'}).status_code, 400)
+
+
+class QueryBudgetTest(TestCase):
+    """Every list endpoint and dashboard page takes as many queries for twice the rows."""
+
+    def setUp(self):
+        create_timelines(patient_timelines=40, public_timelines=6)
+        user = User.objects.get()
+        Organization.objects.create(user=user, name='NCDC', country='Nigeria')
+        self.client.force_login(user)
+        self.trace()
+        self.patient_timeline = PatientTimeline.objects.filter(Timeline_of_Patient__isnull=False).first()
+        self.patient = self.patient_timeline.patient
+
+    def trace(self):
+        for public_timeline in PublicTimeline.objects.all():
+            trace_public_timeline(public_timeline, profile=default_profile(threshold=30))
+
+    def double(self):
+        """Copies every timeline, with its activities, and traces the copies too."""
+        for model in (PatientTimeline, PublicTimeline):
+            for timeline in model.objects.all():
+                activities = list(timeline.activities.all())
+                timeline.pk = None
+                timeline.save()
+                timeline.activities.add(*activities)
+        for patient in Patient.objects.all():
+            patient.pk = None
+            patient.save()
+        location = Location.objects.create(name='location copy', place_id='location copy')
+        location.activities.add(*Activity.objects.all())
+        self.trace()
+
+    def urls(self):
+        api = [reverse('api-patients'), reverse('api-patient-timelines', args=[self.patient.pk]),
+               reverse('api-public-timelines'), reverse('api-potentials', args=[self.patient.pk]),
+               reverse('api-activities'), reverse('api-activities') + '?country=Nigeria']
+        dashboard = [reverse('backend-home'), reverse('backend-positive-cases'),
+                     reverse('backend-positive-case', args=[self.patient.pk]),
+                     reverse('backend-timeline-potential-contact', args=[self.patient.pk, self.patient_timeline.pk]),
+                     reverse('backend-potential-cases')]
+        return ([url + ('&' if '?' in url else '?') + 'page_size=1000' for url in api]
+                + [url + ('&' if '?' in url else '?') + 'paginate=0' for url in api] + dashboard)
+
+    def query_counts(self):
+        counts = {}
+        for url in self.urls():
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(self.client.get(url).status_code, 200, url)
+            counts[url] = len(queries)
+        return counts
+
+    def test_queries_do_not_grow_with_rows(self):
+        self.query_counts()  # the first visit of the dashboard summarizes the country
+        counts = self.query_counts()
+        rows = PotentialContact.objects.filter(patient=self.patient).count()
+        self.double()
+        self.assertGreater(PotentialContact.objects.filter(patient=self.patient).count(), rows)
+        self.assertEqual(self.query_counts(), counts)
+
+
+class ValuesSerializerTest(TestCase):
+
+    def setUp(self):
+        create_timelines(patient_timelines=30, public_timelines=20)
+        user = User.objects.get()
+        for location in Location.objects.all()[:2]:
+            location.activities.add(*Activity.objects.all()[:3])
+            location.creator = user
+            location.set_coordinates(6.5, 3.4)
+            location.save()
+        Patient.objects.filter(pk=Patient.objects.first().pk).update(full_name='Ada', covid_id='COVID-1')
+
+    def assert_same_bytes(self, serializer_class, values_serializer_class, queryset):
+        expected = JSONRenderer().render(serializer_class(serializer_class.eager_load(queryset), many=True).data)
+        rendered = JSONRenderer().render(values_serializer_class(values_serializer_class.eager_load(queryset)).data)
+        self.assertEqual(rendered, expected)
+
+    def test_same_output_as_serializers(self):
+        self.assert_same_bytes(PublicTimelineSerializer, PublicTimelineValuesSerializer,
+                               PublicTimeline.objects.order_by('id'))
+        self.assert_same_bytes(PatientTimelineSerializer, PatientTimelineValuesSerializer,
+                               PatientTimeline.objects.order_by('id'))
+        self.assert_same_bytes(PublicTimelineSerializer, PublicTimelineValuesSerializer, PublicTimeline.objects.none())
+
+
+class BatchIngestionTest(TestCase):
+
+    def setUp(self):
+        create_timelines(patient_timelines=60, public_timelines=0)
+
+    def test_batch_of_public_timelines(self):
+        items = [{'location': 'location %d' % (i % 3), 'place_id': 'place %d' % (i % 3), 'country': 'Nigeria',
+                  'state': 'Lagos', 'date': '2020-03-0%d' % (1 + i % 4), 'time_range': '8-9',
+                  'activities': 'activity %d,Dancing' % (i % 6)} for i in range(10)]
+        items[2]['location'], items[2]['place_id'], items[2]['latitude'], items[2]['longitude'] = \
+            'new place', 'new place', 6.45, 3.39
+        items.append({'location': 'location 1', 'place_id': 'place 1', 'date': 'yesterday'})
+        items.append({'location': 'location 1', 'date': '2020-03-01'})
+        items.append({'location': {'name': 'location 1'}, 'place_id': 'place 1', 'date': '2020-03-01'})
+        items.append({'location': 'location 1', 'place_id': 'place 1', 'date': '2020-03-01', 'time_range': 8})
+        response = self.client.post(reverse('api-public-timelines-batch') + '?trace=1', json.dumps(items),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        results = response.json()['data']
+        self.assertEqual([result['status'] for result in results], ['created'] * 10 + ['failed'] * 4)
+
+        self.assertEqual(Activity.objects.filter(name='dancing').count(), 1)
+        self.assertEqual(Location.objects.filter(place_id='new place').get().geohash[:5], encode_geohash(6.45, 3.39, 5))
+        for index, result in enumerate(results[:10]):
+            public_timeline = PublicTimeline.objects.get(pk=result['data']['id'])
+            self.assertEqual((public_timeline.time_start, public_timeline.time_end), (480, 540))
+            self.assertEqual(sorted(activity['name'] for activity in result['data']['activities']),
+                             sorted(['activity %d' % (index % 6), 'dancing']))
+            self.assertEqual(bytes(public_timeline.activity_bits),
+                             update_activity_bits(PublicTimeline, [public_timeline.pk])[public_timeline.pk])
+            self.assertTrue(set(public_timeline.activities.all()) <= set(public_timeline.location.activities.all()))
+            retraced = trace_public_timeline(public_timeline)
+            self.assertEqual(result['trace'], dict(retraced, matched_activities=sorted(retraced['matched_activities'])))
+        for location in Location.objects.all():
+            self.assertEqual(bytes(location.activity_bits), update_activity_bits(Location, [location.pk])[location.pk])
+
+
+class ImportTimelinesTest(TestCase):
+
+    def setUp(self):
+        create_timelines(patient_timelines=30, public_timelines=8)
+        self.user = User.objects.get()
+        Organization.objects.create(user=self.user, name='NCDC', country='Nigeria')
+        self.client.force_login(self.user)
+        reset_trace_cache()
+
+    def tearDown(self):
+        reset_trace_cache()
+
+    @override_settings(IMPORT_CHUNK_SIZE=3)
+    def test_csv_upload(self):
+        other = User.objects.create_user(username='other@example.com', password='secret')
+        other_patient = Patient.objects.create(nationality='Ghanaian', state='Accra', creator=other)
+        patient = Patient.objects.first()
+        public_timeline = PublicTimeline.objects.first()
+        stale = cached_trace(public_timeline)
+        lines = ['patient_id,covid_id,full_name,location,place_id,date,time_range,state,country,activities']
+        for i in range(7):
+            lines.append('%s,%s,,location %d,place %d,2020-03-0%d,8-9,Lagos,Nigeria,"activity %d,swimming"' % (
+                patient.pk if i % 2 else '', '' if i % 2 else 'COVID-%d' % (i % 3), i % 4, i % 4, 1 + i % 4, i % 6))
+        lines.append(',COVID-9,,location 1,place 1,March,8-9,Lagos,Nigeria,')
+        lines.append('%d,,,location 1,place 1,2020-03-01,8-9,Lagos,Nigeria,' % other_patient.pk)
+        upload = SimpleUploadedFile('timelines.csv', '\n'.join(lines).encode())
+        response = self.client.post(reverse('api-import-patient-timelines'), {'file': upload})
+        self.assertEqual(response.status_code, 202)
+        self.assertFalse(PatientTimeline.objects.filter(activities__name='swimming').exists())
+        url = reverse('api-job', args=[response.json()['data']['job_id']])
+        self.assertEqual(self.client.get(url).status_code, 202)
+
+        # the job fails on the third chunk, and is retried from there
+        chunks = []
+
+        def ingest_two_chunks(items, creator):
+            if len(chunks) == 2:
+                raise Interrupted()
+            chunks.append(items)
+            return ingest_patient_timelines(items, creator)
+        with mock.patch('app.ingestion.ingest_patient_timelines', ingest_two_chunks), \
+                self.assertLogs('app.jobs', 'ERROR'):
+            job = run_job(claim_job('test'))
+        self.assertEqual((job.status, TimelineImport.objects.get().line), (Job.PENDING, 7))
+        self.assertEqual(PatientTimeline.objects.filter(activities__name='swimming').count(), 6)
+        # due before the reverse traces of the first chunks
+        Job.objects.filter(pk=job.pk).update(run_after=timezone.now() - datetime.timedelta(days=1))
+        self.assertEqual(run_job(claim_job('test')).status, Job.DONE)
+        self.assertFalse(TimelineImport.objects.exists())
+        response = self.client.get(url)
+        self.assertEqual((response.status_code, response.json()['message']), (200, 'Import complete.'))
+        summary = response.json()['data']
+        self.assertEqual((summary['imported'], summary['failed']), (7, 2))
+        self.assertEqual([error['line'] for error in summary['errors']], [9, 10])
+        self.assertEqual(len(summary['jobs']), 3)
+        self.assertEqual(Patient.objects.filter(covid_id__startswith='COVID-').count(), 3)
+        self.assertEqual(PatientTimeline.objects.filter(activities__name='swimming').count(), 7)
+        for patient_timeline in PatientTimeline.objects.filter(activities__name='swimming'):
+            self.assertEqual(bytes(patient_timeline.activity_bits),
+                             update_activity_bits(PatientTimeline, [patient_timeline.pk])[patient_timeline.pk])
+            self.assertEqual(patient_timeline.creator, self.user)
+        self.assertNotEqual(cached_trace(public_timeline), stale)
+        self.assertEqual(cached_trace(public_timeline), trace_public_timeline(public_timeline))
+
+        PotentialContact.objects.all().delete()
+        while claim_job('test') is not None:
+            run_job(Job.objects.get(status=Job.RUNNING))
+        imported = PotentialContact.objects.filter(patient_timeline__activities__name='swimming')
+        contacts = sorted(imported.values_list('patient_timeline_id', 'public_timeline_id', 'probability'))
+        self.assertTrue(contacts)
+        PotentialContact.objects.all().delete()
+        for patient_timeline in PatientTimeline.objects.filter(activities__name='swimming'):
+            trace_patient_timeline(patient_timeline)
+        self.assertEqual(sorted(imported.values_list('patient_timeline_id', 'public_timeline_id', 'probability')),
+                         contacts)
+
+    def test_ndjson_command(self):
+        rows = [{'covid_id': 'COVID-%d' % i, 'location': 'location 0', 'place_id': 'place 0', 'date': '2020-03-01',
+                 'country': 'Nigeria', 'other_activities': ['Queueing']} for i in range(5)]
+        lines = [json.dumps(row) for row in rows] + ['{not json', '', json.dumps(['a list']),
+                                                     json.dumps(dict(rows[0], location={'name': 'location 0'})),
+                                                     json.dumps(dict(rows[0], time_range=8))]
+        with tempfile.NamedTemporaryFile('w', suffix='.ndjson', delete=False) as f:
+            f.write('\n'.join(lines))
+        self.addCleanup(os.remove, f.name)
+        stdout, stderr = io.StringIO(), io.StringIO()
+        call_command('import_timelines', f.name, '--user', self.user.username, '--chunk-size', '2', stdout=stdout,
+                     stderr=stderr)
+        self.assertEqual(stderr.getvalue().splitlines(),
+                         ['line 6: Invalid JSON.', 'line 8: Expected a timeline object.',
+                          'line 9: location must be a string.', 'line 10: time_range must be a string.'])
+        self.assertIn('Imported 5 patient timelines, 4 rows failed, queued 3 reverse trace jobs.', stdout.getvalue())
+        self.assertTrue(Location.objects.get(place_id='place 0').activities.filter(name='queueing').exists())
+
+
+@override_settings(EXPORT_CHUNK_SIZE=7)
+class ExportTest(TestCase):
+
+    def setUp(self):
+        create_timelines(patient_timelines=40, public_timelines=6)
+        user = User.objects.get()
+        Organization.objects.create(user=user, name='NCDC', country='Nigeria')
+        self.client.force_login(user)
+        for public_timeline in PublicTimeline.objects.all():
+            trace_public_timeline(public_timeline, profile=default_profile(threshold=30))
+        # contacts of another organization's patient are left out
+        other = User.objects.create_user(username='other@example.com')
+        PotentialContact.objects.filter(pk=PotentialContact.objects.first().pk).update(
+            patient=Patient.objects.create(nationality='Ghanaian', state='Accra', creator=other))
+
+    def export(self, name, file_format, **params):
+        response = self.client.get(reverse(name, args=[file_format]), params)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode()
+
+    def test_potential_contacts(self):
+        contacts = PotentialContact.objects.filter(patient__creator__username='cdc@example.com').order_by('id')
+        rows = list(csv.DictReader(io.StringIO(self.export('api-export-potentials', 'csv'))))
+        lines = [json.loads(line) for line in self.export('api-export-potentials', 'ndjson').splitlines()]
+        self.assertGreater(len(rows), 7)
+        self.assertEqual([int(row['id']) for row in rows], list(contacts.values_list('id', flat=True)))
+        self.assertEqual([line['id'] for line in lines], list(contacts.values_list('id', flat=True)))
+        for row, line, contact in zip(rows, lines, contacts):
+            activities = [activity.name for activity in contact.public_timeline.activities.order_by('id')]
+            self.assertEqual(line['public_timeline_activities'], activities)
+            self.assertEqual(row['public_timeline_activities'], ','.join(activities))
+            self.assertEqual(line['probability'], contact.probability)
+            self.assertEqual(line['patient_timeline_location'], contact.patient_timeline.location.name)
+            self.assertEqual(row['public_timeline_date'], contact.public_timeline.date.isoformat())
+
+        patient = contacts[0].patient
+        filtered = self.export('api-export-potentials', 'ndjson', patient=patient.pk, state='Lagos',
+                               date_from='2020-03-02', date_to='2020-03-03', min_probability=40).splitlines()
+        self.assertEqual([json.loads(line)['id'] for line in filtered], list(contacts.filter(
+            patient=patient, public_timeline__state='Lagos', public_timeline__date__range=('2020-03-02', '2020-03-03'),
+            probability__gte=40).values_list('id', flat=True)))
+        url = reverse('api-export-potentials', args=['csv'])
+        self.assertEqual(self.client.get(url, {'date_from': '2 March'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('api-export-potentials', args=['xlsx'])).status_code, 400)
+
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)).decode(),
+                         self.export('api-export-potentials', 'csv'))
+
+    def test_patient_timelines_export_as_imported(self):
+        exported = self.export('api-export-patient-timelines', 'csv', country='Ghana')
+        timelines = PatientTimeline.objects.filter(country='Ghana').order_by('id')
+        rows = [row for _, row in read_rows(io.StringIO(exported), 'csv')]
+        self.assertEqual([int(row['id']) for row in rows], list(timelines.values_list('id', flat=True)))
+        for row, timeline in zip(rows, timelines):
+            parsed = parse_patient_timeline(row)
+            self.assertEqual(parsed['patient'], ('id', timeline.patient_id))
+            self.assertEqual(parsed['location'], (timeline.location.name, timeline.location.place_id))
+            self.assertEqual(parsed['fields']['date'], timeline.date)
+            self.assertEqual(parsed['activities'], [activity.name for activity in timeline.activities.order_by('id')])
+
+
+class VisitedLocationTest(TestCase):
+
+    def setUp(self):
+        create_timelines(patient_timelines=40)
+        self.user = User.objects.get()
+        activities = list(Activity.objects.order_by('id'))
+        for index, location in enumerate(Location.objects.order_by('id')):
+            location.activities.add(*activities[index:index + 2])
+
+    def assert_counted(self):
+        counts = {}
+        for timeline in PatientTimeline.objects.all():
+            visit = (timeline.country or '', timeline.state or '', timeline.location_id)
+            counts[visit] = counts.get(visit, 0) + 1
+        self.assertEqual({(visit.country, visit.state, visit.location_id): visit.timelines
+                          for visit in VisitedLocation.objects.filter(timelines__gt=0)}, counts)
+
+    def test_counts_follow_timelines(self):
+        self.assert_counted()
+        timelines = list(PatientTimeline.objects.order_by('id')[:6])
+        setattr_and_save(timelines[0], country='Ghana', state='Accra')
+        setattr_and_save(timelines[1], location=Location.objects.create(name='new location', place_id='new place'))
+        setattr_and_save(timelines[2], state=None)
+        timelines[3].save()
+        timelines[4].delete()
+        ingest_patient_timelines([{'covid_id': 'COVID-1', 'location': 'location 0', 'place_id': 'place 0',
+                                   'date': '2020-03-01', 'state': 'Lagos', 'country': 'Nigeria'}] * 3, self.user)
+        self.assert_counted()
+
+        for params in ({'country': 'Nigeria'}, {'country': 'Ghana', 'state': 'Accra'}, {'state': 'Ogun'},
+                       {'country': 'Ghana', 'place_id': 'place 3'}):
+            scanned = set()
+            timelines = PatientTimeline.objects.all()
+            if params.get('country'):
+                timelines = timelines.filter(country=params['country'])
+            if params.get('state'):
+                timelines = timelines.filter(state=params['state'])
+            for timeline in timelines:
+                scanned.update(timeline.location.activities.values_list('name', flat=True))
+            if params.get('place_id'):
+                scanned.update(Location.objects.get(place_id=params['place_id']).activities.values_list(
+                    'name', flat=True))
+            data = self.client.get(reverse('api-activities'), dict(params, paginate=0)).json()['data']
+            self.assertTrue(scanned)
+            self.assertEqual([activity['name'] for activity in data], sorted(scanned))
+
+
+class ConditionalGetTest(TestCase):
+
+    def setUp(self):
+        create_timelines(patient_timelines=20, public_timelines=5)
+        self.user = User.objects.get(username='cdc@example.com')
+        Organization.objects.create(user=self.user, name='NCDC', country='Nigeria', message='Stay home')
+
+    def assertNotModified(self, url, etag, **headers):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag, **headers)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(len(queries), 1)  # the data versions, nothing is serialized
+
+    def test_public_timelines(self):
+        url = reverse('api-public-timelines') + '?country=Nigeria'
+        response = self.client.get(url)
+        etag = response['ETag']
+        self.assertTrue(etag.startswith('"'))
+        self.assertTrue(response.has_header('Last-Modified'))
+        self.assertNotModified(url, etag)
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+        self.assertNotEqual(self.client.get(url + '&page_size=2')['ETag'], etag)
+
+        # posted timelines add their activities to their location, which public timelines serialize
+        location = PublicTimeline.objects.first().location
+        location.activities.add(Activity.objects.create(name='swimming'))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertNotModified(url, etag)
+        PublicTimeline.objects.create(country='Ghana', location=location, date=datetime.date(2020, 3, 1))
+        self.assertNotModified(url, etag)
+        PublicTimeline.objects.create(country='Nigeria', location=location, date=datetime.date(2020, 3, 1))
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_activities(self):
+        url = reverse('api-activities')
+        etag = self.client.get(url)['ETag']
+        self.assertNotModified(url, etag)
+        Activity.objects.create(name='swimming')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class CountryMessageTest(TestCase):
+
+    def setUp(self):
+        caches[settings.COUNTRY_MESSAGE_CACHE['ALIAS']].clear()
+        self.user = User.objects.create_user(username='cdc@example.com', password='secret')
+        Organization.objects.create(user=self.user, name='NCDC', country='Nigeria', message='Stay home')
+
+    def get(self, country, **headers):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('api-country-message'), {'country': country}, **headers)
+        return response, len(queries)
+
+    def test_messages_are_cached_until_changed(self):
+        response, _ = self.get('Nigeria')
+        self.assertEqual(response.json()['data']['message'], 'Stay home')
+        cached, queries = self.get('Nigeria')
+        self.assertEqual((cached.json(), cached['ETag'], queries), (response.json(), response['ETag'], 0))
+        response, queries = self.get('Nigeria', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual((response.status_code, queries), (304, 0))
+
+        # the validators come from the generation of the message, which isn't looked up to answer a current copy
+        with mock.patch('app.api_views.cached_country_message', side_effect=AssertionError):
+            for headers in ({'HTTP_IF_NONE_MATCH': cached['ETag']},
+                            {'HTTP_IF_MODIFIED_SINCE': cached['Last-Modified']}):
+                response, queries = self.get('Nigeria', **headers)
+                self.assertEqual((response.status_code, queries), (304, 0))
+        past = http_date(time.time() - 60)
+        self.assertEqual(self.get('Nigeria', HTTP_IF_MODIFIED_SINCE=past)[0].status_code, 200)
+
+        organization = Organization.objects.get(user=self.user)
+        organization.message = 'Wash your hands'
+        organization.save()
+        response, _ = self.get('Nigeria', HTTP_IF_NONE_MATCH=cached['ETag'])
+        self.assertEqual(response.json()['data']['message'], 'Wash your hands')
+        self.assertNotEqual(response['ETag'], cached['ETag'])
+        self.user.first_name = 'Nigeria CDC'
+        self.user.save()
+        response, _ = self.get('Nigeria')
+        self.assertEqual(response.json()['data']['user']['first_name'], 'Nigeria CDC')
+
+        organization.country = 'Ghana'
+        organization.save()
+        self.assertEqual(self.get('Ghana')[0].json()['data']['message'], 'Wash your hands')
+        response, _ = self.get('Nigeria')
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(response.has_header('ETag'))
+        self.assertEqual(self.get('Nigeria')[1], 0)
+
+
+class DashboardSummaryTest(TestCase):
+
+    def setUp(self):
+        create_timelines(patient_timelines=40, public_timelines=6)
+        self.user = User.objects.get()
+        Organization.objects.create(user=self.user, name='NCDC', country='Nigeria')
+        self.client.force_login(self.user)
+
+    def dashboard(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('backend-home'))
+        context = response.context
+        return [context['positive_cases_count'], context['potential_contacts_count'],
+                context['public_timelines_count'], context['average_probability']], len(queries)
+
+    def assert_summarized(self):
+        counts, _ = self.dashboard()
+        contacts = PotentialContact.objects.filter(patient__creator=self.user)
+        probabilities = list(contacts.values_list('probability', flat=True))
+        self.assertEqual(counts[:3], [Patient.objects.filter(creator=self.user).count(), len(probabilities),
+                                      PublicTimeline.objects.filter(country='Nigeria').count()])
+        self.assertAlmostEqual(counts[3], sum(probabilities) / len(probabilities) if probabilities else 0)
+
+    def test_retracing_updates_contacts_in_place(self):
+        def contacts():
+            return {(contact.patient_timeline_id, contact.public_timeline_id): (contact.pk, contact.probability)
+                    for contact in PotentialContact.objects.all()}
+
+        def summary():
+            return CountrySummary.objects.filter(country='Nigeria').values_list(
+                'patients', 'potential_contacts', 'probability_sum', 'public_timelines').get()
+
+        self.assert_summarized()
+        public_timelines = list(PublicTimeline.objects.all())
+        for public_timeline in public_timelines:
+            trace_public_timeline(public_timeline, profile=default_profile(date_window=2))
+        traced, traced_summary = contacts(), summary()
+        activities = sorted(PotentialContact.activities.through.objects.values_list('potentialcontact_id',
+                                                                                    'activity_id'))
+        for public_timeline in public_timelines:
+            trace_public_timeline(public_timeline, profile=default_profile(date_window=2))
+        self.assertEqual(contacts(), traced)
+        self.assertEqual(summary()[:2] + summary()[3:], traced_summary[:2] + traced_summary[3:])
+        self.assertAlmostEqual(summary()[2], traced_summary[2])
+        self.assertEqual(sorted(PotentialContact.activities.through.objects.values_list(
+            'potentialcontact_id', 'activity_id')), activities)
+        self.assert_summarized()
+
+        # a narrower window drops the contacts on other days and scores the others again, on the same rows
+        for public_timeline in public_timelines:
+            trace_public_timeline(public_timeline, profile=default_profile(date_window=0))
+        retraced = contacts()
+        self.assertLess(len(retraced), len(traced))
+        self.assertEqual({key: pk for key, (pk, _) in retraced.items()}, {key: traced[key][0] for key in retraced})
+        self.assertTrue(any(probability != traced[key][1] for key, (_, probability) in retraced.items()))
+        self.assert_summarized()
+        PotentialContact.objects.all().delete()
+        for public_timeline in public_timelines:
+            trace_public_timeline(public_timeline, profile=default_profile(date_window=0))
+        self.assertEqual({key: probability for key, (_, probability) in contacts().items()},
+                         {key: probability for key, (_, probability) in retraced.items()})
+
+    def test_summary_follows_changes(self):
+        self.assert_summarized()
+        for public_timeline in PublicTimeline.objects.all():
+            trace_public_timeline(public_timeline)
+        self.assertTrue(PotentialContact.objects.exists())
+        self.assert_summarized()
+
+        patient_timeline = PatientTimeline.objects.filter(country='Nigeria', Timeline_of_Patient__isnull=False).first()
+        setattr_and_save(patient_timeline, time_range='8-9')
+        trace_patient_timeline(patient_timeline)
+        PublicTimeline.objects.first().delete()
+        patient_timeline.delete()
+        self.client.post(reverse('api-patients'), {'nationality': 'Nigerian', 'state': 'Lagos'})
+        ingest_patient_timelines([{'covid_id': 'COVID-new', 'location': 'location 0', 'place_id': 'place 0',
+                                   'date': '2020-03-01', 'country': 'Nigeria'}], self.user)
+        ingest_public_timelines([{'location': 'location 0', 'place_id': 'place 0', 'date': '2020-03-01',
+                                  'country': 'Nigeria', 'phone_number': '080'}], None)
+        self.assert_summarized()
+
+        _, queries = self.dashboard()
+        Patient.objects.bulk_create([Patient(nationality='Nigerian', state='Lagos', creator=self.user)
+                                     for _ in range(50)])
+        self.assertEqual(self.dashboard()[1], queries)
+        CountrySummary.objects.all().delete()
+        self.assert_summarized()
+
+
+class CovidIdTest(TransactionTestCase):
+    """Runs outside of a test transaction, so reservations commit as they do in requests."""
+
+    def setUp(self):
+        _reserved.clear()  # the block of the process was reserved in a flushed database
+        self.user = User.objects.create_user(username='cdc@example.com', password='secret')
+        Organization.objects.create(user=self.user, name='NCDC', country='Nigeria')
+        self.client.force_login(self.user)
+
+    def test_ids_are_unique_without_a_query_each(self):
+        allocate_covid_ids(1)  # creates the sequence
+        with CaptureQueriesContext(connection) as one:
+            allocate_covid_ids(1)
+        with CaptureQueriesContext(connection) as many:
+            covid_ids = allocate_covid_ids(5000)
+        tables = [re.findall(r'"app_(patient|sequence)"', query['sql'])[:1] for query in many.captured_queries]
+        # one lookup of taken IDs per 500, and the reservation of the next block
+        self.assertEqual(len(one), 1)
+        self.assertEqual((tables.count(['patient']), tables.count(['sequence'])), (10, 2))
+        self.assertEqual(len(set(covid_ids)), 5000)
+        self.assertTrue(all(re.match(r'^COVID-\d{8}$', covid_id) for covid_id in covid_ids))
+        self.assertNotEqual(covid_ids, sorted(covid_ids))
+        self.assertEqual(len({permute(value) for value in range(10 ** 8 - 3000, 10 ** 8)}), 3000)
+
+    def test_patients_get_free_ids(self):
+        url = reverse('api-patients')
+        fields = {'full_name': 'Ada', 'nationality': 'Nigerian', 'state': 'Lagos'}
+        response = self.client.post(url, dict(fields, covid_id='COVID-1'))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.client.post(url, dict(fields, covid_id='COVID-1')).status_code, 400)
+
+        # the next generated ids were given by organizations before
+        other = User.objects.create_user(username='other@example.com')
+        taken = ['COVID-%08d' % permute(value) for value in (0, 1)]
+        Patient.objects.create(covid_id=taken[0], nationality='Nigerian', state='Lagos', creator=self.user)
+        Patient.objects.create(covid_id=taken[1], nationality='Ghanaian', state='Accra', creator=other)
+        covid_ids = [self.client.post(url, fields).json()['data']['covid_id'] for _ in range(3)]
+        self.assertEqual(covid_ids, ['COVID-%08d' % permute(value) for value in (2, 3, 4)])
+        self.assertEqual(Patient.objects.filter(creator=self.user).count(), 5)
+
+    @skipIf(connection.vendor == 'sqlite', "SQLite can't reserve on a second connection during a transaction.")
+    def test_reservations_outlive_rolled_back_transactions(self):
+        with transaction.atomic():
+            covid_ids = allocate_covid_ids(1)
+            transaction.set_rollback(True)
+        self.assertEqual(Sequence.objects.get(name='covid_ids').value, settings.COVID_IDS['BLOCK_SIZE'])
+        with transaction.atomic():
+            with CaptureQueriesContext(connection) as queries:
+                covid_ids += allocate_covid_ids(2)
+            transaction.set_rollback(True)
+        # handed out from the block kept by the process, the lookup of taken IDs is the only query
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(covid_ids, ['COVID-%08d' % permute(value) for value in (0, 1, 2)])
+        self.assertEqual(Sequence.objects.get(name='covid_ids').value, settings.COVID_IDS['BLOCK_SIZE'])
+
+    @skipUnless(connection.vendor == 'sqlite', "Only SQLite reserves in the transaction of the caller.")
+    def test_sqlite_reservations_roll_back(self):
+        with transaction.atomic():
+            covid_ids = allocate_covid_ids(2)
+            self.assertEqual(Sequence.objects.get(name='covid_ids').value, 2)
+            transaction.set_rollback(True)
+        self.assertFalse(Sequence.objects.exists())
+        self.assertEqual(allocate_covid_ids(2), covid_ids)
+        self.assertEqual(Sequence.objects.get(name='covid_ids').value, settings.COVID_IDS['BLOCK_SIZE'])
+
+
+class TokenAuthenticationTest(TestCase):
+
+    def setUp(self):
+        reset_token_cache()
+        self.user = User.objects.create_user(username='cdc@example.com', password='secret')
+        Organization.objects.create(user=self.user, name='NCDC', country='Nigeria')
+
+    def tearDown(self):
+        reset_token_cache()
+
+    def login(self):
+        response = self.client.post(reverse('api-one-auth'), {'username': 'cdc@example.com', 'password': 'secret'})
+        return 'Token ' + response.json()['token']
+
+    def get(self, url, token):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, HTTP_AUTHORIZATION=token)
+        return response, [query['sql'] for query in queries]
+
+    def test_tokens_are_looked_up_once(self):
+        token = self.login()
+        url = reverse('api-patients')
+        response, first = self.get(url, token)
+        self.assertEqual(response.status_code, 200)
+        response, queries = self.get(url, token)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(queries), len(first) - 1)
+        self.assertFalse([sql for sql in queries if 'authtoken_token' in sql or 'app_organization' in sql])
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('api-organization-password'),
+                                        {'old_password': 'secret', 'new_password': 'secret'},
+                                        HTTP_AUTHORIZATION=token)
+        self.assertEqual(response.json()['data']['name'], 'NCDC')
+        # the organization serialized isn't loaded again, saving the user only looks up its country
+        self.assertFalse([query for query in queries if '"app_organization"."message"' in query['sql']])
+
+    def test_changes_are_seen_at_once(self):
+        token = self.login()
+        self.assertEqual(self.get(reverse('api-patients'), token)[0].status_code, 200)
+        new_token = self.login()
+        self.assertEqual(self.get(reverse('api-patients'), token)[0].status_code, 401)
+        self.assertEqual(self.get(reverse('api-patients'), new_token)[0].status_code, 200)
+
+        Organization.objects.filter(user=self.user).get().delete()
+        self.assertEqual(self.get(reverse('api-patients'), new_token)[0].status_code, 403)
+        Organization.objects.create(user=self.user, name='NCDC', country='Nigeria')
+        self.assertEqual(self.get(reverse('api-patients'), new_token)[0].status_code, 200)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.get(reverse('api-patients'), new_token)[0].status_code, 401)
+        self.user.is_active = True
+        self.user.save()
+        self.assertEqual(self.get(reverse('api-logout'), new_token)[0].status_code, 200)
+        self.assertEqual(self.get(reverse('api-patients'), new_token)[0].status_code, 401)
+
+
+@override_settings(INTERNING={'ACTIVITIES_MAX_SIZE': 100, 'LOCATIONS_MAX_SIZE': 100, 'CHECK_INTERVAL': 60,
+                              'REPORT_EVERY': 0})
+class InterningTest(TransactionTestCase):
+    # rows are interned once the transaction reading them commits, which never happens in a TestCase
+
+    def setUp(self):
+        reset_interning()
+
+    def tearDown(self):
+        reset_interning()
+
+    def test_interned_rows_are_not_looked_up_again(self):
+        item = {'location': 'Mall', 'place_id': 'mall', 'country': 'Nigeria', 'date': '2020-03-01',
+                'time_range': '8-9', 'activities': 'Shopping,Eating,'}
+        self.client.post(reverse('api-public-timelines'), item)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('api-public-timelines'), item)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(sorted(activity['name'] for activity in response.json()['data']['activities']),
+                         ['eating', 'shopping'])
+        self.assertEqual([query['sql'] for query in queries.captured_queries
+                          if '"app_activity"."name" IN' in query['sql'] or '"app_location"."place_id" IN' in query['sql']],
+                         [])
+        self.assertEqual(Activity.objects.count(), 2)
+        stats = interning_stats()
+        self.assertEqual((stats['activities']['hits'], stats['activities']['misses']), (2, 2))
+        self.assertEqual(stats['locations']['hit_rate'], 0.5)
+
+    def test_rows_created_meanwhile_are_returned(self):
+        activities, locations = get_interners()
+        running = Activity.objects.create(name='running')
+        mall = Location.objects.create(name='Mall', place_id='mall')
+        self.assertEqual(activities.create(('running',)).pk, running.pk)
+        self.assertEqual(locations.create(('Mall', 'mall')).pk, mall.pk)
+        with self.assertRaises(IntegrityError):
+            locations.create(('Mall', None))
+
+    def test_rolled_back_rows_are_not_interned(self):
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                intern_activities(['walking'])
+                raise ValueError
+        walking = intern_activities(['walking'])['walking']
+        self.assertTrue(Activity.objects.filter(pk=walking.pk).exists())
+
+    def test_changes_clear_interned_rows(self):
+        walking = intern_activities(['walking'])['walking']
+        # renamed by another process, whose signals bump the data version
+        Activity.objects.filter(pk=walking.pk).update(name='strolling')
+        bump_data_versions(ACTIVITIES_VERSION)
+        self.assertEqual(intern_activities(['walking'])['walking'].pk, walking.pk)
+        with override_settings(INTERNING=dict(settings.INTERNING, CHECK_INTERVAL=0)):
+            self.assertNotEqual(intern_activities(['walking'])['walking'].pk, walking.pk)
+
+        mall = intern_location('Mall', 'mall', 6.45, 3.39)
+        self.assertEqual(intern_location('Mall', 'mall').latitude, 6.45)
+        mall.delete()
+        self.assertNotEqual(intern_location('Mall', 'mall').pk, mall.pk)
+
+
+class ActivityBitsTest(TestCase):
+
+    def setUp(self):
+        create_timelines(patient_timelines=60, public_timelines=10)
+
+    def assert_bits_match_activities(self):
+        for model in (PatientTimeline, PublicTimeline, Location):
+            for instance in model.objects.all():
+                self.assertEqual(bytes(instance.activity_bits),
+                                 activity_bitset(instance.activities.values_list('code', flat=True)), instance)
+
+    def test_bits_follow_activity_changes(self):
+        self.assert_bits_match_activities()
+        activities = list(Activity.objects.order_by('code'))
+        self.assertEqual([activity.code for activity in activities], list(range(len(activities))))
+        # past the first 64 codes, so bitsets grow
+        added = [Activity.objects.create(name='added %d' % i) for i in range(70)]
+        last = added[-1]
+        timeline = PatientTimeline.objects.first()
+        changes = [
+            lambda: timeline.activities.add(last, activities[0]),
+            lambda: timeline.activities.remove(activities[0]),
+            lambda: last.Activities_of_Patient.add(*PatientTimeline.objects.all()[:5]),
+            lambda: last.publictimeline_set.add(*PublicTimeline.objects.all()),
+            lambda: last.Activities_of_Patient.remove(timeline),
+            lambda: last.publictimeline_set.clear(),
+            lambda: Location.objects.first().activities.add(last),
+            lambda: timeline.activities.clear(),
+            lambda: timeline.activities.add(last),
+            lambda: activities[2].delete(),
+        ]
+        for change in changes:
+            change()
+            self.assert_bits_match_activities()
+
+    def test_code_of_the_last_activity_is_reused_without_its_bits(self):
+        last = Activity.objects.order_by('code').last()
+        last.Activities_of_Patient.add(*PatientTimeline.objects.all()[:5])
+        last.delete()
+        self.assert_bits_match_activities()
+        reused = Activity.objects.create(name='reused')
+        self.assertEqual(reused.code, last.code)
+        profile = default_profile()
+        for public_timeline in PublicTimeline.objects.all():
+            public_timeline.activities.add(reused)
+            trace_public_timeline(public_timeline, profile=profile)
+        self.assertFalse(PotentialContact.objects.filter(activities=reused).exists())
+
+
+class TraceCacheTest(TestCase):
+
+    def setUp(self):
+        create_timelines(patient_timelines=60, public_timelines=4)
+        reset_trace_cache()
+
+    def tearDown(self):
+        get_trace_cache().clear()
+        reset_trace_cache()
+
+    def test_repeat_trace_is_served_from_cache(self):
+        public_timeline = PublicTimeline.objects.first()
+        response = cached_trace(public_timeline)
+        with self.assertNumQueries(1):
+            self.assertEqual(cached_trace(public_timeline), response)
+        self.assertEqual(get_trace_cache().stats()['hits'], 1)
+
+    def test_lru_evicts_least_recently_used(self):
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+        self.assertEqual(cache.stats(), {'hits': 3, 'misses': 1, 'size': 2, 'max_size': 2})
+
+    def assert_fresh(self):
+        for public_timeline in PublicTimeline.objects.all():
+            cached = cached_trace(public_timeline)
+            self.assertEqual(cached, trace_public_timeline(public_timeline))
+
+    def check_stale_results_are_never_returned(self):
+        rng = random.Random(7)
+        user = User.objects.get()
+        patient = Patient.objects.first()
+        # activities of public timelines, the ones that change their scores
+        activities = list(Activity.objects.filter(publictimeline__isnull=False).distinct())
+        location = Location.objects.first()
+
+        def timeline():
+            return rng.choice(list(PatientTimeline.objects.filter(country='Nigeria')))
+
+        changes = [
+            lambda: PatientTimeline.objects.create(patient=patient, creator=user, location=location, country='Nigeria',
+                                                   date=datetime.date(2020, 3, 1), time_range='8-9', state='Lagos'),
+            lambda: timeline().delete(),
+            lambda: timeline().activities.add(rng.choice(activities)),
+            lambda: timeline().activities.remove(*activities[:3]),
+            lambda: timeline().activities.clear(),
+            lambda: rng.choice(activities).Activities_of_Patient.add(timeline(), timeline()),
+            lambda: rng.choice(activities).Activities_of_Patient.clear(),
+            lambda: PatientTimeline.objects.filter(country='Ghana').first().save(),
+            lambda: setattr_and_save(timeline(), state=rng.choice(['Lagos', 'Ogun', None])),
+            lambda: setattr_and_save(timeline(), country='Ghana'),
+            lambda: setattr_and_save(PatientTimeline.objects.filter(country='Ghana').first(), country='Nigeria'),
+            lambda: PublicTimeline.objects.first().activities.add(rng.choice(activities)),
+            lambda: setattr_and_save(PublicTimeline.objects.last(), state='Ogun'),
+            lambda: setattr_and_save(rng.choice(activities), name='renamed %d' % rng.randint(0, 100)),
+        ]
+        self.assert_fresh()
+        for change in changes + [rng.choice(changes) for _ in range(40)]:
+            change()
+            self.assert_fresh()
+        self.assertGreater(get_trace_cache().hits, 0)
+        Activity.objects.get(pk=activities[-1].pk).delete()
+        self.assert_fresh()
+
+    def test_stale_results_are_never_returned(self):
+        self.check_stale_results_are_never_returned()
+
+    @override_settings(TRACE_CACHE={'BACKEND': 'app.caching.DjangoCache'})
+    def test_stale_results_are_never_returned_from_django_cache(self):
+        self.check_stale_results_are_never_returned()
+
+
+class Interrupted(Exception):
+    pass
+
+
+class RetraceTest(TestCase):
+
+    def setUp(self):
+        create_timelines(patient_timelines=60, public_timelines=12)
+        partitions = defaultdict(list)
+        for pk, country, date in PublicTimeline.objects.order_by('id').values_list('id', 'country', 'date'):
+            partitions[country, date].append(pk)
+        self.partitions = [partitions[key] for key in sorted(partitions)]
+        self.traced = []
+
+    def retrace(self, *args, interrupt_after=None):
+        def trace(public_timeline, **kwargs):
+            if len(self.traced) == interrupt_after:
+                raise Interrupted()
+            self.traced.append(public_timeline.pk)
+            return trace_public_timeline(public_timeline, **kwargs)
+        stdout = io.StringIO()
+        with mock.patch('app.management.commands.retrace.trace_public_timeline', trace):
+            call_command('retrace', '--processes', '1', '--chunk-size', '2', *args, stdout=stdout)
+        return stdout.getvalue()
+
+    def test_interrupted_run_resumes(self):
+        # interrupted on the 4th timeline of a partition, after a checkpoint of its first 2
+        index = next(index for index, pks in enumerate(self.partitions) if len(pks) >= 4)
+        before = sum(len(pks) for pks in self.partitions[:index])
+        with self.assertRaises(Interrupted):
+            self.retrace(interrupt_after=before + 3)
+        checkpoint = RetraceCheckpoint.objects.get(done=False)
+        self.assertEqual((checkpoint.traced, checkpoint.last_public_timeline_id),
+                         (2, self.partitions[index][1]))
+        self.assertEqual(RetraceCheckpoint.objects.filter(done=True).count(), index)
+
+        interrupted, self.traced = self.traced, []
+        output = self.retrace()
+        self.assertIn('%d partitions to retrace, %d already done.' % (len(self.partitions) - index, index), output)
+        # only the timeline traced after the last checkpoint is traced again
+        self.assertEqual(self.traced[0], self.partitions[index][2])
+        self.assertEqual(set(interrupted + self.traced), set(PublicTimeline.objects.values_list('id', flat=True)))
+        self.assertEqual(len(interrupted) + len(self.traced), PublicTimeline.objects.count() + 1)
+        self.assertEqual(sum(RetraceCheckpoint.objects.filter(done=True).values_list('traced', flat=True)),
+                         PublicTimeline.objects.count())
+        self.assertFalse(RetraceCheckpoint.objects.filter(done=False).exists())
+
+    def test_completed_run(self):
+        self.retrace()
+        contacts = {pk: traced_contacts(pk) for pk in self.traced}
+        self.assertEqual(len(self.traced), PublicTimeline.objects.count())
+        self.traced = []
+        output = self.retrace()
+        self.assertIn('0 partitions to retrace, %d already done.' % len(self.partitions), output)
+        self.assertEqual(self.traced, [])
+        output = self.retrace('--restart')
+        self.assertIn('%d partitions to retrace, 0 already done.' % len(self.partitions), output)
+        self.assertEqual(sorted(self.traced), sorted(contacts))
+        self.assertEqual({pk: traced_contacts(pk) for pk in self.traced}, contacts)
+
+
+@override_settings(JOB_MAX_ATTEMPTS=3, JOB_RETRY_DELAY=10, JOB_TIMEOUT=60)
+class JobTest(TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+        @job_handler('flaky')
+        def flaky(fail):
+            self.calls.append(fail)
+            if len(self.calls) <= fail:
+                raise ValueError('attempt %d failed' % len(self.calls))
+            return {'calls': len(self.calls)}
+        self.addCleanup(HANDLERS.pop, 'flaky')
+
+    def run_next(self):
+        job = claim_job('test')
+        return job and run_job(job)
+
+    def make_due(self, job):
+        Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+
+    def test_failed_jobs_are_retried_with_backoff(self):
+        with self.assertLogs('app.jobs', 'ERROR'):
+            job = enqueue('flaky', fail=2)
+            for attempt, delay in ((1, 10), (2, 20)):
+                started = timezone.now()
+                job = self.run_next()
+                self.assertEqual((job.status, job.attempts), (Job.PENDING, attempt))
+                self.assertIn('attempt %d failed' % attempt, job.error)
+                self.assertGreaterEqual(job.run_after, started + datetime.timedelta(seconds=delay))
+                self.assertLess(job.run_after, started + datetime.timedelta(seconds=delay + 5))
+                self.assertIsNone(self.run_next())  # not due yet
+                self.make_due(job)
+            job = self.run_next()
+            self.assertEqual((job.status, job.attempts, json.loads(job.result), job.error),
+                             (Job.DONE, 3, {'calls': 3}, None))
+
+    def test_jobs_fail_after_their_last_attempt(self):
+        with self.assertLogs('app.jobs', 'ERROR'):
+            job = enqueue('flaky', fail=5)
+            for _ in range(2):
+                self.make_due(self.run_next())
+            job = self.run_next()
+            self.assertEqual((job.status, job.attempts, len(self.calls)), (Job.FAILED, 3, 3))
+            self.assertIsNone(self.run_next())
+
+    def test_hopeless_jobs_fail_at_once(self):
+        with self.assertLogs('app.jobs', 'ERROR'):
+            unknown = Job.objects.create(kind='retired', max_attempts=3)
+            deleted = enqueue('trace_public_timeline', public_timeline_id=404)
+            self.assertEqual({self.run_next().pk, self.run_next().pk}, {unknown.pk, deleted.pk})
+            for job in Job.objects.filter(pk__in=[unknown.pk, deleted.pk]):
+                self.assertEqual((job.status, job.attempts), (Job.FAILED, 1))
+            self.assertIn('UnknownJob', Job.objects.get(pk=unknown.pk).error)
+            self.assertIn('DoesNotExist', Job.objects.get(pk=deleted.pk).error)
+
+    def test_abandoned_jobs_are_queued_again(self):
+        job = enqueue('flaky', fail=0)
+        self.assertEqual(claim_job('died').pk, job.pk)
+        self.assertIsNone(claim_job('test'))
+        for attempt in (2, 3):
+            Job.objects.filter(pk=job.pk).update(updated=timezone.now() - datetime.timedelta(seconds=61))
+            job = claim_job('died')
+            self.assertEqual((job.status, job.attempts, job.worker), (Job.RUNNING, attempt, 'died'))
+        # a job that keeps crashing its worker isn't queued again after its last attempt
+        Job.objects.filter(pk=job.pk).update(updated=timezone.now() - datetime.timedelta(seconds=61))
+        self.assertIsNone(claim_job('test'))
+        job = Job.objects.get(pk=job.pk)
+        self.assertEqual((job.status, job.attempts, self.calls), (Job.FAILED, 3, []))
+
+    def test_async_trace(self):
+        create_timelines(patient_timelines=40, public_timelines=1)
+        public_timeline = PublicTimeline.objects.get()
+        response = self.client.get(reverse('api-trace', args=[public_timeline.pk]), {'async': '1'})
+        self.assertEqual(response.status_code, 202)
+        job = response.json()['data']
+        self.assertEqual(job['status'], Job.PENDING)
+        url = reverse('api-job', args=[job['job_id']])
+        self.assertEqual(self.client.get(url).json()['data'], job)
+        self.assertEqual(self.run_next().status, Job.DONE)
+        response = self.client.get(url)
+        self.assertEqual((response.status_code, response.json()['message']), (200, 'Trace complete.'))
+        traced = self.client.get(reverse('api-trace', args=[public_timeline.pk])).json()['data']
+        self.assertEqual(response.json()['data'], dict(traced, matched_activities=sorted(traced['matched_activities'])))
+
+    def test_jobs_are_shown_to_their_creator(self):
+        creator = User.objects.create_user(username='cdc@example.com', password='secret')
+        other = User.objects.create_user(username='other@example.com', password='secret')
+        job = enqueue('flaky', creator=creator, fail=0)
+        anonymous = enqueue('flaky', fail=0)
+        url = reverse('api-job', args=[job.pk])
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.client.force_login(other)
+        self.assertEqual(self.client.get(url).status_code, 404)
+        # only public kinds, such as traces, queued anonymously are shown to anyone
+        self.assertEqual(self.client.get(reverse('api-job', args=[anonymous.pk])).status_code, 404)
+        self.client.force_login(creator)
+        self.assertEqual(self.client.get(url).status_code, 202)
+        self.run_next()
+        response = self.client.get(url)
+        self.assertEqual((response.status_code, response.json()['data']), (200, {'calls': 1}))
+
+    def test_new_patient_timelines_are_reverse_traced(self):
+        create_timelines(patient_timelines=40, public_timelines=6)
+        user = User.objects.get()
+        Organization.objects.create(user=user, name='NCDC', country='Nigeria')
+        self.client.force_login(user)
+        public_timeline = PublicTimeline.objects.filter(state='Lagos').first()
+        patient = Patient.objects.first()
+        response = self.client.post(reverse('api-patient-timelines', args=[patient.pk]), {
+            'location': public_timeline.location.name, 'place_id': public_timeline.location.place_id,
+            'date': public_timeline.date.isoformat(), 'time_range': public_timeline.time_range, 'state': 'Lagos',
+            'country': 'Nigeria', 'activities': ','.join(public_timeline.activities.values_list('name', flat=True))})
+        self.assertEqual(response.status_code, 201)
+        patient_timeline = PatientTimeline.objects.get(pk=response.json()['data']['id'])
+        job = Job.objects.get()
+        self.assertEqual((job.kind, job.creator, json.loads(job.payload)),
+                         ('reverse_trace', user, {'patient_timeline_id': patient_timeline.pk}))
+        self.assertFalse(PotentialContact.objects.filter(patient_timeline=patient_timeline).exists())
+
+        job = self.run_next()
+        contacts = sorted(PotentialContact.objects.filter(patient_timeline=patient_timeline).values_list(
+            'public_timeline_id', 'probability'))
+        self.assertEqual((job.status, json.loads(job.result)), (Job.DONE, {'possible_contacts': len(contacts)}))
+        self.assertIn((public_timeline.pk, 99.9 if public_timeline.activities.exists() else 83.3), contacts)
+        PotentialContact.objects.all().delete()
+        for public_timeline in PublicTimeline.objects.all():
+            trace_public_timeline(public_timeline)
+        self.assertEqual(sorted(PotentialContact.objects.filter(patient_timeline=patient_timeline).values_list(
+            'public_timeline_id', 'probability')), contacts)
+
+    @override_settings(JOB_RETENTION=3600)
+    def test_finished_jobs_are_purged(self):
+        old, recent = timezone.now() - datetime.timedelta(hours=2), timezone.now() - datetime.timedelta(minutes=30)
+        jobs = {(job_status, updated): Job.objects.create(kind='flaky', status=job_status, payload='{"fail": 0}')
+                for job_status in (Job.DONE, Job.FAILED, Job.PENDING) for updated in (old, recent)}
+        for (_, updated), job in jobs.items():
+            Job.objects.filter(pk=job.pk).update(updated=updated, run_after=updated)
+        # files of imports whose job failed
+        user = User.objects.create_user(username='cdc@example.com')
+        imports = [TimelineImport.objects.create(creator=user, format='csv', data=b'') for _ in range(2)]
+        TimelineImport.objects.filter(pk=imports[0].pk).update(updated=old)
+        call_command('run_jobs', '--burst', '--concurrency', '1')
+        self.assertEqual(list(TimelineImport.objects.values_list('id', flat=True)), [imports[1].pk])
+        self.assertEqual(set(Job.objects.values_list('id', 'status')), {
+            (jobs[Job.DONE, recent].pk, Job.DONE), (jobs[Job.FAILED, recent].pk, Job.FAILED),
+            (jobs[Job.PENDING, old].pk, Job.DONE), (jobs[Job.PENDING, recent].pk, Job.DONE)})
+
+
+def setattr_and_save(instance, **fields):
+    for name, value in fields.items():
+        setattr(instance, name, value)
+    instance.save()
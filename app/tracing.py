@@ -0,0 +1,518 @@
+"""Batch contact tracing.
+
+Candidate timelines are loaded once as NumPy columns (interned codes for the
+compared fields, visit minutes and the stored activity bitset of each row) and
+scored against a reference timeline in one vectorized pass using the weights
+of a scoring profile.
+"""
+import datetime
+from collections import defaultdict
+from fractions import Fraction
+
+import numpy as np
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from app.helpers import MINUTES_PER_DAY, activity_bitset, chunked, distance, geohash_neighbourhood, proximity_degree
+from app.models import Activity, Location, PatientTimeline, PotentialContact, PublicTimeline, ScoringProfile
+from app.scoring import SCORED_KEYS, active_profile, default_profile
+from app.summaries import contact_changes, update_country_summaries
+
+TIMELINE_FIELDS = ('id', 'country', 'state', 'location_id', 'date', 'time_range', 'time_start', 'time_end')
+
+# Scored keys the timeline tables index within a country.
+INDEXED_KEYS = ('state', 'location', 'date')
+
+# Stands in for the state of timelines known to match none of the indexed keys.
+UNMATCHED = object()
+
+
+class Interner:
+    """Maps hashable values to dense integer codes."""
+
+    def __init__(self):
+        self.codes = {}
+
+    def encode(self, values):
+        codes = self.codes
+        return np.fromiter((codes.setdefault(value, len(codes)) for value in values), dtype=np.int64,
+                           count=len(values))
+
+    def code(self, value):
+        """Returns the code of value, or -1 if it was never encoded."""
+        return self.codes.get(value, -1)
+
+
+class TimelineColumns:
+    """ Column-oriented copy of a set of timelines, sorted by id.
+
+    Rows keep the 64 bit words of their `activity_bitset` holding activity_codes,
+    or every word when activity_codes is None.
+    """
+
+    def __init__(self, rows, activity_bitsets, activity_codes=None, extra=None):
+        columns = list(zip(*rows)) or [()] * len(TIMELINE_FIELDS)
+        ids, countries, states, locations, dates, time_ranges, time_starts, time_ends = columns
+        count = len(ids)
+        self.ids = np.array(ids, dtype=np.int64)
+        self.country_codes = Interner()
+        self.countries = self.country_codes.encode(countries)
+        self.state_codes = Interner()
+        self.states = self.state_codes.encode(states)
+        self.locations = np.array(locations, dtype=np.int64)
+        self.dates = np.fromiter((day.toordinal() for day in dates), dtype=np.int64, count=count)
+        self.time_range_codes = Interner()
+        self.time_ranges = self.time_range_codes.encode(time_ranges)
+        self.time_starts = np.array([-1 if minute is None else minute for minute in time_starts], dtype=np.int64)
+        self.time_ends = np.array([-1 if minute is None else minute for minute in time_ends], dtype=np.int64)
+        self._visits = None
+        self._days = None
+        self.extra = {name: np.array(values, dtype=np.int64) for name, values in (extra or {}).items()}
+
+        if activity_codes is None:
+            words = range((max((len(bits) for bits in activity_bitsets), default=0) + 7) // 8)
+        else:
+            words = sorted({code // 64 for code in activity_codes})
+        self.activity_words = np.array(words, dtype=np.int64)
+        stride = 8 * len(words)
+        buffer = bytearray(count * stride)
+        for row, bits in enumerate(activity_bitsets):
+            if activity_codes is None:
+                buffer[row * stride:row * stride + len(bits)] = bits
+                continue
+            for i, word in enumerate(words):
+                chunk = bits[8 * word:8 * word + 8]
+                buffer[row * stride + 8 * i:row * stride + 8 * i + len(chunk)] = chunk
+        self.activity_bits = np.frombuffer(buffer, dtype='<u8').astype(np.uint64).reshape(count, len(words))
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def load(cls, timelines, activity_codes=None, extra=()):
+        """Loads a timeline queryset (patient or public) as columns, in one query."""
+        fields = TIMELINE_FIELDS + ('activity_bits',)
+        rows = list(timelines.order_by('id').values_list(*fields + tuple(extra)))
+        columns = {name: [row[len(fields) + i] for row in rows] for i, name in enumerate(extra)}
+        return cls([row[:len(TIMELINE_FIELDS)] for row in rows], [row[len(TIMELINE_FIELDS)] for row in rows],
+                   activity_codes, extra=columns)
+
+    def activity_mask(self, activity_codes):
+        """Returns the bitset row for activity_codes, ignoring the codes of words that were not loaded."""
+        mask = np.zeros(len(self.activity_words), dtype=np.uint64)
+        for code in activity_codes:
+            word = np.searchsorted(self.activity_words, code // 64)
+            if word < len(self.activity_words) and self.activity_words[word] == code // 64:
+                mask[word] |= np.uint64(1) << np.uint64(code % 64)
+        return mask
+
+    @property
+    def visits(self):
+        """The `IntervalIndex` of the rows with a parsed time range, built on first use."""
+        if self._visits is None:
+            rows = np.flatnonzero(self.time_starts >= 0)
+            self._visits = IntervalIndex(rows, self.time_starts[rows], self.time_ends[rows])
+        return self._visits
+
+    @property
+    def days(self):
+        """The `DateIndex` of the rows, built on first use."""
+        if self._days is None:
+            self._days = DateIndex(self.dates)
+        return self._days
+
+    def decode_activities(self, bits):
+        """Returns the activity codes set in a bitset row."""
+        positions = np.flatnonzero(np.unpackbits(bits.view(np.uint8), bitorder='little'))
+        return (self.activity_words[positions // 64] * 64 + positions % 64).tolist()
+
+
+class IntervalIndex:
+    """ Sorted endpoints of a set of visits, given in minutes.
+
+    Visits overlapping a time range are found with binary searches: they start
+    before the range ends and no earlier than the longest visit before it starts.
+    """
+
+    def __init__(self, rows, starts, ends):
+        order = np.argsort(starts, kind='mergesort')
+        self.rows = rows[order]
+        self.starts = starts[order]
+        self.ends = ends[order]
+        self.longest = int((ends - starts).max()) if len(rows) else 0
+
+    def __len__(self):
+        return len(self.rows)
+
+    def overlapping(self, start, end):
+        """Positions, in sorted order, of the visits overlapping [start, end)."""
+        first = np.searchsorted(self.starts, start - self.longest, side='right')
+        last = np.searchsorted(self.starts, end, side='left')
+        return first + np.flatnonzero(self.ends[first:last] > start)
+
+    def overlap_degrees(self, start, end, size):
+        """ Returns, for each of size rows, the share of the shorter visit spent in both.
+
+        Ranges crossing midnight are compared against the previous and next day too.
+        """
+        degrees = np.zeros(size)
+        for shift in (-MINUTES_PER_DAY, 0, MINUTES_PER_DAY):
+            found = self.overlapping(start + shift, end + shift)
+            overlap = np.minimum(self.ends[found], end + shift) - np.maximum(self.starts[found], start + shift)
+            shortest = np.minimum(self.ends[found] - self.starts[found], end - start)
+            rows = self.rows[found]
+            degrees[rows] = np.maximum(degrees[rows], overlap / shortest)
+        return degrees
+
+
+class DateIndex:
+    """Rows sorted by date ordinal, so the rows within a window of days are found with binary searches."""
+
+    def __init__(self, dates):
+        self.rows = np.argsort(dates, kind='mergesort')
+        self.dates = dates[self.rows]
+
+    def within(self, ordinal, window):
+        """Rows dated at most window days away from ordinal."""
+        first = np.searchsorted(self.dates, ordinal - window, side='left')
+        last = np.searchsorted(self.dates, ordinal + window, side='right')
+        return self.rows[first:last]
+
+
+def date_degrees(columns, timeline, window, decay=ScoringProfile.LINEAR):
+    """Scores how close each row's date is to timeline's, from 0 to 1, like `date_degree` for a linear decay."""
+    ordinal = timeline.date.toordinal()
+    degrees = np.zeros(len(columns))
+    rows = columns.days.within(ordinal, window)
+    if decay == ScoringProfile.FLAT:
+        degrees[rows] = 1
+    else:
+        degrees[rows] = 1 - np.abs(columns.dates[rows] - ordinal) / (window + 1)
+    return degrees
+
+
+def nearby_locations(timeline, radius, decay=ScoringProfile.LINEAR):
+    """ Maps the ids of the locations within radius meters of timeline's to how close they are, from 0 to 1.
+
+    Only the locations in the geohash cells around it are measured. The location itself always matches
+    fully, with or without coordinates.
+    """
+    nearby = {timeline.location_id: 1}
+    if not radius:
+        return nearby
+    location = timeline.location
+    if location.geohash is None:
+        return nearby
+    cells = Q()
+    for cell in geohash_neighbourhood(location.latitude, location.longitude, radius):
+        cells |= Q(geohash__startswith=cell)
+    for location_id, latitude, longitude in Location.objects.filter(cells).exclude(pk=location.pk).values_list(
+            'id', 'latitude', 'longitude'):
+        meters = distance(location.latitude, location.longitude, latitude, longitude)
+        degree = proximity_degree(meters, radius)
+        if decay == ScoringProfile.FLAT:
+            degree = int(meters <= radius)
+        if degree > 0:
+            nearby[location_id] = degree
+    return nearby
+
+
+def location_degrees(columns, nearby):
+    """Scores each row's location from the `nearby_locations` of the reference timeline, 0 when not among them."""
+    location_ids = np.array(sorted(nearby), dtype=np.int64)
+    degrees = np.array([nearby[location_id] for location_id in location_ids.tolist()], dtype=float)
+    positions = np.searchsorted(location_ids, columns.locations).clip(max=len(location_ids) - 1)
+    return np.where(location_ids[positions] == columns.locations, degrees[positions], 0)
+
+
+def time_range_degrees(columns, timeline):
+    """ Scores how much each row's time range overlaps timeline's, from 0 to 1.
+
+    Ranges that couldn't be parsed on either side only match the exact same text.
+    """
+    same_text = columns.time_ranges == columns.time_range_codes.code(timeline.time_range)
+    if timeline.time_start is None:
+        return same_text.astype(float)
+    degrees = columns.visits.overlap_degrees(timeline.time_start, timeline.time_end, len(columns))
+    return np.where(columns.time_starts >= 0, degrees, same_text)
+
+
+def score_timelines(columns, timeline, activity_codes, profile=None, nearby=None):
+    """ Scores every row of columns against timeline, whose activities have activity_codes.
+
+    profile, a `CompiledProfile`, defaults to `default_profile`. nearby, from `nearby_locations`,
+    defaults to timeline's location alone.
+
+    Returns the probabilities and the bitsets of the activities each row shares
+    with timeline. Every probability is bit-for-bit what `contact_chance` returns
+    for the same row and the weights of the profile.
+    """
+    profile = profile or default_profile()
+    shared_activities = columns.activity_bits & columns.activity_mask(activity_codes)
+    matches = {
+        'country': lambda: columns.countries == columns.country_codes.code(timeline.country),
+        'state': lambda: columns.states == columns.state_codes.code(timeline.state),
+        'location': lambda: location_degrees(columns, nearby or {timeline.location_id: 1}),
+        'date': lambda: date_degrees(columns, timeline, profile.date_window, profile.date_decay),
+        'time_range': lambda: time_range_degrees(columns, timeline),
+        'activity': lambda: shared_activities.any(axis=1),
+    }
+    degrees = {key: matches[key]() for key, _ in profile.weights}
+    return profile.score(degrees, len(columns)), shared_activities
+
+
+def exact_mean(values, counts):
+    """Same result as `statistics.mean` over values repeated counts times, computed once per distinct value."""
+    distinct, inverse = np.unique(values, return_inverse=True)
+    totals = np.bincount(inverse.reshape(-1), weights=counts, minlength=len(distinct))
+    total = sum(Fraction(float(value)) * int(count) for value, count in zip(distinct, totals))
+    return float(total / int(np.sum(counts)))
+
+
+def candidate_filter(timeline, profile, nearby=None):
+    """ Returns a Q matching every timeline that can still reach the threshold of profile against timeline, or None.
+
+    A timeline that misses all of `INDEXED_KEYS` scores at most the sum of the weights of the other scored keys.
+    When that sum is below the threshold such a timeline can never become a potential contact, so only timelines
+    sharing the state, at one of the nearby locations or dated within the date window need to be fetched.
+    The date window is a range scan of the (country, date) index. Otherwise nothing can be pruned.
+    """
+    return group_candidate_filter([(timeline, nearby or [timeline.location_id])], profile)
+
+
+def group_candidate_filter(timelines, profile):
+    """ The union of the `candidate_filter` of each (timeline, nearby locations) of timelines, or None.
+
+    It takes as many lookups for any number of timelines: their states, their nearby locations and
+    the date windows from the first of their dates to the last.
+    """
+    best_unindexed = 0
+    for key, weight in profile.weights:
+        if key in SCORED_KEYS and key not in INDEXED_KEYS:
+            best_unindexed += max(weight, 0)
+    if best_unindexed >= profile.threshold:
+        return None
+    window = datetime.timedelta(days=profile.date_window)
+    states, locations, dates = set(), set(), set()
+    for timeline, nearby in timelines:
+        states.add(timeline.state)
+        locations.update(nearby)
+        dates.add(timeline.date)
+    if not dates:
+        return Q(pk__in=[])
+    candidates = Q(location_id__in=sorted(locations)) | Q(date__range=(min(dates) - window, max(dates) + window))
+    if None in states:
+        candidates |= Q(state__isnull=True)
+    if states - {None}:
+        candidates |= Q(state__in=sorted(states - {None}))
+    return candidates
+
+
+def summarize_unmatched(timelines, activities):
+    """ Groups timelines matching none of `INDEXED_KEYS` by what they can still match.
+
+    activities maps the codes of the reference timeline's activities to their ids. Returns one
+    column row per group and the number of timelines in each, so the pruned timelines still
+    count towards the averages without being fetched.
+    """
+    group_fields = ('country', 'time_range', 'time_start', 'time_end')
+    totals = timelines.values_list(*group_fields).annotate(count=Count('id'))
+    with_activity = {}
+    if activities:
+        with_activity = dict((group[:-1], group[-1]) for group in timelines.filter(
+            activities__in=list(activities.values())).values_list(*group_fields).annotate(
+            count=Count('id', distinct=True)))
+    rows, activity_bitsets, counts = [], [], []
+    for country, time_range, time_start, time_end, count in totals:
+        shared = with_activity.get((country, time_range, time_start, time_end), 0)
+        for group_count, has_activity in ((count - shared, False), (shared, True)):
+            if group_count:
+                rows.append((len(rows) + 1, country, UNMATCHED, -1, datetime.date.min, time_range, time_start,
+                             time_end))
+                activity_bitsets.append(activity_bitset([min(activities)] if has_activity else []))
+                counts.append(group_count)
+    return TimelineColumns(rows, activity_bitsets, activities), np.array(counts, dtype=np.int64)
+
+
+def save_potential_contacts(traced, potential_contacts, activity_ids):
+    """ Replaces the potential contacts of a traced timeline, in bulk.
+
+    traced filters the contacts the trace recomputed (e.g. public_timeline=...), and activity_ids[i] are the
+    activities of potential_contacts[i]. A pair of timelines traced again keeps its PotentialContact row, with
+    the new probability and activities, and pairs that no longer reach the threshold are removed.
+    """
+    try:
+        with transaction.atomic():
+            _upsert_potential_contacts(traced, potential_contacts, activity_ids)
+    except IntegrityError:
+        # a concurrent trace inserted some of the same pairs first, they are updated this time
+        with transaction.atomic():
+            _upsert_potential_contacts(traced, potential_contacts, activity_ids)
+
+
+def _upsert_potential_contacts(traced, potential_contacts, activity_ids):
+    existing = {(patient_timeline_id, public_timeline_id): (pk, probability, patient_id)
+                for pk, patient_timeline_id, public_timeline_id, probability, patient_id
+                in PotentialContact.objects.filter(**traced).values_list(
+                    'id', 'patient_timeline_id', 'public_timeline_id', 'probability', 'patient_id')}
+    updated = defaultdict(list)
+    created = []
+    summary_changes = []  # (patient_id, contacts added, probability added) for the dashboard summaries
+    for potential_contact in potential_contacts:
+        pk, probability, _ = existing.pop((potential_contact.patient_timeline_id,
+                                           potential_contact.public_timeline_id), (None, 0.0, None))
+        potential_contact.pk = pk
+        if potential_contact.pk is None:
+            created.append(potential_contact)
+        else:
+            updated[potential_contact.probability, potential_contact.profile_id].append(potential_contact.pk)
+        summary_changes.append((potential_contact.patient_id, int(pk is None),
+                                potential_contact.probability - probability))
+    summary_changes.extend((patient_id, -1, -probability) for _, probability, patient_id in existing.values())
+    update_country_summaries(contact_changes(summary_changes))
+    for (probability, profile_id), pks in updated.items():
+        for chunk in chunked(pks, 500):
+            PotentialContact.objects.filter(pk__in=chunk).update(probability=probability, profile_id=profile_id,
+                                                                  updated=timezone.now())
+    for chunk in chunked([pk for pk, _, _ in existing.values()], 500):
+        PotentialContact.objects.filter(pk__in=chunk).delete()
+    PotentialContact.objects.bulk_create(created, batch_size=500)
+    if created and created[0].pk is None:
+        # only PostgreSQL returns the keys of a bulk insert, elsewhere they are read back by timeline pair
+        inserted = {(patient_timeline_id, public_timeline_id): pk for pk, patient_timeline_id, public_timeline_id
+                    in PotentialContact.objects.filter(**traced).values_list('id', 'patient_timeline_id',
+                                                                              'public_timeline_id')}
+        for potential_contact in created:
+            potential_contact.pk = inserted[(potential_contact.patient_timeline_id,
+                                             potential_contact.public_timeline_id)]
+
+    through = PotentialContact.activities.through
+    for chunk in chunked([pk for pks in updated.values() for pk in pks], 500):
+        through.objects.filter(potentialcontact_id__in=chunk).delete()
+    through.objects.bulk_create([through(potentialcontact_id=potential_contact.pk, activity_id=activity_id)
+                                 for potential_contact, activities in zip(potential_contacts, activity_ids)
+                                 for activity_id in activities], batch_size=500)
+
+
+def load_candidates(public_timelines, profile=None):
+    """ Loads the candidates of public timelines of one country, for tracing each of them in turn.
+
+    The patient timelines kept by the `group_candidate_filter` of public_timelines are loaded once,
+    with all their activity bits. Returns them as columns along with the filter, which is None when
+    the profile can't prune and the country's every patient timeline was loaded. The columns keep
+    about 100 bytes per timeline, plus 8 per 64 activities, and reading the rows peaks at about 800
+    bytes per timeline, so memory follows the candidates of the group rather than the whole table.
+    """
+    profile = profile or active_profile()
+    country = None
+    timelines = []
+    for public_timeline in public_timelines.select_related('location').iterator():
+        country = public_timeline.country
+        timelines.append((public_timeline, nearby_locations(public_timeline, profile.proximity_radius,
+                                                            profile.proximity_decay)))
+    candidates = group_candidate_filter(timelines, profile)
+    patient_timelines = PatientTimeline.objects.filter(country=country)
+    if candidates is not None:
+        patient_timelines = patient_timelines.filter(candidates)
+    return TimelineColumns.load(patient_timelines, extra=('patient_id',)), candidates
+
+
+def trace_public_timeline(public_timeline, prune=True, profile=None, loaded=None):
+    """ Scores every patient timeline in the public timeline's country and records likely contacts.
+
+    With prune, only the timelines `candidate_filter` keeps are fetched and scored one by one; the
+    rest are scored per group by `summarize_unmatched`. loaded, the columns and filter returned by
+    `load_candidates` for public timelines including this one, skips fetching the candidates.
+    profile defaults to the `active_profile`. Returns the response data of the trace endpoint.
+    """
+    profile = profile or active_profile()
+    nearby = nearby_locations(public_timeline, profile.proximity_radius, profile.proximity_decay)
+    activities = dict(public_timeline.activities.values_list('code', 'id'))
+    patient_timelines = PatientTimeline.objects.filter(country=public_timeline.country)
+    columns = candidates = None
+    if loaded is not None:
+        columns, candidates = loaded
+    elif prune:
+        candidates = candidate_filter(public_timeline, profile, nearby)
+    if candidates is not None:
+        others, other_counts = summarize_unmatched(patient_timelines.exclude(candidates), activities)
+        patient_timelines = patient_timelines.filter(candidates)
+    if columns is None:
+        columns = TimelineColumns.load(patient_timelines, activities, extra=('patient_id',))
+    probabilities, shared_activities = score_timelines(columns, public_timeline, activities, profile, nearby)
+    counts = np.ones(len(probabilities), dtype=np.int64)
+    if candidates is not None:
+        other_probabilities, _ = score_timelines(others, public_timeline, activities, profile, nearby)
+        probabilities = np.concatenate([probabilities, other_probabilities])
+        counts = np.concatenate([counts, other_counts])
+
+    contacts = np.flatnonzero(probabilities[:len(columns)] >= profile.threshold).tolist()
+    save_potential_contacts(
+        {'public_timeline': public_timeline},
+        [PotentialContact(public_timeline=public_timeline, probability=float(probabilities[row]),
+                          patient_timeline_id=int(columns.ids[row]), patient_id=int(columns.extra['patient_id'][row]),
+                          profile_id=profile.id)
+         for row in contacts],
+        [[activities[code] for code in columns.decode_activities(shared_activities[row])] for row in contacts])
+
+    matched_activities = Activity.objects.filter(id__in=list(activities.values()),
+                                                 Activities_of_Patient__country=public_timeline.country)
+    matched_activities = set(matched_activities.values_list('name', flat=True))
+    top_probability = 0
+    chance = 0
+    if len(probabilities) > 0:
+        top_probability = float(probabilities.max())
+        chance = exact_mean(probabilities, counts)
+    return {
+        'average_probability': chance,
+        'top_probability': top_probability,
+        'possible_contacts': len(contacts),
+        'matched_activities': matched_activities
+    }
+
+
+def trace_patient_timeline(patient_timeline, profile=None):
+    """ Scores every public timeline in the patient timeline's country against it and records likely contacts.
+
+    The reverse of `trace_public_timeline`, with the same scores for the same pair of timelines.
+    Returns the number of potential contacts found.
+    """
+    profile = profile or active_profile()
+    nearby = nearby_locations(patient_timeline, profile.proximity_radius, profile.proximity_decay)
+    activities = dict(patient_timeline.activities.values_list('code', 'id'))
+    public_timelines = PublicTimeline.objects.filter(country=patient_timeline.country)
+    candidates = candidate_filter(patient_timeline, profile, nearby)
+    if candidates is not None:
+        public_timelines = public_timelines.filter(candidates)
+    columns = TimelineColumns.load(public_timelines, activities)
+    probabilities, shared_activities = score_timelines(columns, patient_timeline, activities, profile, nearby)
+
+    contacts = np.flatnonzero(probabilities >= profile.threshold).tolist()
+    save_potential_contacts(
+        {'patient_timeline': patient_timeline},
+        [PotentialContact(patient_timeline=patient_timeline, public_timeline_id=int(columns.ids[row]),
+                          patient_id=patient_timeline.patient_id, probability=float(probabilities[row]),
+                          profile_id=profile.id)
+         for row in contacts],
+        [[activities[code] for code in columns.decode_activities(shared_activities[row])] for row in contacts])
+    return len(contacts)
+
+
+def reverse_trace(patient_timeline_id):
+    """Traces a just created patient timeline, unless it was deleted since."""
+    try:
+        patient_timeline = PatientTimeline.objects.get(pk=patient_timeline_id)
+    except PatientTimeline.DoesNotExist:
+        return 0
+    return trace_patient_timeline(patient_timeline)
+
+
+def reverse_trace_many(patient_timeline_ids):
+    """Traces a batch of just created patient timelines with the same profile, skipping those deleted since."""
+    profile = active_profile()
+    found = 0
+    for chunk in chunked(patient_timeline_ids, 500):
+        for patient_timeline in PatientTimeline.objects.filter(pk__in=chunk):
+            found += trace_patient_timeline(patient_timeline, profile)
+    return found
@@ -1,15 +1,20 @@
 import datetime
-import statistics
-from statistics import mean
 
+from django.conf import settings
 from django.contrib.auth import login, authenticate, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
+from django.db import IntegrityError
 from django.http import HttpResponseRedirect
 from django.shortcuts import render
 
-from app.helpers import random_illustration, validate_email, generate_covid_id
-from app.models import Organization, Patient, PotentialContact, PublicTimeline, PatientTimeline, Location, Activity
+from app.covid_ids import save_patient
+from app.helpers import random_illustration, validate_email
+from app.ingestion import parse_activity_names
+from app.interning import intern_activities, intern_location
+from app.models import Organization, Patient, PotentialContact, PatientTimeline
+from app.jobs import enqueue
+from app.summaries import country_summary
 
 
 def show_home(request):
@@ -89,33 +94,17 @@ def show_login(request):
 def show_dashboard(request):
     if request.method == 'GET':
         organization = Organization.objects.get(user=request.user)
-        positive_cases_all = []
-        all_orgs = Organization.objects.all()
-        for orgs in all_orgs:
-            if orgs.country == organization.country:
-                positive_cases = Patient.objects.filter(creator=orgs.user)
-                positive_cases_all.extend(positive_cases)
-        potential_contacts_all = []
-        for positive_case in positive_cases_all:
-            potential_contacts = PotentialContact.objects.filter(patient=positive_case)
-            potential_contacts_all.extend(potential_contacts)
-        public_timelines = PublicTimeline.objects.filter(country=organization.country)
-        probabilities = []
-        average_probability = 0
-        for potential_contact in potential_contacts_all:
-            probabilities.append(potential_contact.probability)
-        try:
-            average_probability = mean(probabilities)
-        except statistics.StatisticsError:
-            average_probability = 0
+        summary = country_summary(organization.country)
+        # the latest cases of every organization of the country
+        positive_cases = Patient.objects.filter(creator__organization__country=organization.country).order_by(
+            '-created', '-id')[:settings.DASHBOARD_CASES]
         c = {
             'organization': organization,
-            'positive_cases': positive_cases_all,
-            'positive_cases_count': len(positive_cases_all),
-            'potential_contacts': potential_contacts_all,
-            'potential_contacts_count': len(potential_contacts_all),
-            'public_timelines': public_timelines,
-            'average_probability': average_probability,
+            'positive_cases': positive_cases,
+            'positive_cases_count': summary.patients,
+            'potential_contacts_count': summary.potential_contacts,
+            'public_timelines_count': summary.public_timelines,
+            'average_probability': summary.average_probability,
             'active_tab': 'dashboard'
         }
         return render(request, 'backend/dashboard.html', c)
@@ -131,12 +120,16 @@ def show_positive_cases(request):
             msg = 'Patient Created Successfully'
         elif request.GET.get('msg') == '2':
             msg = 'Patient Deleted Successfully'
+        errors = None
+        if request.GET.get('errors') == '1':
+            errors = 'A case with this COVID ID already exists.'
         organization = Organization.objects.get(user=request.user)
         positive_cases = Patient.objects.filter(creator=request.user)
         c = {
             'organization': organization,
             'positive_cases': positive_cases,
             'msg': msg,
+            'errors': errors,
             'active_tab': 'positive_cases'
         }
         return render(request, 'backend/positive_cases.html', c)
@@ -145,7 +138,7 @@ def show_positive_cases(request):
             full_name = request.POST.get('full_name', None)
             covid_id = request.POST.get('covid_id', None)
             if len(covid_id.strip()) < 1:
-                covid_id = generate_covid_id()
+                covid_id = None  # generated by save_patient
             else:
                 covid_id = 'COVID-' + covid_id
             nationality = request.POST.get('nationality').capitalize()
@@ -153,7 +146,10 @@ def show_positive_cases(request):
             creator = request.user
             patient = Patient(full_name=full_name, covid_id=covid_id, nationality=nationality, state=state,
                               creator=creator)
-            patient.save()
+            try:
+                save_patient(patient)
+            except IntegrityError:
+                return HttpResponseRedirect('/positive-cases?errors=1')
             return HttpResponseRedirect('/positive-cases?msg=1')
         elif request.POST.get('delete_case'):
             patient = Patient.objects.get(pk=int(request.POST.get('delete_case')))
@@ -176,8 +172,9 @@ def show_positive_case(request, positive_case_id):
         elif request.GET.get('msg') == '2':
             msg = 'Timeline Deleted Successfully'
         organization = Organization.objects.get(user=request.user)
-        potential_contacts = PotentialContact.objects.filter(patient=positive_case)
-        patient_timelines = PatientTimeline.objects.filter(patient=positive_case)
+        potential_contacts = PotentialContact.objects.filter(patient=positive_case).select_related('public_timeline')
+        patient_timelines = PatientTimeline.objects.filter(patient=positive_case).select_related(
+            'location').prefetch_related('activities')
         c = {
             'organization': organization,
             'positive_case': positive_case,
@@ -195,28 +192,20 @@ def show_positive_case(request, positive_case_id):
             state = request.POST.get('state')
             country = request.POST.get('country')
             creator = request.user
-            location, _ = Location.objects.get_or_create(name=request.POST.get('location'),
-                                                         place_id=request.POST.get('place_id'))
+            location = intern_location(request.POST.get('location'), request.POST.get('place_id'),
+                                       request.POST.get('latitude'), request.POST.get('longitude'), move=True)
             patient_timeline = PatientTimeline(patient=positive_case, location=location, time_range=time_range,
                                                date=timeline_date, country=country, state=state, creator=creator)
             patient_timeline.save()
-            activities = request.POST.get('activities', '').split(',')  # received as a comma separated string
-            print(activities)
-            for activity in activities:
-                try:
-                    act = Activity.objects.get(name=activity.lower())
-                except Activity.DoesNotExist:
-                    act = Activity.objects.create(name=activity.lower(), creator=request.user)
-                patient_timeline.activities.add(act)
-                location.activities.add(act)
-            other_activities = request.POST.get('other_activities', '').split(',')  # received as comma separated string
-            print(other_activities)
-            for activity in other_activities:
-                try:
-                    act = Activity.objects.get(name=activity.lower())
-                except Activity.DoesNotExist:
-                    act = Activity.objects.create(name=activity.lower(), creator=request.user)
-                location.activities.add(act)
+            # received as comma separated strings
+            activities = parse_activity_names(request.POST.get('activities'))
+            other_activities = parse_activity_names(request.POST.get('other_activities'))
+            interned = intern_activities(activities + other_activities, creator=request.user)
+            if activities:
+                patient_timeline.activities.add(*[interned[name] for name in activities])
+            if interned:
+                location.activities.add(*interned.values())
+            enqueue('reverse_trace', creator=creator, patient_timeline_id=patient_timeline.pk)
             return HttpResponseRedirect('/positive-cases/' + str(positive_case_id) + '/?msg=1')
         elif request.POST.get('delete_timeline'):
             patient_timeline = PatientTimeline.objects.get(pk=int(request.POST.get('delete_timeline')))
@@ -240,7 +229,8 @@ def show_timeline_potential_contacts(request, positive_case_id, timeline_id):
     except PotentialContact.DoesNotExist:
         return HttpResponseRedirect('/positive-cases/')
     if request.method == 'GET':
-        potential_contacts = PotentialContact.objects.filter(patient_timeline=patient_timeline)
+        potential_contacts = PotentialContact.objects.filter(patient_timeline=patient_timeline).select_related(
+            'public_timeline')
         c = {
             'organization': organization,
             'potential_contacts': potential_contacts,
@@ -253,11 +243,8 @@ def show_timeline_potential_contacts(request, positive_case_id, timeline_id):
 def show_potential_contacts(request):
     if request.method == 'GET':
         organization = Organization.objects.get(user=request.user)
-        positive_cases = Patient.objects.filter(creator=request.user)
-        potential_contacts_all = []
-        for positive_case in positive_cases:
-            potential_contacts = PotentialContact.objects.filter(patient=positive_case)
-            potential_contacts_all.extend(potential_contacts)
+        potential_contacts_all = list(PotentialContact.objects.filter(patient__creator=request.user).select_related(
+            'patient', 'public_timeline').order_by('patient', 'id'))
         c = {
             'organization': organization,
             'potential_contacts': potential_contacts_all,
@@ -270,7 +257,8 @@ def show_potential_contacts(request):
 def show_positive_potential_contact(request, potential_contact_id):
     organization = Organization.objects.get(user=request.user)
     try:
-        potential_contact = PotentialContact.objects.get(pk=int(potential_contact_id))
+        potential_contact = PotentialContact.objects.select_related(
+            'patient', 'patient_timeline__location', 'public_timeline__location').get(pk=int(potential_contact_id))
         if potential_contact.public_timeline.country != organization.country:
             return HttpResponseRedirect('/potential-contacts/')
     except PotentialContact.DoesNotExist:
@@ -73,7 +73,7 @@ MIDDLEWARE = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework.authentication.TokenAuthentication',
+        'app.authentication.CachedTokenAuthentication',
         'rest_framework.authentication.SessionAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': (
@@ -154,3 +154,70 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 STATICFILES_STORAGE = 'whitenoise.django.GzipManifestStaticFilesStorage'
+
+# List endpoints
+
+# Whether list endpoints respond with pages to clients that don't ask, with ?paginate=1, ?cursor= or ?page_size=.
+# Off by default, for clients expecting the whole list in one response.
+API_PAGINATE = os.environ.get('API_PAGINATE', 'false').lower() in ('1', 'true', 'yes')
+API_PAGE_SIZE = 100  # rows per page unless the client asks for ?page_size=
+API_MAX_PAGE_SIZE = 1000
+API_MAX_BATCH_SIZE = 500  # timelines a batch endpoint accepts in one request
+IMPORT_CHUNK_SIZE = 1000  # rows of an imported file written per transaction
+IMPORT_MAX_REPORTED_ERRORS = 100  # invalid rows listed in the response of the import endpoint
+EXPORT_CHUNK_SIZE = 2000  # rows an export reads from the database and writes out at a time
+
+# Background jobs, run by `python manage.py run_jobs`
+
+JOB_CONCURRENCY = int(os.environ.get('JOB_CONCURRENCY', '2'))
+JOB_MAX_ATTEMPTS = 5
+JOB_RETRY_DELAY = 10  # seconds before the first retry, doubled after every failed attempt
+JOB_TIMEOUT = 15 * 60  # seconds after which a running job is considered abandoned and queued again
+JOB_RETENTION = 7 * 24 * 60 * 60  # seconds done and failed jobs are kept for, run_jobs deletes them afterwards
+
+# Contact tracing
+
+# Name of the ScoringProfile traces use, its latest version. Until one is stored, the built-in profile scores
+# with CONTACT_WEIGHTS and the two settings below. They also apply to the profiles leaving their date_window or
+# proximity_radius empty, as the one migrations store does. Contacts scored before a change keep their
+# probabilities until `manage.py retrace` scores them again.
+TRACE_SCORING_PROFILE = os.environ.get('TRACE_SCORING_PROFILE', 'default')
+# Days apart two visits still count towards a date match, for less each day. 0 only matches the same date.
+TRACE_DATE_WINDOW = int(os.environ.get('TRACE_DATE_WINDOW', '0'))
+# Meters apart two locations with coordinates still count towards a location match, for less the further
+# apart they are. 0 only matches the same location.
+TRACE_PROXIMITY_RADIUS = float(os.environ.get('TRACE_PROXIMITY_RADIUS', '0'))
+# Where trace results are cached: app.caching.LRUCache keeps them in each process, app.caching.DjangoCache
+# in one of CACHES, shared by every process.
+TRACE_CACHE = {
+    'BACKEND': os.environ.get('TRACE_CACHE_BACKEND', 'app.caching.LRUCache'),
+    'OPTIONS': {'max_size': 10000},
+}
+# Where the country messages of app launches are cached, one of CACHES. Saves of organizations and users make
+# the messages they change be computed again, but a cache each process keeps on its own, like the default local
+# memory one, only learns of the saves made in its process: the others serve theirs for up to TIMEOUT seconds.
+COUNTRY_MESSAGE_CACHE = {
+    'ALIAS': os.environ.get('COUNTRY_MESSAGE_CACHE_ALIAS', 'default'),
+    'TIMEOUT': int(os.environ.get('COUNTRY_MESSAGE_CACHE_TIMEOUT', '60')),
+}
+# Tokens each process keeps along with their user and organization, see app.authentication. A token deleted, or a
+# user or organization saved, in another process is still accepted as it was for up to TTL seconds.
+TOKEN_CACHE = {
+    'MAX_SIZE': 10000,
+    'TTL': float(os.environ.get('TOKEN_CACHE_TTL', '30')),
+}
+# Latest cases of the country listed on the dashboard, next to the counts of app.summaries.
+DASHBOARD_CASES = 10
+# Generated COVID IDs, see app.covid_ids. Changing KEY makes the IDs generated after collide with earlier ones.
+COVID_IDS = {
+    'KEY': os.environ.get('COVID_IDS_KEY', 'tracecovid19'),
+    'BLOCK_SIZE': 1000,  # counter values each process reserves at a time
+}
+# Activities and locations each process keeps the ids of, see app.interning. Every REPORT_EVERY lookups the
+# hit rates are logged at INFO by the app.interning logger, 0 turns that off.
+INTERNING = {
+    'ACTIVITIES_MAX_SIZE': 10000,
+    'LOCATIONS_MAX_SIZE': 50000,
+    'CHECK_INTERVAL': 1.0,  # seconds between checks of the data versions that clear the caches
+    'REPORT_EVERY': 10000,
+}